@@ -0,0 +1,259 @@
+"""Admission control: a global concurrency cap with a bounded wait queue, plus per-caller rate limits."""
+from collections import OrderedDict, deque
+from typing import Deque, Dict, Iterable, Optional, Tuple
+import asyncio
+import math
+import sqlite3
+import threading
+import time
+
+from app.config import settings
+from app.rate_limit import TokenBucket
+
+
+class AdmissionRejected(Exception):
+    """A request was shed; the caller should retry after `retry_after` seconds."""
+    
+    def __init__(self, detail: str, retry_after: float):
+        super().__init__(detail)
+        self.detail = detail
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+class MemoryBucketStore:
+    """Token buckets per key in this worker's memory, least recently used keys evicted first."""
+    
+    def __init__(self, max_keys: int = 100000):
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()
+    
+    def _bucket(self, key: str, rate: float, capacity: float) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(rate, capacity)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket
+    
+    async def try_acquire(self, key: str, rate: float, capacity: float, tokens: float = 1.0) -> float:
+        return self._bucket(key, rate, capacity).try_acquire(tokens)
+    
+    async def refund(self, key: str, rate: float, capacity: float, tokens: float) -> None:
+        self._bucket(key, rate, capacity).refund(tokens)
+
+
+class SQLiteBucketStore:
+    """
+    Token buckets in a SQLite file, shared by every worker on the host.
+    
+    Each acquisition is one short `BEGIN IMMEDIATE` transaction, run on a
+    worker thread. Buckets that have refilled completely carry no state and
+    are pruned now and then.
+    """
+    
+    PRUNE_EVERY = 1000
+    
+    def __init__(self, path: str):
+        self.path = path
+        self._connection: Optional[sqlite3.Connection] = None
+        # One connection, used from executor threads one at a time
+        self._lock = threading.Lock()
+        self._calls = 0
+    
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS rate_limit_buckets "
+                "(key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL, full_at REAL NOT NULL)"
+            )
+            self._connection = connection
+        return self._connection
+    
+    def _try_acquire(self, key: str, rate: float, capacity: float, amount: float) -> float:
+        with self._lock:
+            return self._take(self._connect(), key, rate, capacity, amount)
+    
+    def _take(self, connection: sqlite3.Connection, key: str, rate: float, capacity: float, amount: float) -> float:
+        """Take `amount` tokens if available; a negative amount gives tokens back."""
+        now = time.time()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute(
+                "SELECT tokens, updated FROM rate_limit_buckets WHERE key = ?", (key,)
+            ).fetchone()
+            tokens = capacity if row is None else min(capacity, row[0] + (now - row[1]) * rate)
+            wait = 0.0
+            if tokens >= amount:
+                tokens = min(capacity, tokens - amount)
+            else:
+                wait = (amount - tokens) / rate
+            connection.execute(
+                "INSERT OR REPLACE INTO rate_limit_buckets (key, tokens, updated, full_at) VALUES (?, ?, ?, ?)",
+                (key, tokens, now, now + (capacity - tokens) / rate)
+            )
+            self._calls += 1
+            if self._calls % self.PRUNE_EVERY == 0:
+                connection.execute("DELETE FROM rate_limit_buckets WHERE full_at < ?", (now,))
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+        return wait
+    
+    async def try_acquire(self, key: str, rate: float, capacity: float, tokens: float = 1.0) -> float:
+        return await asyncio.to_thread(self._try_acquire, key, rate, capacity, tokens)
+    
+    async def refund(self, key: str, rate: float, capacity: float, tokens: float) -> None:
+        await asyncio.to_thread(self._try_acquire, key, rate, capacity, -tokens)
+
+
+def create_bucket_store():
+    """Bucket store selected by RATE_LIMIT_STORE."""
+    if settings.rate_limit_store == "sqlite":
+        return SQLiteBucketStore(settings.rate_limit_sqlite_path)
+    return MemoryBucketStore()
+
+
+class AdmissionController:
+    """
+    Decide whether a query may run now, wait, or be shed.
+    
+    Requests over a caller's token bucket (per `user_id` and per
+    `session_id`) are rejected at once. Otherwise up to `max_concurrent`
+    run; up to `max_queue` more wait in FIFO order for at most
+    `queue_timeout` seconds. Anything beyond that is shed with a
+    Retry-After estimated from recent service times.
+    """
+    
+    def __init__(self, max_concurrent: int, max_queue: int, queue_timeout: float, store=None):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.store = store or MemoryBucketStore()
+        self._active = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+        self._service_time = 1.0  # EWMA of seconds a slot is held
+        self.stats = {
+            "admitted": 0,
+            "queued": 0,
+            "shed_queue_full": 0,
+            "shed_timeout": 0,
+            "rate_limited_user": 0,
+            "rate_limited_session": 0
+        }
+    
+    @property
+    def enabled(self) -> bool:
+        return self.max_concurrent > 0
+    
+    def _retry_after(self) -> float:
+        # Time for the queue ahead of a new request to drain
+        return self._service_time * (len(self._waiters) + 1) / max(self.max_concurrent, 1)
+    
+    async def check_rate(self, user_id: Optional[str], session_id: Optional[str]) -> None:
+        """Raise AdmissionRejected if the caller is over its token bucket."""
+        await self.check_batch_rate([(user_id, session_id)])
+    
+    async def check_batch_rate(self, callers: Iterable[Tuple[Optional[str], Optional[str]]]) -> None:
+        """
+        Charge one `(user_id, session_id)` pair per query against the token buckets.
+        
+        Each distinct user and session is charged once for its number of
+        queries, capped at its burst, so a batch larger than the burst needs a
+        full bucket rather than being refused forever. If any bucket is short,
+        the tokens already taken are given back and AdmissionRejected is raised.
+        """
+        limits = {
+            "user": (settings.rate_limit_user_rps, settings.rate_limit_user_burst),
+            "session": (settings.rate_limit_session_rps, settings.rate_limit_session_burst)
+        }
+        counts: Dict[Tuple[str, str], int] = {}
+        for user_id, session_id in callers:
+            for scope, key in (("user", user_id), ("session", session_id)):
+                if key and limits[scope][0] > 0:
+                    counts[(scope, key)] = counts.get((scope, key), 0) + 1
+        
+        charged = []
+        try:
+            for (scope, key), count in counts.items():
+                rate, burst = limits[scope]
+                capacity = max(burst, 1)
+                charge = (f"{scope}:{key}", rate, capacity, min(count, capacity))
+                wait = await self.store.try_acquire(*charge)
+                if wait:
+                    self.stats[f"rate_limited_{scope}"] += 1
+                    raise AdmissionRejected(f"Rate limit exceeded for this {scope}", wait)
+                charged.append(charge)
+        except AdmissionRejected:
+            for charge in charged:
+                await self.store.refund(*charge)
+            raise
+    
+    async def acquire(self, user_id: Optional[str] = None, session_id: Optional[str] = None) -> float:
+        """
+        Check the caller's rate limits, then wait for a slot, or raise AdmissionRejected.
+        
+        Returns:
+            The monotonic time the slot was granted, to pass to `release`
+        """
+        await self.check_rate(user_id, session_id)
+        return await self.acquire_slot()
+    
+    async def acquire_slot(self) -> float:
+        """Wait for a concurrency slot without charging any rate limit (already checked by the caller)."""
+        if not self.enabled:
+            return time.monotonic()
+        
+        if self._active < self.max_concurrent and not self._waiters:
+            self._active += 1
+        else:
+            if len(self._waiters) >= self.max_queue:
+                self.stats["shed_queue_full"] += 1
+                raise AdmissionRejected("Server is busy, please retry", self._retry_after())
+            
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            self.stats["queued"] += 1
+            try:
+                await asyncio.wait_for(asyncio.shield(waiter), self.queue_timeout)
+            except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+                if waiter.done() and not waiter.cancelled():
+                    # The slot was handed over just as we gave up: pass it on
+                    self._hand_over()
+                else:
+                    waiter.cancel()
+                    self._waiters.remove(waiter)
+                if isinstance(e, asyncio.CancelledError):
+                    raise
+                self.stats["shed_timeout"] += 1
+                raise AdmissionRejected("Server is busy, please retry", self._retry_after())
+        
+        self.stats["admitted"] += 1
+        return time.monotonic()
+    
+    def release(self, granted_at: float) -> None:
+        if not self.enabled:
+            return
+        self._service_time = 0.9 * self._service_time + 0.1 * (time.monotonic() - granted_at)
+        self._hand_over()
+    
+    def _hand_over(self) -> None:
+        """Give a finished slot to the oldest waiter, or free it."""
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self._active -= 1
+    
+    def get_stats(self) -> Dict:
+        return {
+            **self.stats,
+            "active": self._active,
+            "waiting": len(self._waiters),
+            "avg_service_seconds": round(self._service_time, 4)
+        }
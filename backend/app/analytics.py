@@ -0,0 +1,395 @@
+"""Incremental usage rollups of the audit log and the dashboard queries served from them.
+
+Run one rollup pass from the backend directory with:
+
+    python -m app.analytics
+"""
+from bisect import bisect_left
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+import asyncio
+import time
+
+from sqlalchemy import insert, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import settings
+from app.context_engine import context_hash
+from app.logger import logger, start_log_output
+from app.models import CacheVersion, ContextPreset, ConversationLog, SessionLocal, UsageRollup, engine
+
+# Row in `cache_versions` holding the id of the last audit row rolled up
+ANALYTICS_WATERMARK_KEY = "analytics"
+
+DIMENSION_TOTAL = "total"
+DIMENSION_PRESET = "preset"
+DIMENSION_USER = "user"
+DIMENSION_HOUR = "hour"
+
+# Preset keys for audit rows whose context is not a preset as applied
+PRESET_CUSTOM = "custom"
+PRESET_NONE = "none"
+
+# Upper bounds of the latency histogram buckets, plus one overflow bucket
+LATENCY_BUCKETS_MS = (50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+
+# Stages already covered by another stage and not added to a turn's latency
+_OVERLAPPING_STAGES = {"llm_first_token"}
+
+
+def _hour(timestamp: datetime) -> datetime:
+    return timestamp.replace(minute=0, second=0, microsecond=0)
+
+
+def _naive_utc(value: datetime) -> datetime:
+    # Log timestamps are stored as naive UTC
+    if value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def _turn_usage(metadata: Optional[Dict]) -> Tuple[float, int, int]:
+    """Latency in ms and prompt/completion tokens of one audit row's `extra_metadata`."""
+    metadata = metadata or {}
+    timings = metadata.get("timings_ms") or {}
+    latency = sum(value for stage, value in timings.items() if stage not in _OVERLAPPING_STAGES)
+    return float(latency), int(metadata.get("prompt_tokens") or 0), int(metadata.get("completion_tokens") or 0)
+
+
+class _Totals:
+    """Running totals for one rollup row while a batch is aggregated."""
+    
+    __slots__ = ("queries", "latency_sum", "latency_min", "latency_max", "histogram", "prompt_tokens", "completion_tokens")
+    
+    def __init__(self):
+        self.queries = 0
+        self.latency_sum = 0.0
+        self.latency_min: Optional[float] = None
+        self.latency_max = 0.0
+        self.histogram = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+    
+    def add(self, latency: float, prompt_tokens: int, completion_tokens: int) -> None:
+        self.queries += 1
+        self.latency_sum += latency
+        self.latency_min = latency if self.latency_min is None else min(self.latency_min, latency)
+        self.latency_max = max(self.latency_max, latency)
+        self.histogram[bisect_left(LATENCY_BUCKETS_MS, latency)] += 1
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+    
+    def merge_row(self, row) -> None:
+        self.queries += row.queries
+        self.latency_sum += row.latency_ms_sum
+        if row.queries:
+            # Rows rolled up before the minimum was kept only bound it by 0
+            row_min = row.latency_ms_min if row.latency_ms_min is not None else 0.0
+            self.latency_min = row_min if self.latency_min is None else min(self.latency_min, row_min)
+        self.latency_max = max(self.latency_max, row.latency_ms_max)
+        self.histogram = [count + extra for count, extra in zip(self.histogram, row.latency_histogram)]
+        self.prompt_tokens += row.prompt_tokens
+        self.completion_tokens += row.completion_tokens
+    
+    def percentile(self, fraction: float) -> Optional[float]:
+        """
+        Estimate a latency percentile by interpolating within its histogram bucket.
+        
+        The bucket's range is narrowed to the observed minimum and maximum, so
+        the estimate never falls outside the latencies actually seen.
+        """
+        if self.queries == 0:
+            return None
+        rank = fraction * self.queries
+        seen = 0
+        lower = 0.0
+        for bound, count in zip(LATENCY_BUCKETS_MS + (self.latency_max,), self.histogram):
+            if count and seen + count >= rank:
+                lower = max(lower, self.latency_min or 0.0)
+                upper = min(bound, self.latency_max)
+                return round(lower + (upper - lower) * (rank - seen) / count, 2)
+            seen += count
+            lower = bound
+        return round(self.latency_max, 2)
+    
+    def summary(self) -> Dict:
+        return {
+            "queries": self.queries,
+            "avg_latency_ms": round(self.latency_sum / self.queries, 2) if self.queries else None,
+            "p50_latency_ms": self.percentile(0.5),
+            "p95_latency_ms": self.percentile(0.95),
+            "max_latency_ms": round(self.latency_max, 2) if self.queries else None,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "total_tokens": self.prompt_tokens + self.completion_tokens
+        }
+
+
+class UsageAnalytics:
+    """
+    Roll audit rows up into hourly usage totals per preset and per user.
+    
+    Each pass reads the `conversation_logs` rows after the watermark (the id
+    of the last row rolled up, kept in the `analytics` row of
+    `cache_versions`), adds them to the matching `usage_rollups` rows and
+    advances the watermark in the same transaction, so no row is ever read
+    twice. The watermark is advanced with a compare-and-set before the
+    rollups are written: when several workers run passes, only one claims a
+    batch and the others roll back.
+    
+    A row's preset is the preset whose context hash equals the row's
+    `context_hash`, i.e. the context the turn ran with was a preset as
+    applied; other contexts count as "custom" and empty ones as "none".
+    Rows younger than `analytics_settle_seconds` are left for the next pass
+    so rows committed late by another worker are not skipped. Age is taken
+    from `inserted_at`, not the turn's `timestamp`: a row is committed right
+    after it is inserted, however long it waited in the audit queue.
+    """
+    
+    def __init__(self):
+        self.interval = settings.analytics_rollup_interval
+        self._task: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+        self.last_run: Optional[Dict] = None
+        self.stats = {"runs": 0, "failed_runs": 0, "rows_rolled_up": 0, "batches": 0, "lost_claims": 0}
+    
+    def start(self) -> None:
+        if self._task is None and self.interval > 0:
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+    
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.run_once()
+            except Exception as e:
+                self.stats["failed_runs"] += 1
+                logger.error("Error rolling up usage analytics: %s", e, exc_info=True)
+    
+    async def run_once(self) -> Dict:
+        """Roll up every settled row after the watermark; concurrent calls wait for each other."""
+        async with self._lock:
+            started = time.perf_counter()
+            result = {"rows_rolled_up": 0, "batches": 0}
+            await self._ensure_watermark()
+            while True:
+                async with SessionLocal() as db:
+                    rolled_up = await self._rollup_batch(db)
+                if not rolled_up:
+                    break
+                result["rows_rolled_up"] += rolled_up
+                result["batches"] += 1
+                if rolled_up < settings.analytics_batch_size:
+                    break
+            
+            for key, value in result.items():
+                self.stats[key] += value
+            self.stats["runs"] += 1
+            result["duration_seconds"] = round(time.perf_counter() - started, 3)
+            self.last_run = {**result, "finished_at": datetime.utcnow().isoformat()}
+            if result["rows_rolled_up"]:
+                logger.info("Usage rollup finished: %s", result)
+            return result
+    
+    @staticmethod
+    async def _ensure_watermark() -> None:
+        async with SessionLocal() as db:
+            exists = await db.scalar(
+                select(CacheVersion.name).where(CacheVersion.name == ANALYTICS_WATERMARK_KEY)
+            )
+            if exists:
+                return
+            db.add(CacheVersion(name=ANALYTICS_WATERMARK_KEY, version=0))
+            try:
+                await db.commit()
+            except IntegrityError:
+                # Another worker created it first
+                await db.rollback()
+    
+    @staticmethod
+    async def _preset_hashes(db: AsyncSession) -> Dict[str, str]:
+        rows = (await db.execute(select(ContextPreset.name, ContextPreset.context_data))).all()
+        return {context_hash(data): name for name, data in rows if data}
+    
+    async def _rollup_batch(self, db: AsyncSession) -> int:
+        watermark = await db.scalar(
+            select(CacheVersion.version).where(CacheVersion.name == ANALYTICS_WATERMARK_KEY)
+        ) or 0
+        settled = datetime.utcnow() - timedelta(seconds=settings.analytics_settle_seconds)
+        rows = (await db.execute(
+            select(
+                ConversationLog.id, ConversationLog.timestamp, ConversationLog.inserted_at,
+                ConversationLog.user_id, ConversationLog.context_hash, ConversationLog.extra_metadata
+            )
+            .where(ConversationLog.id > watermark)
+            .order_by(ConversationLog.id)
+            .limit(settings.analytics_batch_size)
+        )).all()
+        # Stop at the first unsettled row; everything after it waits for the next pass
+        for index, row in enumerate(rows):
+            if row.inserted_at is not None and row.inserted_at >= settled:
+                rows = rows[:index]
+                break
+        if not rows:
+            return 0
+        
+        # Claim the batch before writing anything: a worker that lost the race matches no row
+        claimed = await db.execute(
+            update(CacheVersion)
+            .where(CacheVersion.name == ANALYTICS_WATERMARK_KEY, CacheVersion.version == watermark)
+            .values(version=rows[-1].id, updated_at=datetime.utcnow())
+        )
+        if claimed.rowcount != 1:
+            await db.rollback()
+            self.stats["lost_claims"] += 1
+            return 0
+        
+        presets = await self._preset_hashes(db)
+        inline = await self._inline_contexts(db, [row.id for row in rows if row.context_hash is None])
+        batch: Dict[Tuple[str, datetime, str], _Totals] = defaultdict(_Totals)
+        for row in rows:
+            digest = row.context_hash or inline.get(row.id)
+            preset = presets.get(digest, PRESET_CUSTOM) if digest else PRESET_NONE
+            hour = _hour(row.timestamp or datetime.utcnow())
+            usage = _turn_usage(row.extra_metadata)
+            batch[(DIMENSION_TOTAL, hour, "")].add(*usage)
+            batch[(DIMENSION_PRESET, hour, preset)].add(*usage)
+            batch[(DIMENSION_USER, hour, row.user_id or "")].add(*usage)
+        
+        await self._merge(db, batch)
+        await db.commit()
+        return len(rows)
+    
+    @staticmethod
+    async def _inline_contexts(db: AsyncSession, log_ids: List[int]) -> Dict[int, str]:
+        """Hashes of legacy inline contexts (rows not yet moved to context_blobs)."""
+        if not log_ids:
+            return {}
+        rows = await db.execute(
+            select(ConversationLog.id, ConversationLog.context_used)
+            .where(ConversationLog.id.in_(log_ids), ConversationLog.context_used.isnot(None))
+        )
+        return {log_id: context_hash(context) for log_id, context in rows if context}
+    
+    @staticmethod
+    async def _merge(db: AsyncSession, batch: Dict[Tuple[str, datetime, str], _Totals]) -> None:
+        dimensions = {dimension for dimension, _, _ in batch}
+        hours = {hour for _, hour, _ in batch}
+        existing = {
+            (row.dimension, row.hour, row.key): row
+            for row in (await db.execute(
+                select(UsageRollup).where(UsageRollup.dimension.in_(dimensions), UsageRollup.hour.in_(hours))
+            )).scalars()
+        }
+        new_rows = []
+        for (dimension, hour, key), totals in batch.items():
+            row = existing.get((dimension, hour, key))
+            if row is None:
+                new_rows.append({
+                    "dimension": dimension,
+                    "hour": hour,
+                    "key": key,
+                    "queries": totals.queries,
+                    "latency_ms_sum": totals.latency_sum,
+                    "latency_ms_min": totals.latency_min,
+                    "latency_ms_max": totals.latency_max,
+                    "latency_histogram": totals.histogram,
+                    "prompt_tokens": totals.prompt_tokens,
+                    "completion_tokens": totals.completion_tokens,
+                    "updated_at": datetime.utcnow()
+                })
+                continue
+            totals.merge_row(row)
+            row.queries = totals.queries
+            row.latency_ms_sum = totals.latency_sum
+            row.latency_ms_min = totals.latency_min
+            row.latency_ms_max = totals.latency_max
+            row.latency_histogram = totals.histogram
+            row.prompt_tokens = totals.prompt_tokens
+            row.completion_tokens = totals.completion_tokens
+        if new_rows:
+            await db.execute(insert(UsageRollup), new_rows)
+    
+    async def query(self, db: AsyncSession, dimension: str, start: Optional[datetime] = None,
+                    end: Optional[datetime] = None, limit: int = 50) -> Dict:
+        """
+        Answer a dashboard query from the rollups.
+        
+        Only `usage_rollups` rows are read, one per key and hour in the range,
+        so the cost depends on the range and not on how many queries were
+        logged. Latency percentiles are estimated from histogram buckets.
+        
+        Args:
+            db: Database session
+            dimension: "preset" or "user" (totals per key) or "hour" (time series)
+            start: Start of the range, rounded down to the hour (default: 7 days before `end`)
+            end: End of the range, exclusive (default: now)
+            limit: Maximum number of keys, busiest first (ignored for "hour")
+        
+        Returns:
+            Dictionary with the range, overall 'totals', one entry per key or
+            hour in 'groups', and the 'watermark' the rollups are current to
+        """
+        end = _naive_utc(end) if end else datetime.utcnow()
+        start = _hour(_naive_utc(start) if start else end - timedelta(days=7))
+        source = DIMENSION_TOTAL if dimension == DIMENSION_HOUR else dimension
+        rows = (await db.execute(
+            select(UsageRollup)
+            .where(UsageRollup.dimension == source, UsageRollup.hour >= start, UsageRollup.hour < end)
+            .order_by(UsageRollup.hour)
+        )).scalars().all()
+        
+        totals = _Totals()
+        groups: Dict = defaultdict(_Totals)
+        for row in rows:
+            totals.merge_row(row)
+            groups[row.hour if dimension == DIMENSION_HOUR else row.key].merge_row(row)
+        
+        if dimension == DIMENSION_HOUR:
+            entries = [{"hour": hour.isoformat(), **group.summary()} for hour, group in groups.items()]
+        else:
+            busiest = sorted(groups.items(), key=lambda item: item[1].queries, reverse=True)[:limit]
+            entries = [{dimension: key or None, **group.summary()} for key, group in busiest]
+        
+        watermark = (await db.execute(
+            select(CacheVersion.version, CacheVersion.updated_at)
+            .where(CacheVersion.name == ANALYTICS_WATERMARK_KEY)
+        )).first()
+        return {
+            "dimension": dimension,
+            "start": start.isoformat(),
+            "end": end.isoformat(),
+            "totals": totals.summary(),
+            "groups": entries,
+            "watermark": {
+                "last_log_id": watermark.version if watermark else 0,
+                "updated_at": watermark.updated_at.isoformat() if watermark and watermark.updated_at else None
+            }
+        }
+    
+    def get_stats(self) -> Dict:
+        return {**self.stats, "enabled": self.interval > 0, "last_run": self.last_run}
+
+
+async def _main():
+    start_log_output()
+    try:
+        await UsageAnalytics().run_once()
+    finally:
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
@@ -0,0 +1,138 @@
+"""Deferred, batched writer for the conversation audit log."""
+from typing import Dict, List, Optional
+import asyncio
+
+from sqlalchemy import insert
+
+from app.config import settings
+from app.logger import logger
+from app.models import ConversationLog, SessionLocal
+
+
+class AuditLogWriter:
+    """
+    Queue audit rows in memory and bulk-insert them from a background task.
+    
+    Rows are flushed when `audit_batch_size` rows are pending or every
+    `audit_flush_interval` seconds, whichever comes first. When the queue is
+    full, `submit` waits up to `audit_enqueue_timeout` seconds for room and
+    then drops the row, so a slow database never stalls request handling.
+    
+    A row keeps the `timestamp` of its turn; `inserted_at` is filled in when
+    its batch is inserted, however far the writer falls behind.
+    """
+    
+    def __init__(self):
+        self.batch_size = settings.audit_batch_size
+        self.flush_interval = settings.audit_flush_interval
+        self.enqueue_timeout = settings.audit_enqueue_timeout
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._inflight: Optional[asyncio.Future] = None
+        self._cancelled_batch: List[Dict] = []
+        self.stats = {
+            "submitted": 0,
+            "written": 0,
+            "dropped": 0,
+            "backpressure_waits": 0,
+            "failed_batches": 0
+        }
+    
+    async def start(self) -> None:
+        """Start the background flush task."""
+        if self._task:
+            return
+        self._queue = asyncio.Queue(maxsize=settings.audit_queue_size)
+        self._task = asyncio.create_task(self._run())
+    
+    async def stop(self) -> None:
+        """Stop the flush task and write every pending row."""
+        if not self._task:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        if self._inflight:
+            await self._inflight
+            self._inflight = None
+        
+        pending = self._cancelled_batch + self._drain(self._queue.qsize())
+        self._cancelled_batch = []
+        for start in range(0, len(pending), self.batch_size):
+            await self._write(pending[start:start + self.batch_size])
+    
+    async def submit(self, row: Dict) -> bool:
+        """
+        Queue one audit row for writing.
+        
+        Args:
+            row: Column values for a `ConversationLog` row
+        
+        Returns:
+            True if the row was queued, False if it was dropped
+        """
+        if not self._queue:
+            # Writer not running (e.g. scripts, tests): write through
+            await self._write([row])
+            return True
+        
+        try:
+            self._queue.put_nowait(row)
+        except asyncio.QueueFull:
+            self.stats["backpressure_waits"] += 1
+            try:
+                await asyncio.wait_for(self._queue.put(row), timeout=self.enqueue_timeout)
+            except asyncio.TimeoutError:
+                self.stats["dropped"] += 1
+                logger.warning("Audit log queue full, dropping row")
+                return False
+        self.stats["submitted"] += 1
+        return True
+    
+    def _drain(self, limit: int) -> List[Dict]:
+        rows = []
+        while len(rows) < limit and not self._queue.empty():
+            rows.append(self._queue.get_nowait())
+        return rows
+    
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.flush_interval
+            try:
+                # Fill the batch until it is full or the flush interval expires
+                while len(batch) < self.batch_size:
+                    batch.extend(self._drain(self.batch_size - len(batch)))
+                    remaining = deadline - loop.time()
+                    if len(batch) >= self.batch_size or remaining <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self._queue.get(), timeout=remaining))
+                    except asyncio.TimeoutError:
+                        break
+            except asyncio.CancelledError:
+                # Shutting down: hand the rows to stop() so they are flushed
+                self._cancelled_batch = batch
+                raise
+            # Shield the write so shutdown waits for it instead of abandoning it
+            self._inflight = asyncio.ensure_future(self._write(batch))
+            await asyncio.shield(self._inflight)
+            self._inflight = None
+    
+    async def _write(self, rows: List[Dict]) -> None:
+        try:
+            async with SessionLocal() as db:
+                await db.execute(insert(ConversationLog), rows)
+                await db.commit()
+            self.stats["written"] += len(rows)
+        except Exception as e:
+            self.stats["failed_batches"] += 1
+            logger.error("Error writing %s audit log row(s): %s", len(rows), e)
+    
+    def get_stats(self) -> Dict:
+        """Writer counters plus the current queue depth."""
+        return {**self.stats, "pending": self._queue.qsize() if self._queue else 0}
@@ -0,0 +1,322 @@
+"""Batch query execution with bounded concurrency and bulk persistence."""
+from datetime import datetime
+from typing import AsyncIterator, Dict, List, Optional
+import asyncio
+import json
+import uuid
+
+from sqlalchemy import insert, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.admission import AdmissionController, AdmissionRejected
+from app.config import settings
+from app.conversation_store import allocate_seqs
+from app.history import select_histories, schedule_summary_refresh
+from app.logger import logger
+from app.metrics import StageTimer, turn_metadata
+from app.models import ConversationMessage, ConversationSession
+from app.tokens import count_tokens, history_token_budget
+
+
+class _SessionState:
+    """In-memory view of one session while a batch runs against it."""
+    
+    def __init__(self, session: ConversationSession, context: Dict, history: List[Dict], token_counts: List[int],
+                 summary: Optional[str], first_seq: Optional[int]):
+        self.session = session
+        self.session_id = session.session_id  # Readable even while the row is expired after a rollback
+        self.context_key = session.context_hash  # Blob hash of `context` while it is unchanged
+        self.history = history
+        self.token_counts = token_counts  # Per message of `history`, counted once
+        self.summary = summary
+        self.first_seq = first_seq
+        self.context = context
+
+
+class BatchRunner:
+    """
+    Run many queries through the LLM service and stream results as NDJSON.
+    
+    Sessions and history windows are loaded up front with a handful of
+    queries, whatever the number of sessions. Queries of the same session run one after
+    another so each sees the previous turn; different sessions run
+    concurrently, at most `concurrency` LLM calls at a time. Completed turns
+    are written with one bulk insert and one commit per `batch_flush_size`
+    results instead of a commit per query; their message positions are
+    reserved from each session's counter at that point, so single queries on
+    the same sessions can run meanwhile. Each LLM call holds a slot of the
+    shared admission controller, so batches count against the worker's
+    concurrency cap like single queries.
+    """
+    
+    def __init__(self, llm_service, context_engine, context_store, context_blobs, audit_writer,
+                 admission: AdmissionController):
+        self.llm_service = llm_service
+        self.context_engine = context_engine
+        self.context_store = context_store
+        self.context_blobs = context_blobs
+        self.audit_writer = audit_writer
+        self.admission = admission
+    
+    @staticmethod
+    async def _create_sessions(db: AsyncSession, session_ids: List[str]) -> None:
+        """Commit new sessions before any LLM call; ones created meanwhile by other requests are kept."""
+        db.add_all([ConversationSession(session_id=session_id) for session_id in session_ids])
+        try:
+            await db.commit()
+            return
+        except IntegrityError:
+            await db.rollback()
+        for session_id in session_ids:
+            db.add(ConversationSession(session_id=session_id))
+            try:
+                await db.commit()
+            except IntegrityError:
+                # Another request created it first
+                await db.rollback()
+    
+    async def _load_sessions(self, db: AsyncSession, session_ids: List[str]) -> Dict[str, _SessionState]:
+        result = await db.execute(
+            select(ConversationSession.session_id).where(ConversationSession.session_id.in_(session_ids))
+        )
+        missing = set(session_ids) - set(result.scalars().all())
+        if missing:
+            # New sessions start with an empty context
+            await self._create_sessions(db, sorted(missing))
+        
+        result = await db.execute(
+            select(ConversationSession).where(ConversationSession.session_id.in_(session_ids))
+        )
+        sessions = {session.session_id: session for session in result.scalars().all()}
+        
+        contexts = {}
+        for session_id, session in sessions.items():
+            contexts[session_id] = await self.context_blobs.session_context(db, session)
+        
+        histories = await select_histories(
+            db, [sessions[session_id] for session_id in session_ids if session_id not in missing],
+            self.llm_service.model
+        )
+        
+        states = {}
+        for session_id in session_ids:
+            session = sessions[session_id]
+            history, token_counts, summary, first_seq = histories.get(session_id, ([], [], session.summary, None))
+            states[session_id] = _SessionState(
+                session, contexts[session_id], history, token_counts, summary, first_seq
+            )
+        await db.commit()
+        return states
+    
+    def _window(self, state: _SessionState) -> List[Dict]:
+        """Trim history held in memory to the model's budget, keeping the newest messages."""
+        model = self.llm_service.model
+        budget = history_token_budget(model) - (count_tokens(state.summary, model) if state.summary else 0)
+        start = len(state.history)
+        limit = max(0, len(state.history) - settings.history_max_messages)
+        while start > limit and budget - state.token_counts[start - 1] >= 0:
+            start -= 1
+            budget -= state.token_counts[start]
+        return state.history[start:]
+    
+    async def _run_session(self, items: List[Dict], state: _SessionState, use_cache: bool,
+                           semaphore: asyncio.Semaphore, results: asyncio.Queue) -> None:
+        for item in items:
+            result = {"index": item["index"], "id": item.get("id"), "session_id": state.session_id}
+            timer = item["timer"] = StageTimer("query_batch")
+            try:
+                item["context_used"] = item.get("context") or state.context
+                with timer.stage("prompt_build"):
+                    chunks = await self.context_engine.retrieve_knowledge_async(item["query"])
+                    item["messages"] = self.context_engine.build_chat_messages(
+                        user_query=item["query"],
+                        context_override=item["context_used"],
+                        conversation_history=self._window(state),
+                        conversation_summary=state.summary,
+                        knowledge_chunks=chunks,
+                        context_key=None if item.get("context") else state.context_key
+                    )
+                async with semaphore:
+                    granted_at = await self.admission.acquire_slot()
+                    try:
+                        with timer.stage("llm_wait"):
+                            response_text = await self.llm_service.generate_response(
+                                item["messages"], use_cache=use_cache
+                            )
+                    finally:
+                        self.admission.release(granted_at)
+                
+                turn = [
+                    {"role": "user", "content": item["query"]},
+                    {"role": "assistant", "content": response_text}
+                ]
+                item["token_counts"] = [count_tokens(message["content"], self.llm_service.model) for message in turn]
+                state.history.extend(turn)
+                state.token_counts.extend(item["token_counts"])
+                if item.get("context"):
+                    state.context = {**state.context, **item["context"]}
+                    state.context_key = None
+                result["response"] = response_text
+                await results.put((result, item, state, turn))
+            except AdmissionRejected as e:
+                result["error"] = e.detail
+                result["retry_after"] = e.retry_after
+                await results.put((result, item, state, None))
+            except Exception as e:
+                logger.error("Error processing batch item %s: %s", item['index'], e)
+                result["error"] = f"Error processing query: {str(e)}"
+                await results.put((result, item, state, None))
+    
+    async def _write_turns(self, db: AsyncSession, completed: List) -> None:
+        """Insert the messages of completed turns with one bulk insert and commit."""
+        touched: Dict[str, _SessionState] = {}
+        counts: Dict[str, int] = {}
+        for item, state, turn in completed:
+            touched[state.session_id] = state
+            counts[state.session_id] = counts.get(state.session_id, 0) + len(turn)
+        
+        # New context blobs commit on their own connection, so store them before this transaction writes
+        for state in touched.values():
+            await self.context_blobs.assign(state.session, state.context)
+            state.session.updated_at = datetime.utcnow()
+        # Reserve positions in session order, so concurrent flushes lock the rows in the same order
+        next_seqs = {}
+        for session_id in sorted(counts):
+            next_seqs[session_id] = await allocate_seqs(db, session_id, counts[session_id])
+        
+        rows = []
+        for item, state, turn in completed:
+            for message, token_count in zip(turn, item["token_counts"]):
+                rows.append({
+                    "session_id": state.session_id,
+                    "seq": next_seqs[state.session_id],
+                    "role": message["role"],
+                    "content": message["content"],
+                    "token_count": token_count,
+                    "created_at": datetime.utcnow()
+                })
+                next_seqs[state.session_id] += 1
+        await db.execute(insert(ConversationMessage), rows)
+        await db.commit()
+        
+        for state in touched.values():
+            self.context_store.remember(state.session_id, state.context)
+    
+    @staticmethod
+    async def _rollback(db: AsyncSession, states: Dict[str, _SessionState]) -> None:
+        """Roll back a failed write and reload the session rows the rollback expired."""
+        await db.rollback()
+        await db.execute(
+            select(ConversationSession)
+            .where(ConversationSession.session_id.in_(list(states)))
+            .execution_options(populate_existing=True)
+        )
+    
+    async def _flush(self, db: AsyncSession, completed: List, states: Dict[str, _SessionState]) -> List[Dict]:
+        """
+        Write completed turns with a single bulk insert and commit.
+        
+        When that fails, the turns are written one at a time, so one bad turn
+        does not lose the others.
+        
+        Returns:
+            Error results for turns that could not be saved
+        """
+        if not completed:
+            return []
+        flush_timer = StageTimer("query_batch")
+        saved = list(completed)
+        failures = []
+        
+        with flush_timer.stage("history_persist"):
+            try:
+                await self._write_turns(db, completed)
+            except Exception as e:
+                logger.error("Error saving %s batch turn(s), retrying one at a time: %s", len(completed), e)
+                await self._rollback(db, states)
+                saved = []
+                for entry in completed:
+                    item, state, _ = entry
+                    try:
+                        await self._write_turns(db, [entry])
+                        saved.append(entry)
+                    except Exception as e:
+                        logger.error("Error saving batch item %s: %s", item["index"], e)
+                        await self._rollback(db, states)
+                        failures.append({
+                            "index": item["index"],
+                            "id": item.get("id"),
+                            "session_id": state.session_id,
+                            "error": f"Error saving turn: {str(e)}"
+                        })
+        
+        with flush_timer.stage("audit_log"):
+            for item, state, turn in saved:
+                # Log the interaction for audit; written in batches off the request path
+                await self.audit_writer.submit({
+                    "timestamp": datetime.utcnow(),
+                    "user_query": item["query"],
+                    "context_hash": await self.context_blobs.put(item["context_used"]),
+                    "response": turn[1]["content"],
+                    "session_id": state.session_id,
+                    "user_id": item.get("user_id"),
+                    "extra_metadata": turn_metadata(
+                        item["timer"], self.llm_service.model, item["messages"], turn[1]["content"]
+                    )
+                })
+                item["timer"].finish()
+        completed.clear()
+        return failures
+    
+    async def run(self, db: AsyncSession, items: List[Dict], concurrency: int,
+                  use_cache: bool = True) -> AsyncIterator[str]:
+        """
+        Run a batch and yield one NDJSON line per query, in completion order.
+        
+        Args:
+            db: Database session, used only by this generator
+            items: Dictionaries with 'query' and optional 'context', 'session_id' and 'id'
+            concurrency: Maximum number of LLM calls in flight
+            use_cache: Whether to read and populate the response cache
+        
+        Yields:
+            JSON lines with 'index', 'id', 'session_id' and either 'response' or 'error'.
+            A turn that was answered but could not be saved gets a second line
+            with its 'index' and an 'error'.
+        """
+        groups: Dict[str, List[Dict]] = {}
+        for index, item in enumerate(items):
+            item = {**item, "index": index}
+            groups.setdefault(item.get("session_id") or str(uuid.uuid4()), []).append(item)
+        with StageTimer("query_batch").stage("session_load"):
+            states = await self._load_sessions(db, list(groups))
+        
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+        results: asyncio.Queue = asyncio.Queue()
+        tasks = [
+            asyncio.create_task(self._run_session(group, states[session_id], use_cache, semaphore, results))
+            for session_id, group in groups.items()
+        ]
+        
+        completed = []
+        try:
+            for _ in range(len(items)):
+                result, item, state, turn = await results.get()
+                failures = []
+                if turn is not None:
+                    completed.append((item, state, turn))
+                    if len(completed) >= settings.batch_flush_size:
+                        failures = await self._flush(db, completed, states)
+                yield json.dumps(result) + "\n"
+                for failure in failures:
+                    yield json.dumps(failure) + "\n"
+            for failure in await self._flush(db, completed, states):
+                yield json.dumps(failure) + "\n"
+        finally:
+            for task in tasks:
+                task.cancel()
+        
+        for state in states.values():
+            schedule_summary_refresh(state.session, state.first_seq, self.llm_service)
+        logger.info("Batch of %s queries processed across %s sessions", len(items), len(groups))
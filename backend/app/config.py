@@ -21,11 +21,91 @@ class Settings:
         self.azure_openai_deployment_name: str = os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME", "")
         self.azure_openai_api_version: str = os.getenv("AZURE_OPENAI_API_VERSION", "2024-02-15-preview")
         
+        # OpenAI-compatible Configuration (Ollama, LocalAI, ...); falls back to the Azure fields
+        self.openai_compatible_base_url: str = os.getenv("OPENAI_COMPATIBLE_BASE_URL", "") or self.azure_openai_endpoint
+        self.openai_compatible_api_key: str = os.getenv("OPENAI_COMPATIBLE_API_KEY", "") or self.azure_openai_api_key
+        
         # OpenRouter Configuration
         self.openrouter_api_key: str = os.getenv("OPENROUTER_API_KEY", "")
         self.openrouter_model: str = os.getenv("OPENROUTER_MODEL", "openai/gpt-3.5-turbo")
         self.openrouter_base_url: str = os.getenv("OPENROUTER_BASE_URL", "https://openrouter.ai/api/v1")
         
+        # Per-provider request timeouts (seconds)
+        self.openai_timeout: float = float(os.getenv("OPENAI_TIMEOUT", "60"))
+        self.azure_openai_timeout: float = float(os.getenv("AZURE_OPENAI_TIMEOUT", "60"))
+        self.openrouter_timeout: float = float(os.getenv("OPENROUTER_TIMEOUT", "60"))
+        self.openai_compatible_timeout: float = float(os.getenv("OPENAI_COMPATIBLE_TIMEOUT", "120"))
+        
+        # LLM HTTP Transport Configuration
+        self.llm_max_connections: int = int(os.getenv("LLM_MAX_CONNECTIONS", "100"))
+        self.llm_max_keepalive_connections: int = int(os.getenv("LLM_MAX_KEEPALIVE_CONNECTIONS", "20"))
+        self.llm_keepalive_expiry: float = float(os.getenv("LLM_KEEPALIVE_EXPIRY", "30"))
+        self.llm_connect_timeout: float = float(os.getenv("LLM_CONNECT_TIMEOUT", "10"))
+        self.llm_http2: bool = os.getenv("LLM_HTTP2", "true").lower() in ("1", "true", "yes")
+        
+        # Multi-provider routing: comma-separated "provider" or "provider:model"
+        # entries, e.g. "openai,openrouter:anthropic/claude-3-haiku". Empty uses LLM_PROVIDER only.
+        self.llm_providers: str = os.getenv("LLM_PROVIDERS", "")
+        self.llm_router_window: int = int(os.getenv("LLM_ROUTER_WINDOW", "100"))
+        self.llm_circuit_failure_threshold: int = int(os.getenv("LLM_CIRCUIT_FAILURE_THRESHOLD", "5"))
+        self.llm_circuit_reset_timeout: float = float(os.getenv("LLM_CIRCUIT_RESET_TIMEOUT", "30"))
+        # Seconds before a hedged request goes to the next backend (0 = no hedging)
+        self.llm_hedge_delay: float = float(os.getenv("LLM_HEDGE_DELAY", "0"))
+        
+        # Share one upstream call between identical concurrent requests
+        self.llm_coalesce_enabled: bool = os.getenv("LLM_COALESCE_ENABLED", "true").lower() in ("1", "true", "yes")
+        
+        # Per-provider request rate limit shared by all callers (0 = unlimited)
+        self.llm_rate_limit_rps: float = float(os.getenv("LLM_RATE_LIMIT_RPS", "0"))
+        self.llm_rate_limit_burst: float = float(os.getenv("LLM_RATE_LIMIT_BURST", "10"))
+        
+        # Batch Query Configuration
+        self.batch_max_items: int = int(os.getenv("BATCH_MAX_ITEMS", "1000"))
+        self.batch_max_concurrency: int = int(os.getenv("BATCH_MAX_CONCURRENCY", "8"))
+        self.batch_flush_size: int = int(os.getenv("BATCH_FLUSH_SIZE", "50"))
+        
+        # Response Cache Configuration
+        self.response_cache_enabled: bool = os.getenv("RESPONSE_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+        self.response_cache_max_entries: int = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1024"))
+        self.response_cache_ttl: float = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+        self.response_cache_db_path: str = os.getenv("RESPONSE_CACHE_DB_PATH", "")
+        # Cosine similarity for near-duplicate hits; 0 disables the semantic tier
+        self.response_cache_semantic_threshold: float = float(os.getenv("RESPONSE_CACHE_SEMANTIC_THRESHOLD", "0"))
+        self.response_cache_semantic_scope_size: int = int(os.getenv("RESPONSE_CACHE_SEMANTIC_SCOPE_SIZE", "64"))
+        
+        # Conversation History Windowing
+        # Default token budget for history, with optional per-model overrides ("model=budget,...")
+        self.history_token_budget: int = int(os.getenv("HISTORY_TOKEN_BUDGET", "2000"))
+        self.history_token_budgets: str = os.getenv("HISTORY_TOKEN_BUDGETS", "")
+        self.history_max_messages: int = int(os.getenv("HISTORY_MAX_MESSAGES", "50"))
+        self.history_summary_enabled: bool = os.getenv("HISTORY_SUMMARY_ENABLED", "false").lower() in ("1", "true", "yes")
+        # Minimum number of messages outside the window before the summary is refreshed
+        self.history_summary_min_messages: int = int(os.getenv("HISTORY_SUMMARY_MIN_MESSAGES", "6"))
+        
+        # Per-session Context Cache
+        self.context_cache_size: int = int(os.getenv("CONTEXT_CACHE_SIZE", "10000"))
+        # Seconds a cached context is trusted before re-reading it (picks up other workers' writes)
+        self.context_cache_ttl: float = float(os.getenv("CONTEXT_CACHE_TTL", "5"))
+        # Distinct contexts kept in memory by content hash
+        self.context_blob_cache_size: int = int(os.getenv("CONTEXT_BLOB_CACHE_SIZE", "1024"))
+        
+        # Startup
+        # Schema creation at boot: "auto" skips create_all when the recorded schema
+        # version is current, "always" runs it, "skip" leaves it to `python -m app.migrate`
+        self.db_schema_init: str = os.getenv("DB_SCHEMA_INIT", "auto").lower()
+        # Open connections to every LLM backend in the background before reporting ready
+        self.llm_warmup: bool = os.getenv("LLM_WARMUP", "false").lower() in ("1", "true", "yes")
+        # Log how long each import and startup step took
+        self.startup_profile: bool = os.getenv("STARTUP_PROFILE", "false").lower() in ("1", "true", "yes")
+        
+        # Preset Registry
+        # Seconds between checks for presets written by other workers (0 disables polling)
+        self.preset_poll_interval: float = float(os.getenv("PRESET_POLL_INTERVAL", "5"))
+        
+        # Context History Retention
+        self.context_history_size: int = int(os.getenv("CONTEXT_HISTORY_SIZE", "100"))
+        self.context_snapshot_interval: int = int(os.getenv("CONTEXT_SNAPSHOT_INTERVAL", "10"))
+        
         # Server Configuration
         self.host: str = os.getenv("HOST", "0.0.0.0")
         self.port: int = int(os.getenv("PORT", "8000"))
@@ -35,10 +115,93 @@ class Settings:
         # Database Configuration
         # Heroku provides DATABASE_URL automatically, fallback to SQLite for local dev
         self.database_url: str = os.getenv("DATABASE_URL") or os.getenv("HEROKU_DATABASE_URL") or "sqlite:///./smartadvisor.db"
+        self.db_pool_size: int = int(os.getenv("DB_POOL_SIZE", "10"))
+        self.db_max_overflow: int = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+        self.db_pool_timeout: float = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+        self.db_pool_recycle: int = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+        
+        # Audit Log Writer Configuration
+        self.audit_queue_size: int = int(os.getenv("AUDIT_QUEUE_SIZE", "10000"))
+        self.audit_batch_size: int = int(os.getenv("AUDIT_BATCH_SIZE", "200"))
+        self.audit_flush_interval: float = float(os.getenv("AUDIT_FLUSH_INTERVAL", "1.0"))
+        self.audit_enqueue_timeout: float = float(os.getenv("AUDIT_ENQUEUE_TIMEOUT", "0.05"))
+        
+        # Admission Control for /api/query and /api/query/stream
+        # Queries running at once per worker (0 disables the cap)
+        self.admission_max_concurrent: int = int(os.getenv("ADMISSION_MAX_CONCURRENT", "64"))
+        # Queries allowed to wait for a slot; beyond this they get 429
+        self.admission_max_queue: int = int(os.getenv("ADMISSION_MAX_QUEUE", "128"))
+        # Seconds a query waits for a slot before it gets 429
+        self.admission_queue_timeout: float = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "10"))
+        # Token buckets per user_id and per session_id (0 requests/second disables)
+        self.rate_limit_user_rps: float = float(os.getenv("RATE_LIMIT_USER_RPS", "0"))
+        self.rate_limit_user_burst: float = float(os.getenv("RATE_LIMIT_USER_BURST", "20"))
+        self.rate_limit_session_rps: float = float(os.getenv("RATE_LIMIT_SESSION_RPS", "0"))
+        self.rate_limit_session_burst: float = float(os.getenv("RATE_LIMIT_SESSION_BURST", "10"))
+        # "memory" (per worker) or "sqlite" (shared by the workers on one host)
+        self.rate_limit_store: str = os.getenv("RATE_LIMIT_STORE", "memory").lower()
+        self.rate_limit_sqlite_path: str = os.getenv("RATE_LIMIT_SQLITE_PATH", "rate_limits.db")
+        
+        # Maintenance (compaction and archival of old conversations)
+        # Seconds between background runs; 0 disables the loop (use `python -m app.maintenance` instead)
+        self.maintenance_interval: float = float(os.getenv("MAINTENANCE_INTERVAL", "0"))
+        # Sessions idle this many days keep only their newest messages; older ones are summarized and archived (0 disables)
+        self.maintenance_compact_after_days: float = float(os.getenv("MAINTENANCE_COMPACT_AFTER_DAYS", "30"))
+        self.maintenance_compact_keep_messages: int = int(os.getenv("MAINTENANCE_COMPACT_KEEP_MESSAGES", "20"))
+        self.maintenance_compact_batch_sessions: int = int(os.getenv("MAINTENANCE_COMPACT_BATCH_SESSIONS", "50"))
+        # conversation_logs rows older than this many days are archived and purged (0 disables)
+        self.maintenance_archive_after_days: float = float(os.getenv("MAINTENANCE_ARCHIVE_AFTER_DAYS", "90"))
+        # Rows per archive segment file
+        self.maintenance_batch_size: int = int(os.getenv("MAINTENANCE_BATCH_SIZE", "5000"))
+        self.archive_dir: str = os.getenv("ARCHIVE_DIR", "archive")
+        # gzip, or zstd when the zstandard package is installed
+        self.archive_compression: str = os.getenv("ARCHIVE_COMPRESSION", "gzip").lower()
+        
+        # Usage Analytics
+        # Seconds between incremental rollups of new audit rows; 0 disables the loop
+        self.analytics_rollup_interval: float = float(os.getenv("ANALYTICS_ROLLUP_INTERVAL", "60"))
+        # Audit rows aggregated per transaction
+        self.analytics_batch_size: int = int(os.getenv("ANALYTICS_BATCH_SIZE", "5000"))
+        # Rows younger than this are left for the next pass, so late commits are not skipped
+        self.analytics_settle_seconds: float = float(os.getenv("ANALYTICS_SETTLE_SECONDS", "10"))
+        
+        # Bulk Export
+        # Rows fetched from the server-side cursor and written out per batch
+        self.export_batch_size: int = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
+        
+        # Knowledge Retrieval
+        # Directory holding the memory-mapped index (share it between workers on one host)
+        self.knowledge_dir: str = os.getenv("KNOWLEDGE_DIR", "knowledge_index")
+        # Chunks injected into each prompt (0 disables retrieval)
+        self.knowledge_top_k: int = int(os.getenv("KNOWLEDGE_TOP_K", "4"))
+        self.knowledge_chunk_words: int = int(os.getenv("KNOWLEDGE_CHUNK_WORDS", "180"))
+        self.knowledge_chunk_overlap: int = int(os.getenv("KNOWLEDGE_CHUNK_OVERLAP", "30"))
+        # "none" (BM25 only) or "hashing" (adds hashed word/trigram vectors; needs numpy)
+        self.knowledge_embeddings: str = os.getenv("KNOWLEDGE_EMBEDDINGS", "none").lower()
+        self.knowledge_embedding_dims: int = int(os.getenv("KNOWLEDGE_EMBEDDING_DIMS", "512"))
+        # Seconds to wait after a document change so several uploads share one rebuild
+        self.knowledge_ingest_delay: float = float(os.getenv("KNOWLEDGE_INGEST_DELAY", "2"))
+        # Seconds between checks for an index rebuilt by another worker (0 disables polling)
+        self.knowledge_poll_interval: float = float(os.getenv("KNOWLEDGE_POLL_INTERVAL", "5"))
+        
+        # Metrics Configuration
+        self.metrics_loop_lag_interval: float = float(os.getenv("METRICS_LOOP_LAG_INTERVAL", "0.5"))
         
         # Logging Configuration
         self.log_level: str = os.getenv("LOG_LEVEL", "INFO")
         self.log_file: str = os.getenv("LOG_FILE", "logs/smartadvisor.log")
+        # "json" (one object per line) or "text"
+        self.log_format: str = os.getenv("LOG_FORMAT", "json").lower()
+        # "size" rotates at LOG_MAX_BYTES, "time" rotates on LOG_ROTATION_WHEN
+        self.log_rotation: str = os.getenv("LOG_ROTATION", "size").lower()
+        self.log_max_bytes: int = int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+        self.log_rotation_when: str = os.getenv("LOG_ROTATION_WHEN", "midnight")
+        self.log_backup_count: int = int(os.getenv("LOG_BACKUP_COUNT", "5"))
+        # Records waiting for the background writer; beyond this they are dropped
+        self.log_queue_size: int = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+        # Once the queue is this full, keep only LOG_SAMPLE_RATE of records below WARNING
+        self.log_sample_threshold: float = float(os.getenv("LOG_SAMPLE_THRESHOLD", "0.8"))
+        self.log_sample_rate: float = float(os.getenv("LOG_SAMPLE_RATE", "0.1"))
 
 
 settings = Settings()
@@ -0,0 +1,148 @@
+"""Content-addressed storage of context JSON shared by sessions and audit rows."""
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional
+import json
+
+from sqlalchemy import bindparam, null, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import settings
+from app.context_engine import context_hash
+from app.models import ContextBlob, ConversationLog, ConversationSession, SessionLocal
+
+
+class ContextBlobStore:
+    """
+    Store each distinct context once, keyed by its content hash.
+    
+    Sessions and audit rows keep only the hash (`context_hash`). Blobs are
+    immutable, so a bounded LRU of recently used ones can serve reads
+    without expiry; hashes in the LRU are also known to be persisted, which
+    makes writing an already-seen context free.
+    """
+    
+    def __init__(self, max_entries: Optional[int] = None):
+        self.max_entries = max_entries or settings.context_blob_cache_size
+        self._entries: "OrderedDict[str, Dict]" = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0, "blobs_written": 0}
+    
+    def _remember(self, digest: str, context: Dict) -> None:
+        self._entries[digest] = context
+        self._entries.move_to_end(digest)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+    
+    async def put(self, context: Optional[Dict]) -> Optional[str]:
+        """
+        Persist a context if it is new and return its hash (None for an empty context).
+        
+        New blobs are committed in their own short transaction, so a hash handed
+        out here always resolves, even if the caller's transaction rolls back.
+        Call it before the caller's transaction writes anything: SQLite allows
+        one writer at a time.
+        """
+        if not context:
+            return None
+        digest = context_hash(context)
+        if digest in self._entries:
+            self._entries.move_to_end(digest)
+            return digest
+        
+        # Copy so later changes to the caller's dict cannot alter the cached blob
+        context = json.loads(json.dumps(context, default=str))
+        async with SessionLocal() as db:
+            exists = await db.scalar(select(ContextBlob.hash).where(ContextBlob.hash == digest))
+            if exists is None:
+                db.add(ContextBlob(hash=digest, data=context, size=len(json.dumps(context))))
+                try:
+                    await db.commit()
+                    self.stats["blobs_written"] += 1
+                except IntegrityError:
+                    # Another worker stored the same context first
+                    await db.rollback()
+        self._remember(digest, context)
+        return digest
+    
+    async def get(self, db: AsyncSession, digest: Optional[str]) -> Dict:
+        """Load a context by hash; returns a copy the caller may modify."""
+        if not digest:
+            return {}
+        return dict((await self.get_many(db, [digest])).get(digest) or {})
+    
+    async def get_many(self, db: AsyncSession, digests: Iterable[Optional[str]]) -> Dict[str, Dict]:
+        """Load several contexts with at most one query. Returned dicts are shared; do not modify them."""
+        found = {}
+        missing = set()
+        for digest in digests:
+            if not digest or digest in found:
+                continue
+            cached = self._entries.get(digest)
+            if cached is None:
+                missing.add(digest)
+            else:
+                self._entries.move_to_end(digest)
+                found[digest] = cached
+        self.stats["hits"] += len(found)
+        self.stats["misses"] += len(missing)
+        
+        if missing:
+            result = await db.execute(select(ContextBlob).where(ContextBlob.hash.in_(missing)))
+            for blob in result.scalars().all():
+                self._remember(blob.hash, blob.data)
+                found[blob.hash] = blob.data
+        return found
+    
+    async def session_context(self, db: AsyncSession, session: Optional[ConversationSession]) -> Dict:
+        """The context of a session row, whether stored by hash or (not yet backfilled) inline."""
+        if session is None:
+            return {}
+        if session.context_hash:
+            return await self.get(db, session.context_hash)
+        return dict(session.context or {})
+    
+    async def assign(self, session: ConversationSession, context: Optional[Dict]) -> None:
+        """Point a session at a context; the caller commits the session."""
+        session.context_hash = await self.put(context)
+        session.context = null()
+    
+    def get_stats(self) -> Dict:
+        return {**self.stats, "cached": len(self._entries)}
+
+
+async def backfill_context_blobs(db: AsyncSession, store: ContextBlobStore, batch_size: int = 500) -> Dict[str, int]:
+    """
+    Move inline context JSON of existing rows into `context_blobs`.
+    
+    Rows are processed in id order, a batch per commit, so the backfill can be
+    interrupted and re-run.
+    
+    Returns:
+        Number of rows converted per table
+    """
+    converted = {}
+    for model, column in ((ConversationLog, "context_used"), (ConversationSession, "context")):
+        table = model.__table__
+        inline = table.c[column]
+        statement = (
+            table.update()
+            .where(table.c.id == bindparam("row_id"))
+            .values({"context_hash": bindparam("digest"), column: null()})
+        )
+        converted[table.name] = 0
+        last_id = 0
+        while True:
+            rows = (await db.execute(
+                select(table.c.id, inline)
+                .where(table.c.id > last_id, table.c.context_hash.is_(None), inline.isnot(None))
+                .order_by(table.c.id)
+                .limit(batch_size)
+            )).all()
+            if not rows:
+                break
+            params = [{"row_id": row_id, "digest": await store.put(context)} for row_id, context in rows]
+            await db.execute(statement, params)
+            await db.commit()
+            converted[table.name] += len(rows)
+            last_id = rows[-1][0]
+    return converted
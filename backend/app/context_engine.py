@@ -1,17 +1,44 @@
 """Dynamic Context Engine for merging user queries with business context."""
-from typing import Dict, Optional
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
 from datetime import datetime
+import hashlib
 import json
 
+from app.context_history import ContextHistory
+
+
+def context_hash(context: Dict) -> str:
+    """Stable content hash of a context dict, independent of key order."""
+    canonical = json.dumps(context, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def _render_key(context: Dict) -> str:
+    # Rendering follows key order, so unlike `context_hash` the key must too
+    serialized = json.dumps(context, separators=(",", ":"), ensure_ascii=False, default=str)
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
 
 class ContextEngine:
     """Engine that merges user queries with dynamic business context."""
     
-    def __init__(self, default_context: Optional[Dict] = None):
-        """Initialize the context engine with optional default context."""
-        self.current_context: Dict = default_context or {}
-        self.context_history: list = []
+    def __init__(self, default_context: Optional[Dict] = None, max_compiled_prompts: int = 256,
+                 history_size: int = 100, snapshot_interval: int = 10, knowledge=None):
+        """
+        Initialize the context engine with optional default context.
         
+        `knowledge` is a retriever (`KnowledgeBase`) whose `retrieve(query)` returns
+        the document chunks relevant to a query; only those go into the prompt.
+        """
+        self.current_context: Dict = default_context or {}
+        self.knowledge = knowledge
+        self.context_history = ContextHistory(max_records=history_size, snapshot_interval=snapshot_interval)
+        # Rendered prompt sections, keyed by context version or content hash
+        self._version = 0
+        self._compiled: "OrderedDict[tuple, str]" = OrderedDict()
+        self._max_compiled_prompts = max_compiled_prompts
+    
     def update_context(self, context: Dict, merge: bool = True) -> None:
         """
         Update the business context dynamically.
@@ -24,12 +51,10 @@ class ContextEngine:
             self.current_context.update(context)
         else:
             self.current_context = context
-            
+        self._version += 1
+        
         # Log context update
-        self.context_history.append({
-            "timestamp": datetime.utcnow().isoformat(),
-            "context": self.current_context.copy()
-        })
+        self.context_history.record(self.current_context)
     
     def get_context(self) -> Dict:
         """Get the current business context."""
@@ -38,51 +63,158 @@ class ContextEngine:
     def clear_context(self) -> None:
         """Clear all context."""
         self.current_context = {}
+        self._version += 1
+        self.context_history.record(self.current_context)
     
-    def build_prompt(self, user_query: str, context_override: Optional[Dict] = None) -> str:
+    def get_context_at(self, version: Optional[int] = None,
+                       timestamp: Optional[datetime] = None) -> Optional[Dict]:
         """
-        Build a structured prompt by merging user query with business context.
+        Reconstruct a past context from the bounded context history.
         
         Args:
-            user_query: The user's question/request
-            context_override: Optional context that temporarily overrides current context
-            
+            version: History version to reconstruct
+            timestamp: Reconstruct the context in effect at this time (UTC)
+        
         Returns:
-            Structured prompt string ready for LLM
+            The context, or None if it is older than the retained history
         """
-        # Use override context if provided, otherwise use current context
-        active_context = context_override if context_override else self.current_context
+        return self.context_history.context_at(version=version, timestamp=timestamp)
+    
+    def _compile(self, kind: str, context: Dict, render: Callable[[Dict], str],
+                 context_key: Optional[str] = None) -> str:
+        """
+        Render a prompt section once per context and reuse it.
         
-        # Build structured prompt
-        prompt_parts = []
+        The live context is keyed by its version, which `update_context` and
+        `clear_context` bump. A context the caller already has an address for
+        (a session's `context_hash`, whose blob always loads in the same key
+        order) is keyed by it, so large contexts are not serialized per call.
+        Any other context is keyed by a hash of its content in key order, as
+        sections render keys in order.
+        """
+        if context is self.current_context:
+            key = (kind, "version", self._version)
+        elif context_key:
+            key = (kind, "blob", context_key)
+        else:
+            key = (kind, _render_key(context))
+        
+        compiled = self._compiled.get(key)
+        if compiled is None:
+            compiled = render(context)
+            self._compiled[key] = compiled
+            if len(self._compiled) > self._max_compiled_prompts:
+                self._compiled.popitem(last=False)
+        else:
+            self._compiled.move_to_end(key)
+        return compiled
+    
+    @staticmethod
+    def _render_context_section(active_context: Dict) -> str:
+        """Render the business context section used by `build_prompt`."""
+        prompt_parts = ["## Business Context"]
+        
+        # Add role/persona if specified
+        if "role" in active_context:
+            prompt_parts.append(f"**Role:** {active_context['role']}")
+        
+        # Add mode/preset if specified
+        if "mode" in active_context:
+            prompt_parts.append(f"**Mode:** {active_context['mode']}")
+        
+        # Add instructions
+        if "instructions" in active_context:
+            instructions = active_context["instructions"]
+            if isinstance(instructions, list):
+                instructions = "\n".join(f"- {inst}" for inst in instructions)
+            prompt_parts.append(f"**Instructions:**\n{instructions}")
+        
+        # Add additional context fields
+        for key, value in active_context.items():
+            if key not in ["role", "mode", "instructions"]:
+                if isinstance(value, (dict, list)):
+                    value = json.dumps(value, indent=2)
+                prompt_parts.append(f"**{key.title()}:** {value}")
+        
+        prompt_parts.append("")  # Empty line
+        return "\n".join(prompt_parts)
+    
+    @staticmethod
+    def _render_system_message(active_context: Dict) -> str:
+        """Render the system message used by `build_chat_messages`."""
+        system_message_parts = []
         
-        # Business context section
         if active_context:
-            prompt_parts.append("## Business Context")
+            system_message_parts.append("You are SmartAdvisor, an internal business assistant.")
             
-            # Add role/persona if specified
             if "role" in active_context:
-                prompt_parts.append(f"**Role:** {active_context['role']}")
+                system_message_parts.append(f"You are operating in the role of: {active_context['role']}")
             
-            # Add mode/preset if specified
             if "mode" in active_context:
-                prompt_parts.append(f"**Mode:** {active_context['mode']}")
+                system_message_parts.append(f"You are in {active_context['mode']} mode.")
             
-            # Add instructions
             if "instructions" in active_context:
                 instructions = active_context["instructions"]
                 if isinstance(instructions, list):
-                    instructions = "\n".join(f"- {inst}" for inst in instructions)
-                prompt_parts.append(f"**Instructions:**\n{instructions}")
+                    instructions = "\n".join(inst for inst in instructions)
+                system_message_parts.append(f"Follow these instructions:\n{instructions}")
             
-            # Add additional context fields
+            # Add other context fields
             for key, value in active_context.items():
                 if key not in ["role", "mode", "instructions"]:
                     if isinstance(value, (dict, list)):
                         value = json.dumps(value, indent=2)
-                    prompt_parts.append(f"**{key.title()}:** {value}")
-            
-            prompt_parts.append("")  # Empty line
+                    system_message_parts.append(f"{key.title()}: {value}")
+        else:
+            system_message_parts.append("You are SmartAdvisor, an internal business assistant.")
+        
+        system_message_parts.append("\nImportant: Do not mention that you are an AI, model name, tokens, or any technical details. Respond as SmartAdvisor itself.")
+        return "\n".join(system_message_parts)
+    
+    def retrieve_knowledge(self, user_query: str) -> List[Dict]:
+        """Knowledge chunks relevant to a query, best first (empty without a retriever)."""
+        if self.knowledge is None or not self.knowledge.enabled:
+            return []
+        return self.knowledge.retrieve(user_query)
+    
+    async def retrieve_knowledge_async(self, user_query: str) -> List[Dict]:
+        """`retrieve_knowledge` without blocking the event loop on a hybrid lookup."""
+        if self.knowledge is None or not self.knowledge.enabled:
+            return []
+        return await self.knowledge.retrieve_async(user_query)
+    
+    @staticmethod
+    def _render_knowledge(chunks: List[Dict]) -> str:
+        parts = [f"[{number}] From {chunk['document']}:\n{chunk['text']}" for number, chunk in enumerate(chunks, 1)]
+        return "\n\n".join(parts)
+    
+    def build_prompt(self, user_query: str, context_override: Optional[Dict] = None) -> str:
+        """
+        Build a structured prompt by merging user query with business context.
+        
+        Args:
+            user_query: The user's question/request
+            context_override: Optional context that temporarily overrides current context
+        
+        Returns:
+            Structured prompt string ready for LLM
+        """
+        # Use override context if provided, otherwise use current context
+        active_context = context_override if context_override else self.current_context
+        
+        # Build structured prompt
+        prompt_parts = []
+        
+        # Business context section
+        if active_context:
+            prompt_parts.append(self._compile("prompt", active_context, self._render_context_section))
+        
+        # Knowledge section: only the chunks relevant to this query
+        chunks = self.retrieve_knowledge(user_query)
+        if chunks:
+            prompt_parts.append("## Relevant Knowledge")
+            prompt_parts.append(self._render_knowledge(chunks))
+            prompt_parts.append("")
         
         # User query section
         prompt_parts.append("## User Query")
@@ -97,8 +229,11 @@ class ContextEngine:
         
         return "\n".join(prompt_parts)
     
-    def build_chat_messages(self, user_query: str, context_override: Optional[Dict] = None, 
-                           conversation_history: Optional[list] = None) -> list:
+    def build_chat_messages(self, user_query: str, context_override: Optional[Dict] = None,
+                           conversation_history: Optional[list] = None,
+                           conversation_summary: Optional[str] = None,
+                           knowledge_chunks: Optional[List[Dict]] = None,
+                           context_key: Optional[str] = None) -> list:
         """
         Build chat messages for LLM API that supports conversation history.
         
@@ -106,47 +241,40 @@ class ContextEngine:
             user_query: The user's question/request
             context_override: Optional context that temporarily overrides current context
             conversation_history: Previous messages in the conversation
-            
+            conversation_summary: Optional summary of turns older than the history
+            knowledge_chunks: Chunks already retrieved for the query (retrieved here if None)
+            context_key: `context_hash` of `context_override` as loaded from the blob store, if it is one
+        
         Returns:
             List of message dictionaries formatted for LLM API
         """
         messages = []
         
-        # Add system message with context
+        # Add system message with context (rendered once per context, then reused)
         active_context = context_override if context_override else self.current_context
-        system_message_parts = []
-        
-        if active_context:
-            system_message_parts.append("You are SmartAdvisor, an internal business assistant.")
-            
-            if "role" in active_context:
-                system_message_parts.append(f"You are operating in the role of: {active_context['role']}")
-            
-            if "mode" in active_context:
-                system_message_parts.append(f"You are in {active_context['mode']} mode.")
-            
-            if "instructions" in active_context:
-                instructions = active_context["instructions"]
-                if isinstance(instructions, list):
-                    instructions = "\n".join(inst for inst in instructions)
-                system_message_parts.append(f"Follow these instructions:\n{instructions}")
-            
-            # Add other context fields
-            for key, value in active_context.items():
-                if key not in ["role", "mode", "instructions"]:
-                    if isinstance(value, (dict, list)):
-                        value = json.dumps(value, indent=2)
-                    system_message_parts.append(f"{key.title()}: {value}")
-        else:
-            system_message_parts.append("You are SmartAdvisor, an internal business assistant.")
-        
-        system_message_parts.append("\nImportant: Do not mention that you are an AI, model name, tokens, or any technical details. Respond as SmartAdvisor itself.")
-        
         messages.append({
             "role": "system",
-            "content": "\n".join(system_message_parts)
+            "content": self._compile(
+                "system", active_context, self._render_system_message,
+                context_key if context_override else None
+            )
         })
         
+        # Add the knowledge chunks relevant to this query, not the whole knowledge base
+        chunks = self.retrieve_knowledge(user_query) if knowledge_chunks is None else knowledge_chunks
+        if chunks:
+            messages.append({
+                "role": "system",
+                "content": "Relevant knowledge (use it where it answers the question):\n\n" + self._render_knowledge(chunks)
+            })
+        
+        # Add summary of earlier turns that no longer fit in the history window
+        if conversation_summary:
+            messages.append({
+                "role": "system",
+                "content": f"Summary of the earlier conversation:\n{conversation_summary}"
+            })
+        
         # Add conversation history if provided
         if conversation_history:
             messages.extend(conversation_history)
@@ -158,4 +286,3 @@ class ContextEngine:
         })
         
         return messages
-
@@ -0,0 +1,145 @@
+"""Bounded history of context versions, stored as snapshots plus diffs."""
+from collections import deque
+from datetime import datetime
+from typing import Dict, Iterator, Optional, Tuple
+
+
+class ContextRecord:
+    """One context version: either a full snapshot or a diff against the previous version."""
+    __slots__ = ("version", "timestamp", "snapshot", "changed", "removed")
+    
+    def __init__(self, version: int, timestamp: datetime, snapshot: Optional[Dict] = None,
+                 changed: Optional[Dict] = None, removed: Tuple[str, ...] = ()):
+        self.version = version
+        self.timestamp = timestamp
+        self.snapshot = snapshot
+        self.changed = changed
+        self.removed = removed
+    
+    @property
+    def is_snapshot(self) -> bool:
+        return self.snapshot is not None
+
+
+class ContextHistory:
+    """
+    Ring buffer of context versions.
+    
+    Every `snapshot_interval`-th version is stored in full; the others only
+    store the keys that changed or were removed. At most `max_records`
+    versions are kept, and the oldest retained version is always a snapshot
+    so every retained version can be reconstructed.
+    """
+    
+    def __init__(self, max_records: int = 100, snapshot_interval: int = 10):
+        self.max_records = max(1, max_records)
+        self.snapshot_interval = max(1, snapshot_interval)
+        self._records: "deque[ContextRecord]" = deque()
+        self._latest: Dict = {}
+        self._next_version = 1
+    
+    def __len__(self) -> int:
+        return len(self._records)
+    
+    def __iter__(self) -> Iterator[Dict]:
+        """Iterate over retained versions, oldest first, as full contexts."""
+        context: Dict = {}
+        for record in self._records:
+            context = self._apply(context, record)
+            yield {"version": record.version, "timestamp": record.timestamp.isoformat(), "context": dict(context)}
+    
+    @property
+    def latest_version(self) -> Optional[int]:
+        return self._records[-1].version if self._records else None
+    
+    @property
+    def oldest_version(self) -> Optional[int]:
+        return self._records[0].version if self._records else None
+    
+    @staticmethod
+    def _apply(context: Dict, record: ContextRecord) -> Dict:
+        if record.is_snapshot:
+            return dict(record.snapshot)
+        context = dict(context)
+        for key in record.removed:
+            context.pop(key, None)
+        context.update(record.changed)
+        return context
+    
+    def record(self, context: Dict, timestamp: Optional[datetime] = None) -> int:
+        """
+        Record a new context version.
+        
+        Args:
+            context: The full context after the change
+            timestamp: When the change happened (defaults to now, UTC)
+        
+        Returns:
+            The version number assigned to this context
+        """
+        version = self._next_version
+        self._next_version += 1
+        timestamp = timestamp or datetime.utcnow()
+        
+        if not self._records or version % self.snapshot_interval == 0:
+            entry = ContextRecord(version, timestamp, snapshot=dict(context))
+        else:
+            changed = {key: value for key, value in context.items()
+                       if key not in self._latest or self._latest[key] != value}
+            removed = tuple(key for key in self._latest if key not in context)
+            entry = ContextRecord(version, timestamp, changed=changed, removed=removed)
+        
+        if len(self._records) >= self.max_records:
+            self._evict_oldest()
+        self._records.append(entry)
+        self._latest = dict(context)
+        return version
+    
+    def _evict_oldest(self) -> None:
+        # The oldest record is always a snapshot, so its successor's diff applies to it
+        oldest = self._records.popleft()
+        if self._records and not self._records[0].is_snapshot:
+            # Promote the new oldest record to a snapshot so it stays reconstructable
+            successor = self._records[0]
+            successor.snapshot = self._apply(oldest.snapshot, successor)
+            successor.changed = None
+            successor.removed = ()
+    
+    def context_at(self, version: Optional[int] = None,
+                   timestamp: Optional[datetime] = None) -> Optional[Dict]:
+        """
+        Reconstruct the context as of a version or a point in time.
+        
+        Args:
+            version: Version number to reconstruct
+            timestamp: Reconstruct the latest version recorded at or before this time
+        
+        Returns:
+            The context, or None if that version is no longer (or not yet) retained
+        """
+        if not self._records:
+            return None
+        if version is None and timestamp is None:
+            return dict(self._latest)
+        
+        if version is not None:
+            # Versions are contiguous, so the record's position follows from the oldest one
+            target_index = version - self._records[0].version
+            if not 0 <= target_index < len(self._records):
+                return None
+        else:
+            target_index = None
+            for index in range(len(self._records) - 1, -1, -1):
+                if self._records[index].timestamp <= timestamp:
+                    target_index = index
+                    break
+            if target_index is None:
+                return None
+        
+        start = target_index
+        while not self._records[start].is_snapshot:
+            start -= 1
+        context: Dict = {}
+        for index in range(start, target_index + 1):
+            context = self._apply(context, self._records[index])
+        return context
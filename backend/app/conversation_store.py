@@ -0,0 +1,253 @@
+"""Append-only storage for conversation history."""
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import delete, func, null, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.models import ConversationMessage, ConversationSession
+from app.tokens import count_tokens
+
+
+def _to_dict(message: ConversationMessage) -> Dict:
+    return {"role": message.role, "content": message.content}
+
+
+async def load_recent_messages(db: AsyncSession, session_id: str, limit: int) -> List[Dict]:
+    """
+    Load the most recent messages of a session in chronological order.
+
+    Args:
+        db: Database session
+        session_id: Conversation session identifier
+        limit: Maximum number of messages to return
+
+    Returns:
+        List of message dictionaries with 'role' and 'content'
+    """
+    result = await db.execute(
+        select(ConversationMessage)
+        .where(ConversationMessage.session_id == session_id)
+        .order_by(ConversationMessage.seq.desc())
+        .limit(limit)
+    )
+    rows = result.scalars().all()
+    return [_to_dict(row) for row in reversed(rows)]
+
+
+async def load_history_window(db: AsyncSession, session_id: str, token_budget: int, max_messages: int,
+                              after_seq: Optional[int] = None, model: Optional[str] = None,
+                              page_size: int = 32) -> Tuple[List[Dict], Optional[int]]:
+    """
+    Load the most recent messages that fit in a token budget.
+
+    Messages are read newest first, a page at a time, and packed until the next
+    one would exceed the budget. Token counts are cached on the rows; rows
+    written before counts were stored get theirs filled in and saved with the
+    caller's next commit. Messages at or before `after_seq` (already folded
+    into the summary) are never included.
+
+    Returns:
+        Tuple of (messages in chronological order, seq of the oldest included
+        message or None if nothing fit)
+    """
+    window = []
+    used = 0
+    before_seq = None
+    while len(window) < max_messages:
+        query = select(ConversationMessage).where(ConversationMessage.session_id == session_id)
+        if before_seq is not None:
+            query = query.where(ConversationMessage.seq < before_seq)
+        if after_seq is not None:
+            query = query.where(ConversationMessage.seq > after_seq)
+        result = await db.execute(query.order_by(ConversationMessage.seq.desc()).limit(page_size))
+        rows = result.scalars().all()
+        if not rows:
+            break
+
+        for row in rows:
+            if row.token_count is None:
+                row.token_count = count_tokens(row.content, model)
+            if used + row.token_count > token_budget or len(window) >= max_messages:
+                return [_to_dict(message) for message in reversed(window)], (window[-1].seq if window else None)
+            used += row.token_count
+            window.append(row)
+        before_seq = rows[-1].seq
+
+    return [_to_dict(message) for message in reversed(window)], (window[-1].seq if window else None)
+
+
+async def load_history_windows(db: AsyncSession, token_budgets: Dict[str, int], max_messages: int,
+                               exclude_summarized: bool = False,
+                               model: Optional[str] = None) -> Dict[str, Tuple[List[Dict], List[int], Optional[int]]]:
+    """
+    Load the history windows of many sessions with a single query.
+
+    The newest `max_messages` messages of every session are ranked with a
+    window function and packed per session into its token budget, like
+    `load_history_window`. With `exclude_summarized`, messages at or before a
+    session's `summary_seq` are left out.
+
+    Returns:
+        Dictionary of session id to (messages in chronological order, their
+        token counts, seq of the oldest included message or None)
+    """
+    position = func.row_number().over(
+        partition_by=ConversationMessage.session_id, order_by=ConversationMessage.seq.desc()
+    ).label("position")
+    ranked = select(
+        ConversationMessage.session_id, ConversationMessage.seq, ConversationMessage.role,
+        ConversationMessage.content, ConversationMessage.token_count, position
+    ).where(ConversationMessage.session_id.in_(list(token_budgets)))
+    if exclude_summarized:
+        ranked = ranked.join(
+            ConversationSession, ConversationSession.session_id == ConversationMessage.session_id
+        ).where(ConversationMessage.seq > func.coalesce(ConversationSession.summary_seq, -1))
+    ranked = ranked.subquery()
+    result = await db.execute(
+        select(ranked).where(ranked.c.position <= max_messages)
+        .order_by(ranked.c.session_id, ranked.c.position)
+    )
+
+    windows = {session_id: ([], [], None) for session_id in token_budgets}
+    used: Dict[str, int] = {}
+    full = set()
+    for row in result:
+        if row.session_id in full:
+            continue
+        token_count = row.token_count if row.token_count is not None else count_tokens(row.content, model)
+        if used.get(row.session_id, 0) + token_count > token_budgets[row.session_id]:
+            full.add(row.session_id)
+            continue
+        used[row.session_id] = used.get(row.session_id, 0) + token_count
+        messages, counts, _ = windows[row.session_id]
+        messages.append({"role": row.role, "content": row.content})
+        counts.append(token_count)
+        windows[row.session_id] = (messages, counts, row.seq)
+    return {
+        session_id: (messages[::-1], counts[::-1], first_seq)
+        for session_id, (messages, counts, first_seq) in windows.items()
+    }
+
+
+async def load_messages_between(db: AsyncSession, session_id: str,
+                                after_seq: Optional[int], before_seq: int) -> List[Dict]:
+    """Load messages with `after_seq < seq < before_seq` in chronological order."""
+    query = select(ConversationMessage).where(
+        ConversationMessage.session_id == session_id,
+        ConversationMessage.seq < before_seq
+    )
+    if after_seq is not None:
+        query = query.where(ConversationMessage.seq > after_seq)
+    result = await db.execute(query.order_by(ConversationMessage.seq))
+    return [_to_dict(row) for row in result.scalars().all()]
+
+
+async def get_messages_page(db: AsyncSession, session_id: str, offset: int, limit: int) -> Tuple[List[Dict], int]:
+    """
+    Load one page of a session's history in chronological order.
+
+    Returns:
+        Tuple of (messages on the page, total number of messages in the session)
+    """
+    total = await db.scalar(
+        select(func.count()).select_from(ConversationMessage)
+        .where(ConversationMessage.session_id == session_id)
+    )
+    result = await db.execute(
+        select(ConversationMessage)
+        .where(ConversationMessage.session_id == session_id)
+        .order_by(ConversationMessage.seq)
+        .offset(offset)
+        .limit(limit)
+    )
+    return [_to_dict(row) for row in result.scalars().all()], total
+
+
+async def allocate_seqs(db: AsyncSession, session_id: str, count: int) -> int:
+    """
+    Reserve `count` consecutive message positions in a session.
+
+    The session's `next_seq` counter is advanced with a single UPDATE, which
+    holds the row (on SQLite, the database) write lock until the caller
+    commits, so concurrent turns of one session never get the same positions.
+    Sessions written before the counter existed start from their highest seq.
+
+    Returns:
+        The first reserved seq
+    """
+    last_seq = (
+        select(func.max(ConversationMessage.seq))
+        .where(ConversationMessage.session_id == session_id)
+        .scalar_subquery()
+    )
+    current = func.coalesce(ConversationSession.next_seq, func.coalesce(last_seq + 1, 0))
+    result = await db.execute(
+        update(ConversationSession)
+        .where(ConversationSession.session_id == session_id)
+        .values(next_seq=current + count)
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount == 0:
+        # No session row to lock (not written by the API): fall back to the highest seq
+        last = await db.scalar(select(last_seq))
+        return 0 if last is None else last + 1
+    next_seq = await db.scalar(
+        select(ConversationSession.next_seq).where(ConversationSession.session_id == session_id)
+    )
+    return next_seq - count
+
+
+async def append_messages(db: AsyncSession, session_id: str, messages: List[Dict],
+                          model: Optional[str] = None) -> None:
+    """
+    Append messages to a session's history without touching earlier rows.
+
+    The caller is responsible for committing.
+    """
+    first_seq = await allocate_seqs(db, session_id, len(messages))
+
+    for offset, message in enumerate(messages):
+        db.add(ConversationMessage(
+            session_id=session_id,
+            seq=first_seq + offset,
+            role=message["role"],
+            content=message["content"],
+            token_count=count_tokens(message["content"], model)
+        ))
+
+
+async def delete_messages(db: AsyncSession, session_id: str) -> None:
+    """Delete all stored messages of a session. The caller is responsible for committing."""
+    await db.execute(
+        delete(ConversationMessage).where(ConversationMessage.session_id == session_id)
+    )
+
+
+async def migrate_legacy_messages(db: AsyncSession, batch_size: int = 200) -> int:
+    """
+    Move history out of the legacy `ConversationSession.messages` JSON column.
+
+    Each session's blob is expanded into `conversation_messages` rows and the
+    column is set to NULL, so the migration is safe to re-run.
+
+    Returns:
+        Number of sessions migrated
+    """
+    migrated = 0
+    while True:
+        result = await db.execute(
+            select(ConversationSession)
+            .where(ConversationSession.messages.isnot(None))
+            .limit(batch_size)
+        )
+        sessions = result.scalars().all()
+        if not sessions:
+            break
+
+        for session in sessions:
+            if session.messages:
+                await append_messages(db, session.session_id, session.messages)
+            session.messages = null()
+            migrated += 1
+        await db.commit()
+
+    return migrated
@@ -0,0 +1,185 @@
+"""Streaming bulk export of conversation logs and sessions."""
+from datetime import datetime, timezone
+from typing import AsyncIterator, Dict, List, Optional
+import base64
+import binascii
+import csv
+import io
+import json
+import zlib
+
+from sqlalchemy import select
+
+from app.config import settings
+from app.context_blobs import ContextBlobStore
+from app.models import ConversationLog, ConversationSession, SessionLocal
+
+LOGS_TABLE = "conversation_logs"
+SESSIONS_TABLE = "conversation_sessions"
+FORMAT_NDJSON = "ndjson"
+FORMAT_CSV = "csv"
+
+# Exported columns per table; `context` is resolved from `context_hash` (or the legacy inline column)
+_COLUMNS = {
+    LOGS_TABLE: ["id", "timestamp", "session_id", "user_id", "user_query", "response", "context", "extra_metadata"],
+    SESSIONS_TABLE: ["id", "session_id", "user_id", "context", "summary", "created_at", "updated_at"]
+}
+
+
+class ExportCursorError(ValueError):
+    """A cursor token could not be decoded."""
+
+
+class ExportRequest:
+    """What to export: a table, its filters and the id to resume after."""
+    
+    def __init__(self, table: str = LOGS_TABLE, session_id: Optional[str] = None, user_id: Optional[str] = None,
+                 start: Optional[datetime] = None, end: Optional[datetime] = None, after_id: int = 0):
+        self.table = table
+        self.session_id = session_id
+        self.user_id = user_id
+        # Timestamps are stored as naive UTC
+        self.start = start.astimezone(timezone.utc).replace(tzinfo=None) if start and start.tzinfo else start
+        self.end = end.astimezone(timezone.utc).replace(tzinfo=None) if end and end.tzinfo else end
+        self.after_id = after_id
+    
+    def cursor(self, after_id: int) -> str:
+        """Opaque token that resumes this export after row `after_id`."""
+        state = {
+            "table": self.table,
+            "session_id": self.session_id,
+            "user_id": self.user_id,
+            "start": self.start.isoformat() if self.start else None,
+            "end": self.end.isoformat() if self.end else None,
+            "after_id": after_id
+        }
+        encoded = json.dumps(state, separators=(",", ":")).encode("utf-8")
+        return base64.urlsafe_b64encode(encoded).decode("ascii").rstrip("=")
+    
+    @classmethod
+    def from_cursor(cls, token: str) -> "ExportRequest":
+        try:
+            state = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+            return cls(
+                table=state["table"] if state["table"] in _COLUMNS else LOGS_TABLE,
+                session_id=state.get("session_id"),
+                user_id=state.get("user_id"),
+                start=datetime.fromisoformat(state["start"]) if state.get("start") else None,
+                end=datetime.fromisoformat(state["end"]) if state.get("end") else None,
+                after_id=int(state["after_id"])
+            )
+        except (binascii.Error, UnicodeDecodeError, ValueError, KeyError, TypeError) as e:
+            raise ExportCursorError("Invalid export cursor") from e
+    
+    def statement(self):
+        if self.table == SESSIONS_TABLE:
+            model, time_column = ConversationSession, ConversationSession.created_at
+            columns = [
+                model.id, model.session_id, model.user_id, model.context, model.context_hash,
+                model.summary, model.created_at, model.updated_at
+            ]
+        else:
+            model, time_column = ConversationLog, ConversationLog.timestamp
+            columns = [
+                model.id, model.timestamp, model.session_id, model.user_id, model.user_query,
+                model.response, model.context_used.label("context"), model.context_hash, model.extra_metadata
+            ]
+        # Core columns rather than ORM entities: rows are never added to an identity map
+        statement = select(*columns).where(model.id > self.after_id)
+        if self.session_id:
+            statement = statement.where(model.session_id == self.session_id)
+        if self.user_id:
+            statement = statement.where(model.user_id == self.user_id)
+        if self.start:
+            statement = statement.where(time_column >= self.start)
+        if self.end:
+            statement = statement.where(time_column < self.end)
+        return statement.order_by(model.id)
+
+
+def _record(row, contexts: Dict[str, Dict], columns: List[str]) -> Dict:
+    values = row._mapping
+    record = {}
+    for column in columns:
+        if column == "context":
+            value = contexts.get(values["context_hash"]) if values["context_hash"] else values["context"]
+        else:
+            value = values[column]
+        record[column] = value.isoformat() if isinstance(value, datetime) else value
+    return record
+
+
+def _csv_lines(records: List[Dict], columns: List[str], header: bool) -> str:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if header:
+        writer.writerow(columns)
+    for record in records:
+        writer.writerow([
+            json.dumps(value, default=str) if isinstance(value, (dict, list)) else value
+            for value in (record[column] for column in columns)
+        ])
+    return buffer.getvalue()
+
+
+async def stream_export(request: ExportRequest, context_blobs: ContextBlobStore, output_format: str = FORMAT_NDJSON,
+                        compress: bool = False, max_rows: Optional[int] = None) -> AsyncIterator[bytes]:
+    """
+    Stream a table as NDJSON or CSV, optionally gzip-compressed.
+    
+    Rows are read through a server-side cursor `export_batch_size` at a time
+    and written out batch by batch, so memory use does not depend on table
+    size. NDJSON ends with a trailer line
+    `{"_export": {"rows", "complete", "next_cursor"}}`; passing `next_cursor`
+    back resumes after the last row sent, or picks up rows added since a
+    complete export. CSV has no trailer: resume with `after_id` set to the
+    last exported `id`.
+    """
+    columns = _COLUMNS[request.table]
+    batch_size = settings.export_batch_size
+    # wbits=31 writes a gzip container; flushed after every batch so clients see progress
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    last_id = request.after_id
+    sent = 0
+    complete = True
+    
+    def encode(text: str) -> bytes:
+        data = text.encode("utf-8")
+        if compressor is None:
+            return data
+        return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    
+    statement = request.statement()
+    if max_rows:
+        # One extra row tells whether the export stopped early
+        statement = statement.limit(max_rows + 1)
+    
+    async with SessionLocal() as db:
+        result = await db.stream(statement.execution_options(yield_per=batch_size))
+        async for rows in result.partitions(batch_size):
+            if max_rows and sent + len(rows) > max_rows:
+                rows = rows[:max_rows - sent]
+                complete = False
+            if not rows:
+                break
+            contexts = await context_blobs.get_many(db, [row.context_hash for row in rows])
+            records = [_record(row, contexts, columns) for row in rows]
+            if output_format == FORMAT_CSV:
+                chunk = _csv_lines(records, columns, header=(sent == 0))
+            else:
+                chunk = "".join(json.dumps(record, default=str) + "\n" for record in records)
+            sent += len(rows)
+            last_id = records[-1]["id"]
+            yield encode(chunk)
+            if not complete:
+                break
+        await result.close()
+    
+    if output_format == FORMAT_CSV:
+        if sent == 0:
+            yield encode(_csv_lines([], columns, header=True))
+    else:
+        trailer = {"rows": sent, "complete": complete, "next_cursor": request.cursor(last_id)}
+        yield encode(json.dumps({"_export": trailer}) + "\n")
+    if compressor is not None:
+        yield compressor.flush()
@@ -0,0 +1,135 @@
+"""Token-budgeted conversation history with an optional rolling summary."""
+from typing import Dict, List, Optional, Set, Tuple
+import asyncio
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import settings
+from app.conversation_store import load_history_window, load_history_windows, load_messages_between
+from app.logger import logger
+from app.models import ConversationSession, SessionLocal
+from app.tokens import count_tokens, history_token_budget
+
+
+SUMMARY_INSTRUCTIONS = (
+    "Summarize the conversation below for your own later reference. Keep facts, "
+    "decisions, names, numbers and open questions; drop pleasantries. Reply with "
+    "the summary only."
+)
+
+# Sessions with a summary refresh in flight, and the tasks doing it
+_summarizing: Set[str] = set()
+_summary_tasks: Set[asyncio.Task] = set()
+
+
+async def select_history(db: AsyncSession, session: ConversationSession,
+                         model: str) -> Tuple[List[Dict], Optional[str], Optional[int]]:
+    """
+    Pick the conversation history to send with the next query.
+
+    Returns:
+        Tuple of (recent messages that fit the model's history budget, stored
+        rolling summary to include or None, seq of the oldest message in the window)
+    """
+    budget = history_token_budget(model)
+    summary = session.summary if settings.history_summary_enabled else None
+    if summary:
+        budget -= count_tokens(summary, model)
+
+    # Turns already folded into the summary are not sent again
+    summarized_through = session.summary_seq if summary else None
+    history, first_seq = await load_history_window(
+        db, session.session_id, max(budget, 0), settings.history_max_messages,
+        after_seq=summarized_through, model=model
+    )
+    return history, summary, first_seq
+
+
+async def select_histories(db: AsyncSession, sessions: List[ConversationSession],
+                           model: str) -> Dict[str, Tuple[List[Dict], List[int], Optional[str], Optional[int]]]:
+    """
+    Pick the history of many sessions at once, with one query, like `select_history`.
+
+    Returns:
+        Dictionary of session id to (recent messages, their token counts,
+        stored rolling summary or None, seq of the oldest message in the window)
+    """
+    summaries = {}
+    budgets = {}
+    for session in sessions:
+        summary = session.summary if settings.history_summary_enabled else None
+        budget = history_token_budget(model) - (count_tokens(summary, model) if summary else 0)
+        summaries[session.session_id] = summary
+        budgets[session.session_id] = max(budget, 0)
+
+    windows = await load_history_windows(
+        db, budgets, settings.history_max_messages,
+        exclude_summarized=settings.history_summary_enabled, model=model
+    )
+    return {
+        session_id: (history, counts, summaries[session_id], first_seq)
+        for session_id, (history, counts, first_seq) in windows.items()
+    }
+
+
+def schedule_summary_refresh(session: ConversationSession, first_seq: Optional[int], llm_service) -> None:
+    """
+    Fold turns that fell out of the history window into the session summary.
+
+    Runs in the background once enough unsummarized messages have dropped out,
+    so it never adds latency to the query that triggered it.
+    """
+    if not settings.history_summary_enabled or first_seq is None:
+        return
+    summarized_through = session.summary_seq if session.summary_seq is not None else -1
+    if first_seq - summarized_through - 1 < settings.history_summary_min_messages:
+        return
+    if session.session_id in _summarizing:
+        return
+
+    _summarizing.add(session.session_id)
+    task = asyncio.create_task(_refresh_summary(session.session_id, first_seq, llm_service))
+    _summary_tasks.add(task)
+    task.add_done_callback(_summary_tasks.discard)
+
+
+async def summarize_messages(llm_service, summary: Optional[str], messages: List[Dict]) -> str:
+    """Fold messages into an existing summary (or start one) with the LLM."""
+    transcript = "\n".join(f"{message['role']}: {message['content']}" for message in messages)
+    if summary:
+        transcript = f"Summary so far:\n{summary}\n\nLater messages:\n{transcript}"
+
+    return await llm_service.generate_response(
+        [
+            {"role": "system", "content": SUMMARY_INSTRUCTIONS},
+            {"role": "user", "content": transcript}
+        ],
+        temperature=0.2,
+        use_cache=False
+    )
+
+
+async def _refresh_summary(session_id: str, before_seq: int, llm_service) -> None:
+    try:
+        async with SessionLocal() as db:
+            result = await db.execute(
+                select(ConversationSession).where(ConversationSession.session_id == session_id)
+            )
+            session = result.scalars().first()
+            if session is None:
+                return
+
+            dropped = await load_messages_between(db, session_id, session.summary_seq, before_seq)
+            if not dropped:
+                return
+
+            session.summary = await summarize_messages(llm_service, session.summary, dropped)
+            session.summary_seq = before_seq - 1
+            await db.commit()
+            logger.info("Updated rolling summary for session: %s", session_id)
+    except Exception as e:
+        logger.error("Error updating summary for session %s: %s", session_id, e)
+    finally:
+        _summarizing.discard(session_id)
+
@@ -0,0 +1,619 @@
+"""
+Local knowledge base: documents are chunked, indexed on disk and retrieved per query.
+
+An index generation is a directory of flat binary files that are memory-mapped
+when opened, so workers share the page cache and opening one does not read it:
+
+- `chunks.bin` / `chunk_offsets.bin`: UTF-8 chunk texts and their offsets
+- `chunk_lengths.bin` / `chunk_docs.bin`: terms per chunk and owning document
+- `postings_ids.bin` / `postings_tfs.bin`: per-term runs of chunk ids and term
+  frequencies, located through `vocab.json`
+- `vectors.npy`: optional float32 chunk vectors (needs numpy)
+- `meta.json`: documents, counts and average chunk length, written last
+
+`CURRENT` names the live generation. Builds write a new generation and swap
+`CURRENT` atomically; readers pick it up on their next poll.
+"""
+from array import array
+from collections import Counter
+from datetime import datetime
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+import asyncio
+import hashlib
+import heapq
+import json
+import math
+import mmap
+import os
+import re
+import shutil
+import sys
+import time
+import uuid
+import zlib
+
+from sqlalchemy import delete, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import settings
+from app.logger import logger
+from app.metrics import knowledge_retrieval_seconds
+from app.models import CacheVersion, KnowledgeDocument, SessionLocal
+
+try:
+    import numpy
+except ImportError:  # Optional: without it retrieval is BM25 only
+    numpy = None
+
+
+INDEX_FORMAT = 1
+CURRENT_FILE = "CURRENT"
+# Seconds after which a leftover `.partial` generation is treated as abandoned
+PARTIAL_MAX_AGE = 3600
+# Row in `cache_versions` bumped whenever a document is written or deleted
+KNOWLEDGE_VERSION_KEY = "knowledge"
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Reciprocal rank fusion constant for combining BM25 and vector rankings
+RRF_K = 60
+
+_WORD = re.compile(r"\w+", re.UNICODE)
+_PARAGRAPH = re.compile(r"\n\s*\n")
+_STOPWORDS = frozenset(
+    "a an and are as at be but by can do does for from has have how i if in into is it its "
+    "me my no not of on or our so than that the their them then there these they this to "
+    "us was we were what when where which who why will with you your".split()
+)
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercased word terms, without stopwords."""
+    return [term for term in _WORD.findall(text.lower()) if term not in _STOPWORDS]
+
+
+def chunk_document(text: str, chunk_words: int, overlap: int) -> List[str]:
+    """
+    Split a document into chunks of about `chunk_words` words.
+    
+    Paragraphs are packed together until a chunk is full; each chunk repeats
+    the last `overlap` words of the previous one so a passage cut at a chunk
+    boundary is still found whole in one of them.
+    """
+    overlap = min(overlap, chunk_words // 2)
+    chunks = []
+    current: List[str] = []
+    for paragraph in _PARAGRAPH.split(text):
+        words = paragraph.split()
+        while words:
+            room = chunk_words - len(current)
+            current.extend(words[:room])
+            words = words[room:]
+            if len(current) >= chunk_words:
+                chunks.append(" ".join(current))
+                current = current[-overlap:] if overlap else []
+    if current and (not chunks or len(current) > overlap):
+        chunks.append(" ".join(current))
+    return chunks
+
+
+@lru_cache(maxsize=65536)
+def _term_features(term: str, dims: int) -> Tuple[Tuple[int, ...], Tuple[float, ...]]:
+    """Vector positions and signed weights of a term and its character trigrams."""
+    padded = f"#{term}#"
+    positions = []
+    weights = []
+    for feature, weight in [(term, 1.0)] + [(padded[i:i + 3], 0.5) for i in range(len(padded) - 2)]:
+        digest = zlib.crc32(feature.encode("utf-8"))
+        positions.append(digest % dims)
+        weights.append(weight if digest & 0x80000000 else -weight)
+    return tuple(positions), tuple(weights)
+
+
+def embed(text: str, dims: int):
+    """
+    Hashed bag of words and character trigrams, L2-normalized.
+    
+    No model is needed, and trigrams let misspellings and word forms that
+    BM25 treats as different terms still match. Uses crc32, which unlike
+    `hash()` is the same in every process.
+    """
+    positions = []
+    weights = []
+    for term in tokenize(text):
+        term_positions, term_weights = _term_features(term, dims)
+        positions.extend(term_positions)
+        weights.extend(term_weights)
+    vector = numpy.zeros(dims, dtype=numpy.float32)
+    if positions:
+        vector += numpy.bincount(positions, weights, minlength=dims)
+    norm = float(numpy.linalg.norm(vector))
+    if norm:
+        vector /= norm
+    return vector
+
+
+def _write_array(path: Path, values: array) -> None:
+    with open(path, "wb") as f:
+        values.tofile(f)
+
+
+def build_index(directory: str, version: int, documents: Iterable[Tuple[int, str, str]],
+                chunk_words: int, chunk_overlap: int, embedding_dims: int = 0) -> str:
+    """
+    Write a new index generation for `documents` (id, name, content) and return its name.
+    
+    Blocking; run it on a worker thread. The generation is written under a
+    temporary name and renamed into place once complete.
+    """
+    root = Path(directory)
+    root.mkdir(parents=True, exist_ok=True)
+    name = f"v{version:08d}-{uuid.uuid4().hex[:8]}"
+    partial = root / f"{name}.partial"
+    partial.mkdir()
+    
+    offsets = array("Q", [0])
+    lengths = array("I")
+    chunk_docs = array("I")
+    postings: Dict[str, List[Tuple[int, int]]] = {}
+    document_meta = []
+    vectors = []
+    with open(partial / "chunks.bin", "wb") as chunks_file:
+        for doc_index, (doc_id, doc_name, content) in enumerate(documents):
+            chunks = chunk_document(content, chunk_words, chunk_overlap)
+            document_meta.append({"id": doc_id, "name": doc_name, "chunks": len(chunks)})
+            for chunk in chunks:
+                chunk_id = len(lengths)
+                terms = tokenize(chunk)
+                for term, tf in Counter(terms).items():
+                    postings.setdefault(term, []).append((chunk_id, tf))
+                encoded = chunk.encode("utf-8")
+                chunks_file.write(encoded)
+                offsets.append(offsets[-1] + len(encoded))
+                lengths.append(len(terms))
+                chunk_docs.append(doc_index)
+                if embedding_dims:
+                    vectors.append(embed(chunk, embedding_dims))
+    
+    vocab = {}
+    ids = array("I")
+    tfs = array("I")
+    for term in sorted(postings):
+        entries = postings[term]
+        vocab[term] = [len(ids), len(entries)]
+        ids.extend(chunk_id for chunk_id, _ in entries)
+        tfs.extend(tf for _, tf in entries)
+    
+    _write_array(partial / "chunk_offsets.bin", offsets)
+    _write_array(partial / "chunk_lengths.bin", lengths)
+    _write_array(partial / "chunk_docs.bin", chunk_docs)
+    _write_array(partial / "postings_ids.bin", ids)
+    _write_array(partial / "postings_tfs.bin", tfs)
+    with open(partial / "vocab.json", "w", encoding="utf-8") as f:
+        json.dump(vocab, f, ensure_ascii=False, separators=(",", ":"))
+    if vectors:
+        numpy.save(partial / "vectors.npy", numpy.vstack(vectors))
+    
+    meta = {
+        "format": INDEX_FORMAT,
+        "version": version,
+        "created_at": datetime.utcnow().isoformat(),
+        "byteorder": sys.byteorder,
+        "documents": document_meta,
+        "chunks": len(lengths),
+        "terms": len(vocab),
+        "avg_length": (sum(lengths) / len(lengths)) if lengths else 0.0,
+        "embedding_dims": embedding_dims if vectors else 0
+    }
+    with open(partial / "meta.json", "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    os.replace(partial, root / name)
+    return name
+
+
+def read_current(directory: str) -> Optional[Dict]:
+    """The live generation's name and version, or None before the first build."""
+    try:
+        with open(Path(directory) / CURRENT_FILE, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def publish(directory: str, generation: str, version: int) -> bool:
+    """
+    Make a generation live unless a newer one already is, then delete older generations.
+    
+    The previous generation is kept, since other workers may still be reading it.
+    """
+    root = Path(directory)
+    current = read_current(directory)
+    if current and current["version"] > version:
+        shutil.rmtree(root / generation, ignore_errors=True)
+        return False
+    
+    temporary = root / f"{CURRENT_FILE}.{uuid.uuid4().hex[:8]}.tmp"
+    with open(temporary, "w", encoding="utf-8") as f:
+        json.dump({"generation": generation, "version": version}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, root / CURRENT_FILE)
+    
+    keep = {generation, current["generation"] if current else None}
+    for path in root.iterdir():
+        if not path.is_dir() or path.name in keep:
+            continue
+        # Another worker may be writing a partial generation; only remove abandoned ones
+        if path.suffix == ".partial" and time.time() - path.stat().st_mtime < PARTIAL_MAX_AGE:
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+    return True
+
+
+class KnowledgeIndex:
+    """A read-only, memory-mapped index generation."""
+    
+    def __init__(self, path: Path):
+        self.path = path
+        with open(path / "meta.json", encoding="utf-8") as f:
+            self.meta = json.load(f)
+        if self.meta["format"] != INDEX_FORMAT or self.meta["byteorder"] != sys.byteorder:
+            raise ValueError(f"Index {path.name} was written in an incompatible format")
+        with open(path / "vocab.json", encoding="utf-8") as f:
+            self.vocab: Dict[str, List[int]] = json.load(f)
+        
+        self._maps: List[mmap.mmap] = []
+        self.chunks = self._map("chunks.bin")
+        self.offsets = self._map("chunk_offsets.bin", "Q")
+        self.lengths = self._map("chunk_lengths.bin", "I")
+        self.chunk_docs = self._map("chunk_docs.bin", "I")
+        self.posting_ids = self._map("postings_ids.bin", "I")
+        self.posting_tfs = self._map("postings_tfs.bin", "I")
+        self.vectors = None
+        if self.meta["embedding_dims"] and numpy is not None:
+            self.vectors = numpy.load(path / "vectors.npy", mmap_mode="r")
+        
+        self.documents = [document["name"] for document in self.meta["documents"]]
+        self.chunk_count = self.meta["chunks"]
+        self.avg_length = self.meta["avg_length"] or 1.0
+    
+    def _map(self, filename: str, typecode: Optional[str] = None):
+        with open(self.path / filename, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                # mmap cannot map an empty file
+                return memoryview(array(typecode or "B")) if typecode else b""
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps.append(mapped)
+        return memoryview(mapped).cast(typecode) if typecode else mapped
+    
+    @property
+    def generation(self) -> str:
+        return self.path.name
+    
+    @property
+    def version(self) -> int:
+        return self.meta["version"]
+    
+    def chunk_text(self, chunk_id: int) -> str:
+        return self.chunks[self.offsets[chunk_id]:self.offsets[chunk_id + 1]].decode("utf-8")
+    
+    def _postings(self, term: str):
+        start, count = self.vocab[term]
+        if numpy is not None:
+            # Views over the mapped files: a run is scored without copying it
+            ids = numpy.frombuffer(self.posting_ids, dtype=numpy.uint32, count=count, offset=start * 4)
+            tfs = numpy.frombuffer(self.posting_tfs, dtype=numpy.uint32, count=count, offset=start * 4)
+            return ids, tfs
+        return self.posting_ids[start:start + count], self.posting_tfs[start:start + count]
+    
+    def search_bm25(self, terms: List[str], k: int) -> List[Tuple[int, float]]:
+        """Top `k` chunks by BM25 score, best first."""
+        terms = [term for term in set(terms) if term in self.vocab]
+        if not terms:
+            return []
+        n = self.chunk_count
+        norm = BM25_K1 / self.avg_length
+        
+        if numpy is not None:
+            lengths = numpy.frombuffer(self.lengths, dtype=numpy.uint32)
+            scores = numpy.zeros(n, dtype=numpy.float32)
+            for term in terms:
+                ids, tfs = self._postings(term)
+                df = len(ids)
+                idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+                tf = tfs.astype(numpy.float32)
+                denominator = tf + BM25_K1 * (1 - BM25_B) + norm * BM25_B * lengths[ids]
+                scores[ids] += idf * tf * (BM25_K1 + 1) / denominator
+            k = min(k, int(numpy.count_nonzero(scores)))
+            if k <= 0:
+                return []
+            top = numpy.argpartition(-scores, k - 1)[:k]
+            return sorted(((int(i), float(scores[i])) for i in top), key=lambda item: item[1], reverse=True)
+        
+        scores: Dict[int, float] = {}
+        lengths = self.lengths
+        for term in terms:
+            ids, tfs = self._postings(term)
+            df = len(ids)
+            idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+            for chunk_id, tf in zip(ids, tfs):
+                denominator = tf + BM25_K1 * (1 - BM25_B) + norm * BM25_B * lengths[chunk_id]
+                scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * tf * (BM25_K1 + 1) / denominator
+        return heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+    
+    def search_vectors(self, text: str, k: int) -> List[Tuple[int, float]]:
+        """Top `k` chunks by cosine similarity of hashed vectors, best first."""
+        if self.vectors is None or not self.chunk_count:
+            return []
+        similarities = self.vectors @ embed(text, self.vectors.shape[1])
+        k = min(k, self.chunk_count)
+        top = numpy.argpartition(-similarities, k - 1)[:k]
+        ranked = sorted(((int(i), float(similarities[i])) for i in top), key=lambda item: item[1], reverse=True)
+        return [(chunk_id, score) for chunk_id, score in ranked if score > 0]
+    
+    def search(self, query: str, k: int) -> List[Tuple[int, float]]:
+        """
+        Top `k` chunks for a query.
+        
+        With vectors, BM25 and vector rankings (each `k * 4` deep) are merged
+        by reciprocal rank fusion; otherwise this is plain BM25.
+        """
+        lexical = self.search_bm25(tokenize(query), k if self.vectors is None else k * 4)
+        if self.vectors is None:
+            return lexical
+        fused: Dict[int, float] = {}
+        for ranking in (lexical, self.search_vectors(query, k * 4)):
+            for rank, (chunk_id, _) in enumerate(ranking):
+                fused[chunk_id] = fused.get(chunk_id, 0.0) + 1.0 / (RRF_K + rank + 1)
+        return heapq.nlargest(k, fused.items(), key=lambda item: item[1])
+    
+    def close(self) -> None:
+        """Unmap the files; only call once no search can still be using this index."""
+        for name in ("offsets", "lengths", "chunk_docs", "posting_ids", "posting_tfs"):
+            view = getattr(self, name)
+            if isinstance(view, memoryview):
+                view.release()
+        self.vectors = None
+        for mapped in self._maps:
+            mapped.close()
+        self._maps = []
+
+
+class KnowledgeBase:
+    """
+    Documents in the database, retrieved from a memory-mapped index on disk.
+    
+    Writes go to `knowledge_documents` and bump the `knowledge` row of
+    `cache_versions` in the same transaction, then schedule a rebuild. The
+    rebuild waits `ingest_delay` seconds so a burst of uploads shares one
+    build, and runs on a worker thread; queries keep using the previous
+    generation until the new one is published. Other workers poll the
+    `CURRENT` pointer and switch when it changes.
+    """
+    
+    def __init__(self, directory: Optional[str] = None, top_k: Optional[int] = None):
+        self.directory = directory or settings.knowledge_dir
+        self.top_k = settings.knowledge_top_k if top_k is None else top_k
+        self.chunk_words = settings.knowledge_chunk_words
+        self.chunk_overlap = settings.knowledge_chunk_overlap
+        self.embedding_dims = 0
+        if settings.knowledge_embeddings == "hashing":
+            if numpy is None:
+                logger.warning("KNOWLEDGE_EMBEDDINGS=hashing needs numpy; using BM25 only")
+            else:
+                self.embedding_dims = settings.knowledge_embedding_dims
+        self.index: Optional[KnowledgeIndex] = None
+        self._rebuild_requested = asyncio.Event()
+        self._build_lock = asyncio.Lock()
+        self._tasks: List[asyncio.Task] = []
+        self.stats = {"retrievals": 0, "chunks_returned": 0, "builds": 0, "failed_builds": 0, "reloads": 0}
+        self.last_build_seconds = 0.0
+    
+    @property
+    def enabled(self) -> bool:
+        return self.top_k > 0
+    
+    def retrieve(self, query: str, k: Optional[int] = None) -> List[Dict]:
+        """
+        The chunks most relevant to a query, best first.
+        
+        A BM25 lookup touches only the postings of the query's terms; a hybrid
+        lookup also scores every chunk vector, so its cost grows with the
+        corpus. Request handlers use `retrieve_async`.
+        """
+        index = self.index
+        k = self.top_k if k is None else k
+        if index is None or k <= 0 or not index.chunk_count:
+            return []
+        started = time.perf_counter()
+        results = [
+            {
+                "document": index.documents[index.chunk_docs[chunk_id]],
+                "chunk": chunk_id,
+                "text": index.chunk_text(chunk_id),
+                "score": round(score, 6)
+            }
+            for chunk_id, score in index.search(query, k)
+        ]
+        knowledge_retrieval_seconds.observe(time.perf_counter() - started)
+        self.stats["retrievals"] += 1
+        self.stats["chunks_returned"] += len(results)
+        return results
+    
+    async def retrieve_async(self, query: str, k: Optional[int] = None) -> List[Dict]:
+        """`retrieve` for the event loop: hybrid lookups run on a worker thread."""
+        index = self.index
+        if index is not None and index.vectors is not None:
+            return await asyncio.to_thread(self.retrieve, query, k)
+        return self.retrieve(query, k)
+    
+    def _open(self, current: Optional[Dict]) -> Optional[KnowledgeIndex]:
+        if not current:
+            return None
+        if self.index is not None and self.index.generation == current["generation"]:
+            return self.index
+        return KnowledgeIndex(Path(self.directory) / current["generation"])
+    
+    async def reload(self) -> bool:
+        """Switch to the live generation if it changed; returns True when switched."""
+        current = await asyncio.to_thread(read_current, self.directory)
+        index = await asyncio.to_thread(self._open, current)
+        if index is self.index:
+            return False
+        # The old generation is unmapped once no retrieval holds it any more
+        self.index = index
+        self.stats["reloads"] += 1
+        logger.info("Loaded knowledge index %s (%s chunks)", index.generation, index.chunk_count)
+        return True
+    
+    @staticmethod
+    async def _read_version(db: AsyncSession) -> int:
+        version = await db.scalar(
+            select(CacheVersion.version).where(CacheVersion.name == KNOWLEDGE_VERSION_KEY)
+        )
+        return version or 0
+    
+    async def _bump(self, db: AsyncSession) -> None:
+        result = await db.execute(
+            update(CacheVersion)
+            .where(CacheVersion.name == KNOWLEDGE_VERSION_KEY)
+            .values(version=CacheVersion.version + 1, updated_at=datetime.utcnow())
+        )
+        if result.rowcount == 0:
+            db.add(CacheVersion(name=KNOWLEDGE_VERSION_KEY, version=1))
+    
+    async def rebuild(self) -> Optional[str]:
+        """Build and publish a generation from the documents in the database."""
+        async with self._build_lock:
+            started = time.perf_counter()
+            async with SessionLocal() as db:
+                # Read the version first: a write landing in between only causes an extra build
+                version = await self._read_version(db)
+                result = await db.execute(
+                    select(KnowledgeDocument.id, KnowledgeDocument.name, KnowledgeDocument.content)
+                    .order_by(KnowledgeDocument.id)
+                )
+                documents = [tuple(row) for row in result.all()]
+            
+            try:
+                generation = await asyncio.to_thread(
+                    build_index, self.directory, version, documents,
+                    self.chunk_words, self.chunk_overlap, self.embedding_dims
+                )
+                await asyncio.to_thread(publish, self.directory, generation, version)
+                await self.reload()
+            except Exception:
+                self.stats["failed_builds"] += 1
+                raise
+            self.stats["builds"] += 1
+            self.last_build_seconds = time.perf_counter() - started
+            logger.info(
+                "Built knowledge index %s from %s document(s) in %.2fs",
+                generation, len(documents), self.last_build_seconds
+            )
+            return generation
+    
+    async def initialize(self) -> None:
+        """Open the live index; schedule a rebuild if documents changed since it was built."""
+        await self.reload()
+        async with SessionLocal() as db:
+            version = await self._read_version(db)
+        if version and (self.index is None or self.index.version < version):
+            self.schedule_rebuild()
+    
+    def schedule_rebuild(self) -> None:
+        self._rebuild_requested.set()
+    
+    async def add_document(self, db: AsyncSession, name: str, content: str) -> Dict:
+        """Create or replace a document; it becomes searchable after the next rebuild."""
+        digest = hashlib.sha256(content.encode("utf-8")).hexdigest()
+        document = await db.scalar(select(KnowledgeDocument).where(KnowledgeDocument.name == name))
+        changed = document is None or document.content_hash != digest
+        if document is None:
+            document = KnowledgeDocument(name=name, content=content, content_hash=digest)
+            db.add(document)
+        elif changed:
+            document.content = content
+            document.content_hash = digest
+        if changed:
+            await self._bump(db)
+        await db.commit()
+        if changed:
+            self.schedule_rebuild()
+        return {"id": document.id, "name": name, "size": len(content), "changed": changed}
+    
+    async def delete_document(self, db: AsyncSession, name: str) -> bool:
+        result = await db.execute(delete(KnowledgeDocument).where(KnowledgeDocument.name == name))
+        if result.rowcount == 0:
+            return False
+        await self._bump(db)
+        await db.commit()
+        self.schedule_rebuild()
+        return True
+    
+    @staticmethod
+    async def list_documents(db: AsyncSession) -> List[Dict]:
+        result = await db.execute(
+            select(KnowledgeDocument.id, KnowledgeDocument.name, KnowledgeDocument.content_hash,
+                   KnowledgeDocument.updated_at)
+            .order_by(KnowledgeDocument.name)
+        )
+        return [
+            {
+                "id": row.id,
+                "name": row.name,
+                "content_hash": row.content_hash,
+                "updated_at": row.updated_at.isoformat() if row.updated_at else None
+            }
+            for row in result.all()
+        ]
+    
+    async def _ingest(self) -> None:
+        while True:
+            await self._rebuild_requested.wait()
+            await asyncio.sleep(settings.knowledge_ingest_delay)
+            self._rebuild_requested.clear()
+            try:
+                await self.rebuild()
+            except Exception as e:
+                logger.error("Error building knowledge index: %s", e, exc_info=True)
+    
+    async def _poll(self) -> None:
+        while True:
+            await asyncio.sleep(settings.knowledge_poll_interval)
+            try:
+                await self.reload()
+            except Exception as e:
+                logger.error("Error reloading knowledge index: %s", e)
+    
+    def start(self) -> None:
+        if self._tasks:
+            return
+        self._tasks.append(asyncio.create_task(self._ingest()))
+        if settings.knowledge_poll_interval > 0:
+            self._tasks.append(asyncio.create_task(self._poll()))
+    
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._tasks = []
+    
+    def get_stats(self) -> Dict:
+        index = self.index
+        return {
+            **self.stats,
+            "enabled": self.enabled,
+            "embeddings": bool(index is not None and index.vectors is not None),
+            "documents": len(index.documents) if index else 0,
+            "chunks": index.chunk_count if index else 0,
+            "terms": len(index.vocab) if index else 0,
+            "version": index.version if index else 0,
+            "generation": index.generation if index else None,
+            "last_build_seconds": round(self.last_build_seconds, 4)
+        }
@@ -0,0 +1,272 @@
+"""Latency-aware routing across several LLM backends."""
+from collections import deque
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, TypeVar
+import asyncio
+import time
+
+from app.logger import logger
+from app.metrics import provider_requests
+from app.rate_limit import TokenBucket
+
+
+T = TypeVar("T")
+
+
+class LLMServiceError(Exception):
+    """Raised when no LLM backend could produce a response."""
+
+
+class ProviderBackend:
+    """
+    One provider/model endpoint with its own rate limit, rolling stats and circuit breaker.
+    
+    The breaker opens after `failure_threshold` consecutive failures and
+    rejects traffic for `reset_timeout` seconds. It then lets a single trial
+    request through (half-open): success closes it, failure re-opens it.
+    """
+    
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+    
+    def __init__(self, provider: str, model: str, chat_url: str, headers: Dict[str, str],
+                 params: Dict[str, str], timeout: float, rate_limiter: TokenBucket,
+                 window: int = 100, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.provider = provider
+        self.model = model
+        self.chat_url = chat_url
+        self.headers = headers
+        self.params = params
+        self.timeout = timeout
+        self.rate_limiter = rate_limiter
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._latencies: "deque[float]" = deque(maxlen=window)
+        self._outcomes: "deque[bool]" = deque(maxlen=window)
+        self._consecutive_failures = 0
+        self._state = self.CLOSED
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self.requests = 0
+        self.failures = 0
+    
+    @property
+    def name(self) -> str:
+        return f"{self.provider}:{self.model}"
+    
+    @property
+    def state(self) -> str:
+        if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+            self._state = self.HALF_OPEN
+        return self._state
+    
+    def available(self) -> bool:
+        """Whether the breaker lets a request through right now."""
+        state = self.state
+        if state == self.CLOSED:
+            return True
+        return state == self.HALF_OPEN and not self._trial_in_flight
+    
+    def _percentile(self, fraction: float) -> Optional[float]:
+        if not self._latencies:
+            return None
+        ordered = sorted(self._latencies)
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+    
+    @property
+    def p50(self) -> Optional[float]:
+        return self._percentile(0.5)
+    
+    @property
+    def p99(self) -> Optional[float]:
+        return self._percentile(0.99)
+    
+    @property
+    def error_rate(self) -> float:
+        if not self._outcomes:
+            return 0.0
+        return self._outcomes.count(False) / len(self._outcomes)
+    
+    def score(self) -> float:
+        """
+        Expected seconds to a successful response; lower is better.
+        
+        Backends without samples score 0 so each one gets measured.
+        """
+        p50 = self.p50
+        if p50 is None:
+            return 0.0
+        return p50 / max(1.0 - self.error_rate, 0.05)
+    
+    def begin(self) -> None:
+        self.requests += 1
+        if self.state == self.HALF_OPEN:
+            self._trial_in_flight = True
+    
+    def record_success(self, latency: float) -> None:
+        provider_requests.inc(1, self.provider, self.model, "success")
+        self._latencies.append(latency)
+        self._outcomes.append(True)
+        self._consecutive_failures = 0
+        self._trial_in_flight = False
+        if self._state != self.CLOSED:
+            logger.info("LLM backend %s recovered; circuit closed", self.name)
+        self._state = self.CLOSED
+    
+    def record_failure(self) -> None:
+        provider_requests.inc(1, self.provider, self.model, "error")
+        self.failures += 1
+        self._outcomes.append(False)
+        self._consecutive_failures += 1
+        self._trial_in_flight = False
+        if self._state == self.HALF_OPEN or self._consecutive_failures >= self.failure_threshold:
+            if self._state != self.OPEN:
+                logger.warning("LLM backend %s failing; circuit opened for %ss", self.name, self.reset_timeout)
+            self._state = self.OPEN
+            self._opened_at = time.monotonic()
+    
+    def record_cancelled(self) -> None:
+        """A request that lost a hedge race says nothing about the backend's health."""
+        provider_requests.inc(1, self.provider, self.model, "cancelled")
+        self._trial_in_flight = False
+    
+    def get_stats(self) -> Dict:
+        return {
+            "provider": self.provider,
+            "model": self.model,
+            "state": self.state,
+            "p50_seconds": self.p50,
+            "p99_seconds": self.p99,
+            "error_rate": round(self.error_rate, 4),
+            "requests": self.requests,
+            "failures": self.failures
+        }
+
+
+class ProviderRouter:
+    """
+    Send each request to the fastest healthy backend and fail over on errors.
+    
+    Backends are ranked by `ProviderBackend.score`, with configuration order
+    breaking ties. When `hedge_delay` is above zero and the first attempt has
+    not finished after that many seconds, one hedged request goes to the
+    next-ranked backend and whichever answers first wins.
+    """
+    
+    def __init__(self, backends: List[ProviderBackend], hedge_delay: float = 0.0):
+        self.backends = backends
+        self.hedge_delay = hedge_delay
+        self.stats = {"failovers": 0, "hedges": 0, "hedge_wins": 0}
+    
+    def rank(self) -> List[ProviderBackend]:
+        """Available backends, best first."""
+        return sorted((backend for backend in self.backends if backend.available()), key=ProviderBackend.score)
+    
+    async def _attempt(self, backend: ProviderBackend, call: Callable[[ProviderBackend], Awaitable[T]]) -> T:
+        backend.begin()
+        started = time.monotonic()
+        try:
+            result = await call(backend)
+        except asyncio.CancelledError:
+            backend.record_cancelled()
+            raise
+        except Exception:
+            backend.record_failure()
+            raise
+        backend.record_success(time.monotonic() - started)
+        return result
+    
+    async def call(self, call: Callable[[ProviderBackend], Awaitable[T]]) -> T:
+        """
+        Run `call` against the best backend, failing over and hedging as configured.
+        
+        Raises:
+            LLMServiceError: If no backend is available or every attempt failed
+        """
+        candidates = self.rank()
+        if not candidates:
+            raise LLMServiceError("LLM service error: no healthy LLM backend available")
+        
+        pending: Dict[asyncio.Task, ProviderBackend] = {}
+        errors = []
+        next_index = 0
+        hedged = False
+        
+        def launch() -> None:
+            nonlocal next_index
+            backend = candidates[next_index]
+            next_index += 1
+            pending[asyncio.create_task(self._attempt(backend, call))] = backend
+        
+        launch()
+        try:
+            while pending:
+                can_hedge = self.hedge_delay > 0 and not hedged and next_index < len(candidates)
+                done, _ = await asyncio.wait(
+                    pending,
+                    timeout=self.hedge_delay if can_hedge else None,
+                    return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    hedged = True
+                    self.stats["hedges"] += 1
+                    launch()
+                    continue
+                
+                for task in done:
+                    backend = pending.pop(task)
+                    if task.exception() is None:
+                        if hedged and backend is not candidates[0]:
+                            self.stats["hedge_wins"] += 1
+                        return task.result()
+                    errors.append(f"{backend.name}: {task.exception()}")
+                
+                if not pending and next_index < len(candidates):
+                    self.stats["failovers"] += 1
+                    launch()
+        finally:
+            for task in pending:
+                task.cancel()
+        
+        raise LLMServiceError(f"LLM service error: {'; '.join(errors)}")
+    
+    async def stream(self, open_stream: Callable[[ProviderBackend], AsyncIterator[str]]) -> AsyncIterator[str]:
+        """
+        Stream from the best backend, failing over until the first fragment arrives.
+        
+        Streams are not hedged; once a fragment has been yielded an error ends the stream.
+        
+        Raises:
+            LLMServiceError: If no backend is available or every attempt failed
+        """
+        candidates = self.rank()
+        if not candidates:
+            raise LLMServiceError("LLM service error: no healthy LLM backend available")
+        
+        errors = []
+        for index, backend in enumerate(candidates):
+            if index:
+                self.stats["failovers"] += 1
+            backend.begin()
+            started = time.monotonic()
+            streamed = False
+            try:
+                async for fragment in open_stream(backend):
+                    streamed = True
+                    yield fragment
+            except Exception as e:
+                backend.record_failure()
+                if streamed:
+                    raise LLMServiceError(f"LLM service error: {backend.name}: {str(e)}")
+                errors.append(f"{backend.name}: {str(e)}")
+                continue
+            except BaseException:
+                backend.record_cancelled()
+                raise
+            backend.record_success(time.monotonic() - started)
+            return
+        
+        raise LLMServiceError(f"LLM service error: {'; '.join(errors)}")
+    
+    def get_stats(self) -> Dict:
+        return {**self.stats, "backends": [backend.get_stats() for backend in self.backends]}
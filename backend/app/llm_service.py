@@ -1,7 +1,101 @@
 """LLM Service for connecting to various LLM providers."""
-from typing import Optional, List, Dict
-import openai
+from typing import Optional, List, Dict, AsyncIterator, Tuple
+from functools import partial
+from urllib.parse import urlsplit
+import asyncio
+import importlib.util
+import json
+import httpx
 from app.config import settings
+from app.logger import logger
+from app.llm_router import LLMServiceError, ProviderBackend, ProviderRouter
+from app.metrics import provider_tokens
+from app.rate_limit import TokenBucket
+from app.response_cache import ResponseCache, canonical_request_hash
+from app.single_flight import SingleFlight
+
+
+OPENROUTER_HEADERS = {
+    "HTTP-Referer": "https://github.com/nikunjvadodariya/smartadvisor",  # Optional
+    "X-Title": "SmartAdvisor"  # Optional
+}
+
+
+def _http2_available() -> bool:
+    """HTTP/2 needs the optional h2 package; fall back to HTTP/1.1 without it."""
+    return importlib.util.find_spec("h2") is not None
+
+
+def _parse_backend_specs(raw: str) -> List[Tuple[str, Optional[str]]]:
+    """Parse LLM_PROVIDERS, e.g. "openai,openrouter:anthropic/claude-3-haiku", into (provider, model) pairs."""
+    specs = []
+    for item in raw.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        provider, _, model = item.partition(":")
+        specs.append((provider.strip().lower(), model.strip() or None))
+    return specs
+
+
+def _create_backend(provider: str, model: Optional[str] = None) -> ProviderBackend:
+    """Build the endpoint, credentials and limits for one provider from settings."""
+    if provider == "openai":
+        if not settings.openai_api_key:
+            raise ValueError("OPENAI_API_KEY is required when using OpenAI provider")
+        chat_url = "https://api.openai.com/v1/chat/completions"
+        headers = {"Authorization": f"Bearer {settings.openai_api_key}"}
+        params = {}
+        model = model or settings.openai_model
+        timeout = settings.openai_timeout
+    
+    elif provider == "azure":
+        if not settings.azure_openai_endpoint or not settings.azure_openai_api_key:
+            raise ValueError("Azure OpenAI endpoint and API key are required")
+        # Azure routes by deployment name rather than by the model field
+        model = model or settings.azure_openai_deployment_name
+        chat_url = (
+            f"{settings.azure_openai_endpoint.rstrip('/')}/openai/deployments/"
+            f"{model}/chat/completions"
+        )
+        headers = {"api-key": settings.azure_openai_api_key}
+        params = {"api-version": settings.azure_openai_api_version}
+        timeout = settings.azure_openai_timeout
+    
+    elif provider == "openai-compatible":
+        # For compatible APIs like Ollama, LocalAI, etc.
+        base_url = settings.openai_compatible_base_url or "http://localhost:11434/v1"
+        chat_url = f"{base_url.rstrip('/')}/chat/completions"
+        headers = {"Authorization": f"Bearer {settings.openai_compatible_api_key or 'ollama'}"}
+        params = {}
+        model = model or settings.openai_model
+        timeout = settings.openai_compatible_timeout
+    
+    elif provider == "openrouter":
+        # OpenRouter - Unified access to multiple LLM models
+        # OpenRouter uses OpenAI-compatible API
+        if not settings.openrouter_api_key:
+            raise ValueError("OPENROUTER_API_KEY is required when using OpenRouter provider")
+        chat_url = f"{settings.openrouter_base_url.rstrip('/')}/chat/completions"
+        headers = {
+            "Authorization": f"Bearer {settings.openrouter_api_key}",
+            **OPENROUTER_HEADERS
+        }
+        params = {}
+        model = model or settings.openrouter_model
+        timeout = settings.openrouter_timeout
+    
+    else:
+        raise ValueError(f"Unsupported LLM provider: {provider}")
+    
+    return ProviderBackend(
+        provider, model, chat_url, headers, params, timeout,
+        # Caps the request rate to this provider across all callers (0 = unlimited)
+        rate_limiter=TokenBucket(settings.llm_rate_limit_rps, settings.llm_rate_limit_burst),
+        window=settings.llm_router_window,
+        failure_threshold=settings.llm_circuit_failure_threshold,
+        reset_timeout=settings.llm_circuit_reset_timeout
+    )
 
 
 class LLMService:
@@ -10,57 +104,96 @@ class LLMService:
     def __init__(self):
         """Initialize the LLM service based on configuration."""
         self.provider = settings.llm_provider.lower()
+        self.cache = ResponseCache()
+        # Identical concurrent requests share one upstream call
+        self.single_flight = SingleFlight() if settings.llm_coalesce_enabled else None
         self._initialize_client()
     
     def _initialize_client(self):
-        """Initialize the appropriate LLM client."""
-        if self.provider == "openai":
-            if not settings.openai_api_key:
-                raise ValueError("OPENAI_API_KEY is required when using OpenAI provider")
-            openai.api_key = settings.openai_api_key
-            self.client = openai
-            self.model = settings.openai_model
-            
-        elif self.provider == "azure":
-            if not settings.azure_openai_endpoint or not settings.azure_openai_api_key:
-                raise ValueError("Azure OpenAI endpoint and API key are required")
-            openai.api_type = "azure"
-            openai.api_key = settings.azure_openai_api_key
-            openai.api_base = settings.azure_openai_endpoint
-            openai.api_version = settings.azure_openai_api_version
-            self.client = openai
-            self.model = settings.azure_openai_deployment_name
-            
-        elif self.provider == "openai-compatible":
-            # For compatible APIs like Ollama, LocalAI, etc.
-            base_url = settings.azure_openai_endpoint or "http://localhost:11434/v1"
-            openai.api_base = base_url
-            openai.api_key = settings.azure_openai_api_key or "ollama"
-            self.client = openai
-            self.model = settings.openai_model
-            
-        elif self.provider == "openrouter":
-            # OpenRouter - Unified access to multiple LLM models
-            # OpenRouter uses OpenAI-compatible API
-            if not settings.openrouter_api_key:
-                raise ValueError("OPENROUTER_API_KEY is required when using OpenRouter provider")
-            # Set OpenRouter endpoint and API key
-            openai.api_base = settings.openrouter_base_url
-            openai.api_key = settings.openrouter_api_key
-            # Store headers for OpenRouter requests
-            self.openrouter_headers = {
-                "HTTP-Referer": "https://github.com/nikunjvadodariya/smartadvisor",  # Optional
-                "X-Title": "SmartAdvisor"  # Optional
-            }
-            self.client = openai
-            self.model = settings.openrouter_model
-            
-        else:
-            raise ValueError(f"Unsupported LLM provider: {self.provider}")
+        """Initialize the configured backends and the shared HTTP client."""
+        specs = _parse_backend_specs(settings.llm_providers) or [(self.provider, None)]
+        self.router = ProviderRouter(
+            [_create_backend(provider, model) for provider, model in specs],
+            hedge_delay=settings.llm_hedge_delay
+        )
+        # The first configured backend names the model used for prompt budgeting and cache keys
+        primary = self.router.backends[0]
+        self.provider = primary.provider
+        self.model = primary.model
+        # Created on first use (or by `warm_up`) so importing the app stays cheap
+        self._client: Optional[httpx.AsyncClient] = None
+    
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = self._create_client()
+        return self._client
+    
+    def _create_client(self) -> httpx.AsyncClient:
+        # One pooled client per service: connections are kept alive and reused
+        # across requests, so calls no longer pay a TLS handshake or hold an
+        # executor thread while waiting on the provider.
+        return httpx.AsyncClient(
+            http2=settings.llm_http2 and _http2_available(),
+            limits=httpx.Limits(
+                max_connections=settings.llm_max_connections,
+                max_keepalive_connections=settings.llm_max_keepalive_connections,
+                keepalive_expiry=settings.llm_keepalive_expiry
+            ),
+            timeout=httpx.Timeout(self.router.backends[0].timeout, connect=settings.llm_connect_timeout)
+        )
+    
+    async def warm_up(self) -> None:
+        """Open a pooled connection to every backend host in parallel."""
+        origins = {
+            f"{url.scheme}://{url.netloc}/"
+            for url in (urlsplit(backend.chat_url) for backend in self.router.backends)
+        }
+        
+        async def connect(origin: str) -> None:
+            try:
+                # Any response will do; the point is the TCP/TLS handshake
+                await self.client.head(origin, timeout=settings.llm_connect_timeout)
+            except httpx.HTTPError as e:
+                logger.warning("Could not warm up connection to %s: %s", origin, e)
+        
+        await asyncio.gather(*(connect(origin) for origin in origins))
+    
+    def _build_payload(self, model: str, messages: List[Dict[str, str]], temperature: float,
+                       max_tokens: Optional[int], stream: bool = False) -> Dict:
+        """Build the OpenAI-style chat completion request body."""
+        payload = {
+            "model": model,
+            "messages": messages,
+            "temperature": temperature
+        }
+        if max_tokens:
+            payload["max_tokens"] = max_tokens
+        if stream:
+            payload["stream"] = True
+        return payload
+    
+    @staticmethod
+    def _record_usage(backend: ProviderBackend, usage: Optional[Dict]) -> None:
+        """Count provider-reported token usage."""
+        if not usage:
+            return
+        for kind in ("prompt_tokens", "completion_tokens"):
+            if usage.get(kind):
+                provider_tokens.inc(usage[kind], backend.provider, backend.model, kind)
+    
+    def _use_cache(self, use_cache: bool) -> bool:
+        """Resolve whether a call should go through the cache, counting explicit bypasses."""
+        if not self.cache.enabled:
+            return False
+        if not use_cache:
+            self.cache.record_bypass()
+        return use_cache
     
-    async def generate_response(self, messages: List[Dict[str, str]], 
-                               temperature: float = 0.7, 
-                               max_tokens: Optional[int] = None) -> str:
+    async def generate_response(self, messages: List[Dict[str, str]],
+                               temperature: float = 0.7,
+                               max_tokens: Optional[int] = None,
+                               use_cache: bool = True) -> str:
         """
         Generate a response from the LLM.
         
@@ -68,62 +201,157 @@ class LLMService:
             messages: List of message dictionaries with 'role' and 'content'
             temperature: Sampling temperature (0-2)
             max_tokens: Maximum tokens to generate
-            
+            use_cache: If False, skip the response cache for this call
+        
         Returns:
             Generated response text
         """
-        try:
-            # Use async client if available, otherwise run in executor
-            import asyncio
-            loop = asyncio.get_event_loop()
-            
-            # Build request parameters
-            request_params = {
-                "model": self.model,
-                "messages": messages,
-                "temperature": temperature
-            }
-            if max_tokens:
-                request_params["max_tokens"] = max_tokens
-            
-            # For OpenRouter, use requests library to add custom headers
-            if self.provider == "openrouter":
-                import requests
-                
-                def make_openrouter_request():
-                    response = requests.post(
-                        f"{settings.openrouter_base_url}/chat/completions",
-                        headers={
-                            "Authorization": f"Bearer {settings.openrouter_api_key}",
-                            "Content-Type": "application/json",
-                            "HTTP-Referer": "https://github.com/nikunjvadodariya/smartadvisor",
-                            "X-Title": "SmartAdvisor"
-                        },
-                        json=request_params
-                    )
-                    response.raise_for_status()
-                    return response.json()
-                
-                result = await loop.run_in_executor(None, make_openrouter_request)
-                # Extract response in OpenAI format
-                return result["choices"][0]["message"]["content"].strip()
-            else:
-                # Run the synchronous call in executor to avoid blocking
-                # OpenAI SDK 0.27.x uses ChatCompletion.create
-                response = await loop.run_in_executor(
-                    None,
-                    lambda: self.client.ChatCompletion.create(**request_params)
-                )
-                # Extract only the response content, no metadata
-                return response.choices[0].message.content.strip()
-            
-        except Exception as e:
-            raise Exception(f"LLM service error: {str(e)}")
+        use_cache = self._use_cache(use_cache)
+        if use_cache:
+            cached = await self.cache.get(messages, self.model, temperature, max_tokens)
+            if cached is not None:
+                return cached
+        
+        produce = partial(self._produce_response, messages, temperature, max_tokens, use_cache)
+        if self.single_flight is None:
+            return "".join([fragment async for fragment in produce()])
+        key = canonical_request_hash(messages, self.model, temperature, max_tokens)
+        # A joiner may share a streamed call, whose fragments are not stripped
+        return (await self.single_flight.call(key, produce)).strip()
+    
+    async def _produce_response(self, messages: List[Dict[str, str]], temperature: float,
+                                max_tokens: Optional[int], use_cache: bool) -> AsyncIterator[str]:
+        """Run one upstream completion, store it in the cache and yield it whole."""
+        response_text, model = await self._complete(messages, temperature, max_tokens)
+        if use_cache and model == self.model:
+            await self.cache.set(messages, self.model, temperature, max_tokens, response_text)
+        yield response_text
+    
+    async def _complete(self, messages: List[Dict[str, str]], temperature: float,
+                        max_tokens: Optional[int]) -> Tuple[str, str]:
+        """Get one non-streaming chat completion from the best available backend, with the model that answered."""
+        return await self.router.call(
+            lambda backend: self._complete_with(backend, messages, temperature, max_tokens)
+        )
+    
+    async def _complete_with(self, backend: ProviderBackend, messages: List[Dict[str, str]],
+                             temperature: float, max_tokens: Optional[int]) -> Tuple[str, str]:
+        """Send one non-streaming chat completion request to a backend."""
+        await backend.rate_limiter.acquire()
+        response = await self.client.post(
+            backend.chat_url,
+            headers=backend.headers,
+            params=backend.params,
+            json=self._build_payload(backend.model, messages, temperature, max_tokens),
+            timeout=httpx.Timeout(backend.timeout, connect=settings.llm_connect_timeout)
+        )
+        response.raise_for_status()
+        result = response.json()
+        self._record_usage(backend, result.get("usage"))
+        # Extract only the response content, no metadata
+        return result["choices"][0]["message"]["content"].strip(), backend.model
+    
+    async def generate_response_stream(self, messages: List[Dict[str, str]],
+                                      temperature: float = 0.7,
+                                      max_tokens: Optional[int] = None,
+                                      use_cache: bool = True) -> AsyncIterator[str]:
+        """
+        Stream a response from the LLM as the provider generates it.
+        
+        Args:
+            messages: List of message dictionaries with 'role' and 'content'
+            temperature: Sampling temperature (0-2)
+            max_tokens: Maximum tokens to generate
+            use_cache: If False, skip the response cache for this call
+        
+        Yields:
+            Response text fragments in the order they are produced. A cache hit,
+            or joining an identical non-streaming call, yields a single fragment.
+        """
+        use_cache = self._use_cache(use_cache)
+        if use_cache:
+            cached = await self.cache.get(messages, self.model, temperature, max_tokens)
+            if cached is not None:
+                yield cached
+                return
+        
+        produce = partial(self._produce_stream, messages, temperature, max_tokens, use_cache)
+        if self.single_flight is None:
+            stream = produce()
+        else:
+            key = canonical_request_hash(messages, self.model, temperature, max_tokens)
+            stream = self.single_flight.stream(key, produce)
+        async for fragment in stream:
+            yield fragment
+    
+    async def _produce_stream(self, messages: List[Dict[str, str]], temperature: float,
+                              max_tokens: Optional[int], use_cache: bool) -> AsyncIterator[str]:
+        """Run one upstream streaming completion and store the full text in the cache."""
+        fragments = []
+        answered: Dict[str, str] = {}
+        async for fragment in self._complete_stream(messages, temperature, max_tokens, answered):
+            fragments.append(fragment)
+            yield fragment
+        
+        if use_cache and answered.get("model") == self.model:
+            await self.cache.set(messages, self.model, temperature, max_tokens, "".join(fragments).strip())
+    
+    def _complete_stream(self, messages: List[Dict[str, str]], temperature: float,
+                         max_tokens: Optional[int], answered: Dict[str, str]) -> AsyncIterator[str]:
+        """Stream one chat completion from the best available backend, noting its model in `answered`."""
+        return self.router.stream(
+            lambda backend: self._stream_from(backend, messages, temperature, max_tokens, answered)
+        )
+    
+    async def _stream_from(self, backend: ProviderBackend, messages: List[Dict[str, str]],
+                           temperature: float, max_tokens: Optional[int],
+                           answered: Dict[str, str]) -> AsyncIterator[str]:
+        """Send one streaming chat completion request to a backend."""
+        await backend.rate_limiter.acquire()
+        async with self.client.stream(
+            "POST",
+            backend.chat_url,
+            headers=backend.headers,
+            params=backend.params,
+            json=self._build_payload(backend.model, messages, temperature, max_tokens, stream=True),
+            timeout=httpx.Timeout(backend.timeout, connect=settings.llm_connect_timeout)
+        ) as response:
+            response.raise_for_status()
+            # Providers stream OpenAI-style SSE: "data: {...}" lines ending with "data: [DONE]"
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                chunk = json.loads(data)
+                # Some providers report usage on the final chunk
+                self._record_usage(backend, chunk.get("usage"))
+                choices = chunk.get("choices") or []
+                if not choices:
+                    continue
+                content = (choices[0].get("delta") or {}).get("content")
+                if content:
+                    # The router fails over only before the first fragment, so this backend answers
+                    answered["model"] = backend.model
+                    yield content
+    
+    async def aclose(self) -> None:
+        """Close pooled provider connections."""
+        if self._client is not None:
+            await self._client.aclose()
+    
+    def get_stats(self) -> Dict:
+        """Get routing and request coalescing counters."""
+        return {
+            **self.router.get_stats(),
+            "coalescing": self.single_flight.get_stats() if self.single_flight else None
+        }
     
     def get_provider_info(self) -> Dict:
         """Get information about the current LLM provider (for debugging, not exposed to UI)."""
         return {
             "provider": self.provider,
-            "model": self.model
+            "model": self.model,
+            "backends": [backend.name for backend in self.router.backends]
         }
-
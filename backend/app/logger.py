@@ -1,30 +1,189 @@
 """Logging configuration for SmartAdvisor."""
-import logging
-import os
-from datetime import datetime
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler
 from pathlib import Path
+from typing import Dict, Optional
+import atexit
+import json
+import logging
+import queue
+import uuid
+
 from app.config import settings
 
 
+# Request ID of the HTTP request being handled, attached to every log record
+request_id_var: ContextVar[Optional[str]] = ContextVar("request_id", default=None)
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+
+class JsonFormatter(logging.Formatter):
+    """Format records as one JSON object per line."""
+    
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+        if getattr(record, "request_id", None):
+            entry["request_id"] = record.request_id
+        if getattr(record, "dropped", None):
+            entry["dropped_before"] = record.dropped
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class OverloadQueueHandler(QueueHandler):
+    """
+    Hand records to a bounded queue drained by a background thread.
+    
+    Formatting (including %-style arguments) and file/console I/O happen on
+    the listener thread, never on the event loop. Once the queue is more
+    than `sample_threshold` full, only one in every `1 / sample_rate`
+    records below WARNING is kept; when it is completely full records are
+    dropped. The next record that gets through carries the number dropped.
+    """
+    
+    def __init__(self, log_queue: queue.Queue, sample_threshold: float, sample_rate: float):
+        super().__init__(log_queue)
+        self.high_watermark = int(log_queue.maxsize * sample_threshold)
+        self.sample_every = max(1, round(1 / sample_rate)) if sample_rate > 0 else 0
+        self._sampled = 0
+        self._pending_drops = 0
+        self.stats = {"enqueued": 0, "sampled_out": 0, "dropped": 0}
+    
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Capture context here; leave formatting to the listener thread
+        record.request_id = request_id_var.get()
+        return record
+    
+    def enqueue(self, record: logging.LogRecord) -> None:
+        if record.levelno < logging.WARNING and self.queue.qsize() >= self.high_watermark:
+            self._sampled += 1
+            if not self.sample_every or self._sampled % self.sample_every:
+                self.stats["sampled_out"] += 1
+                self._pending_drops += 1
+                return
+        
+        if self._pending_drops:
+            record.dropped = self._pending_drops
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.stats["dropped"] += 1
+            self._pending_drops += 1
+            return
+        self._pending_drops = 0
+        self.stats["enqueued"] += 1
+    
+    def get_stats(self) -> Dict:
+        return {**self.stats, "queue_depth": self.queue.qsize()}
+
+
+def _file_handler() -> logging.Handler:
+    if settings.log_rotation == "time":
+        return TimedRotatingFileHandler(
+            settings.log_file,
+            when=settings.log_rotation_when,
+            backupCount=settings.log_backup_count,
+            utc=True
+        )
+    return RotatingFileHandler(
+        settings.log_file,
+        maxBytes=settings.log_max_bytes,
+        backupCount=settings.log_backup_count
+    )
+
+
 def setup_logging():
-    """Configure application logging."""
-    # Create logs directory if it doesn't exist
-    log_dir = Path(settings.log_file).parent
-    log_dir.mkdir(parents=True, exist_ok=True)
+    """
+    Configure application logging.
     
-    # Configure logging
+    Only the queue is set up at import time. The file and console handlers
+    that drain it are created by `start_log_output`, so importing `app`
+    opens no files; records logged before then wait in the queue.
+    """
+    handler = OverloadQueueHandler(
+        queue.Queue(maxsize=settings.log_queue_size),
+        settings.log_sample_threshold,
+        settings.log_sample_rate
+    )
     logging.basicConfig(
         level=getattr(logging, settings.log_level.upper()),
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        handlers=[
-            logging.FileHandler(settings.log_file),
-            logging.StreamHandler()
-        ]
+        handlers=[handler]
     )
     
     logger = logging.getLogger("smartadvisor")
-    return logger
+    return logger, handler
+
+
+def start_log_output() -> None:
+    """
+    Open the log file and console handlers and start draining the log queue.
+    
+    Called by the API's startup and by the command-line entry points; later
+    calls do nothing.
+    """
+    global _listener
+    if _listener is not None:
+        return
+    
+    # Create logs directory if it doesn't exist
+    log_dir = Path(settings.log_file).parent
+    log_dir.mkdir(parents=True, exist_ok=True)
+    
+    formatter = JsonFormatter() if settings.log_format == "json" else logging.Formatter(TEXT_FORMAT)
+    output_handlers = [_file_handler(), logging.StreamHandler()]
+    for handler in output_handlers:
+        handler.setFormatter(formatter)
+    
+    _listener = QueueListener(log_handler.queue, *output_handlers, respect_handler_level=True)
+    _listener.start()
+    # Flush queued records when the process exits
+    atexit.register(_listener.stop)
 
 
-logger = setup_logging()
+class RequestIdMiddleware:
+    """
+    Give every HTTP request an ID for log correlation.
+    
+    Uses the caller's `X-Request-ID` header when it looks sane, otherwise
+    generates one, and echoes it back on the response.
+    """
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        request_id = None
+        for name, value in scope.get("headers", []):
+            if name == b"x-request-id":
+                candidate = value.decode("latin-1")
+                if 0 < len(candidate) <= 128 and candidate.isprintable():
+                    request_id = candidate
+                break
+        request_id = request_id or uuid.uuid4().hex
+        
+        async def send_with_request_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = [*message.get("headers", []), (b"x-request-id", request_id.encode("latin-1"))]
+            await send(message)
+        
+        token = request_id_var.set(request_id)
+        try:
+            await self.app(scope, receive, send_with_request_id)
+        finally:
+            request_id_var.reset(token)
+
 
+_listener: Optional[QueueListener] = None
+logger, log_handler = setup_logging()
@@ -1,22 +1,52 @@
 """Main FastAPI application for SmartAdvisor backend."""
-from fastapi import FastAPI, HTTPException, Depends, APIRouter
+# Imported first so the import phases below can be timed
+from app.startup import startup_profile, STEP_RETRY_MAX_DELAY
+from fastapi import FastAPI, HTTPException, Depends, APIRouter, Query, Header
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from typing import Optional, Dict, List
+from typing import Optional, Dict, List, Tuple
 from datetime import datetime
+import asyncio
+import copy
+import json
+import time
 import uuid
-from sqlalchemy.orm import Session
+from sqlalchemy import select, text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+startup_profile.mark("import_framework")
 
 from app.config import settings
 from app.context_engine import ContextEngine
-from app.llm_service import LLMService
-from app.models import init_db, get_db, ConversationLog, ContextPreset, ConversationSession
-from app.logger import logger
+from app.audit_log import AuditLogWriter
+from app.admission import AdmissionController, AdmissionRejected, create_bucket_store
+from app.batch import BatchRunner
+from app.conversation_store import get_messages_page, append_messages, delete_messages
+from app.history import select_history, schedule_summary_refresh
+from app.tokens import load_encodings
+from app.session_context import SessionContextStore
+from app.context_blobs import ContextBlobStore
+from app.presets import PresetRegistry
+from app.maintenance import MaintenanceJob, read_archive, LOGS_KIND, MESSAGES_KIND
+from app.knowledge import KnowledgeBase
+from app.analytics import UsageAnalytics, DIMENSION_PRESET, DIMENSION_USER, DIMENSION_HOUR
+from app.export import (
+    ExportRequest, ExportCursorError, stream_export, LOGS_TABLE, SESSIONS_TABLE, FORMAT_NDJSON, FORMAT_CSV
+)
+from app.search import search_conversations, SearchQueryError, SORT_RELEVANCE, SORT_RECENT
+from app.llm_service import LLMService, LLMServiceError
+from app.metrics import (
+    registry, StageTimer, LoopLagMonitor, stats_samples, backend_samples, pool_samples, turn_metadata
+)
+from app.models import init_db, schema_is_current, get_db, engine, SessionLocal, ContextPreset, ConversationSession
+from app.logger import logger, log_handler, start_log_output, RequestIdMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, Response, StreamingResponse
 
 import os
 
+startup_profile.mark("import_app")
 
 # Initialize FastAPI app
 app = FastAPI(
@@ -27,6 +57,9 @@ app = FastAPI(
 
 api_router = APIRouter(prefix="/api")
 
+# Shown to clients when every LLM backend is failing or cut off by its circuit breaker
+LLM_UNAVAILABLE_DETAIL = "The assistant is temporarily unavailable, please retry shortly"
+
 
 # FRONTEND_DIR = os.path.join(os.path.dirname(__file__), "../../frontend/dist")
 # FRONTEND_DIR = os.path.abspath(FRONTEND_DIR)
@@ -46,14 +79,63 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Request-ID"],
 )
 
+# Request IDs for log correlation
+app.add_middleware(RequestIdMiddleware)
+
 # Initialize services
-context_engine = ContextEngine()
+knowledge_base = KnowledgeBase()
+context_engine = ContextEngine(
+    history_size=settings.context_history_size,
+    snapshot_interval=settings.context_snapshot_interval,
+    knowledge=knowledge_base
+)
+context_blobs = ContextBlobStore()
+context_store = SessionContextStore(context_blobs)
+preset_registry = PresetRegistry(settings.preset_poll_interval)
 llm_service = LLMService()
+audit_writer = AuditLogWriter()
+loop_lag_monitor = LoopLagMonitor(settings.metrics_loop_lag_interval)
+usage_analytics = UsageAnalytics()
+maintenance_job = MaintenanceJob(llm_service, context_blobs, usage_analytics)
+admission_controller = AdmissionController(
+    settings.admission_max_concurrent,
+    settings.admission_max_queue,
+    settings.admission_queue_timeout,
+    store=create_bucket_store()
+)
+batch_runner = BatchRunner(
+    llm_service, context_engine, context_store, context_blobs, audit_writer, admission_controller
+)
+
+
+def _collect_service_metrics():
+    """Point-in-time samples from the services, gathered on each scrape."""
+    yield from stats_samples("cache", llm_service.cache, "Response cache")
+    yield from stats_samples("audit", audit_writer, "Audit log writer")
+    yield from stats_samples("llm_router", llm_service.router, "LLM router")
+    yield from stats_samples("log", log_handler, "Log pipeline")
+    yield from stats_samples("presets", preset_registry, "Preset registry")
+    yield from stats_samples("context_blobs", context_blobs, "Context blob store")
+    yield from stats_samples("knowledge", knowledge_base, "Knowledge base")
+    yield from stats_samples("maintenance", maintenance_job, "Maintenance job")
+    yield from stats_samples("analytics", usage_analytics, "Usage analytics rollup")
+    yield from stats_samples("admission", admission_controller, "Admission control")
+    if llm_service.single_flight:
+        yield from stats_samples("llm_coalescing", llm_service.single_flight, "LLM request coalescing")
+    yield from backend_samples(llm_service.router.get_stats())
+    yield from pool_samples(engine.sync_engine.pool)
+    yield ("smartadvisor_event_loop_lag_last_seconds", "gauge",
+           "Most recent event loop lag measurement", {}, loop_lag_monitor.last_lag)
 
-# Initialize database
-init_db()
+
+registry.register_collector(_collect_service_metrics)
+startup_profile.mark("services")
+
+# Background startup steps; referenced here so they are not garbage collected
+_startup_tasks: List[asyncio.Task] = []
 
 
 # Request/Response models
@@ -61,6 +143,22 @@ class QueryRequest(BaseModel):
     query: str
     context: Optional[Dict] = None
     session_id: Optional[str] = None
+    user_id: Optional[str] = None
+    no_cache: bool = False
+
+
+class BatchQueryItem(BaseModel):
+    query: str
+    context: Optional[Dict] = None
+    session_id: Optional[str] = None
+    user_id: Optional[str] = None
+    id: Optional[str] = None
+
+
+class BatchQueryRequest(BaseModel):
+    items: List[BatchQueryItem]
+    concurrency: Optional[int] = None
+    no_cache: bool = False
 
 
 class QueryResponse(BaseModel):
@@ -88,36 +186,126 @@ class ContextPresetResponse(BaseModel):
     updated_at: datetime
 
 
+class KnowledgeDocumentCreate(BaseModel):
+    name: str
+    content: str
+
+
 class ConversationHistoryResponse(BaseModel):
     session_id: str
     messages: List[Dict]
     context: Optional[Dict]
+    total: int
+    offset: int
+    limit: int
 
 
 @app.on_event("startup")
 async def startup_event():
     """Initialize services on startup."""
+    with startup_profile.step("log_output"):
+        start_log_output()
     logger.info("SmartAdvisor API starting up...")
-    logger.info(f"LLM Provider: {llm_service.get_provider_info()}")
+    logger.info("LLM Provider: %s", llm_service.get_provider_info())
     
-    # Load default context presets if they exist
-    db = next(get_db())
-    try:
-        # Check if we have default presets, if not create them
-        preset_count = db.query(ContextPreset).count()
-        if preset_count == 0:
-            _create_default_presets(db)
-            db.commit()
-    except Exception as e:
-        logger.error(f"Error initializing presets: {str(e)}")
-        db.rollback()
-    finally:
-        db.close()
+    # Initialize database, unless the recorded schema version is already current
+    with startup_profile.step("init_db"):
+        mode = settings.db_schema_init
+        if mode == "always" or (mode == "auto" and not await schema_is_current()):
+            await init_db()
     
+    # Presets, tokenizer encodings and provider connections load in the background; /api/ready waits for them
+    _start_background_step("presets", _initialize_presets)
+    _start_background_step("tokenizer", _load_tokenizer, required=False)
+    _start_background_step("knowledge", knowledge_base.initialize)
+    if settings.llm_warmup:
+        _start_background_step("llm_warmup", llm_service.warm_up, required=False)
+    
+    with startup_profile.step("background_services"):
+        await audit_writer.start()
+        loop_lag_monitor.start()
+        preset_registry.start()
+        knowledge_base.start()
+        maintenance_job.start()
+        usage_analytics.start()
+    
+    logger.info("SmartAdvisor API started")
+    if startup_profile.complete_startup():
+        _on_ready()
+
+
+def _on_ready():
     logger.info("SmartAdvisor API ready!")
+    if settings.startup_profile:
+        logger.info("Startup profile:\n%s", startup_profile.report())
 
 
-def _create_default_presets(db: Session):
+def _start_background_step(name: str, step, required: bool = True):
+    """
+    Run a startup step after the server starts listening; readiness waits for it.
+    
+    A required step that fails is retried with backoff and keeps the worker
+    unready until it succeeds; an optional one is given up after one failure.
+    """
+    async def run():
+        delay = 1.0
+        while True:
+            try:
+                with startup_profile.step(name):
+                    await step()
+                break
+            except Exception as e:
+                if not required:
+                    logger.warning("Optional startup step %s failed: %s", name, e)
+                    break
+                startup_profile.fail(name, e)
+                logger.error("Error during startup step %s: %s; retrying in %.0fs", name, e, delay)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, STEP_RETRY_MAX_DELAY)
+        if startup_profile.done(name):
+            _on_ready()
+    
+    startup_profile.begin(name)
+    _startup_tasks.append(asyncio.create_task(run()))
+
+
+async def _load_tokenizer():
+    """Load the token-counting encoding off the event loop; it may be downloaded."""
+    await asyncio.to_thread(load_encodings, llm_service.model)
+
+
+async def _initialize_presets():
+    """Load presets into the registry, creating the defaults on an empty database."""
+    async with SessionLocal() as db:
+        try:
+            await preset_registry.load(db)
+            if len(preset_registry) == 0:
+                _create_default_presets(db)
+                await preset_registry.bump(db)
+                await db.commit()
+                await preset_registry.load(db)
+        except Exception:
+            await db.rollback()
+            raise
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Release pooled resources on shutdown."""
+    for task in _startup_tasks:
+        task.cancel()
+    await loop_lag_monitor.stop()
+    await preset_registry.stop()
+    await knowledge_base.stop()
+    await maintenance_job.stop()
+    await usage_analytics.stop()
+    await audit_writer.stop()
+    await llm_service.aclose()
+    await engine.dispose()
+    logger.info("SmartAdvisor API shut down")
+
+
+def _create_default_presets(db: AsyncSession):
     """Create default context presets."""
     default_presets = [
         {
@@ -186,123 +374,366 @@ async def health_check():
     return {"status": "healthy", "timestamp": datetime.utcnow().isoformat()}
 
 
+@api_router.get("/ready")
+async def readiness_check():
+    """Readiness probe: 503 until startup has finished and the database answers."""
+    if not startup_profile.ready:
+        return JSONResponse(
+            status_code=503,
+            content={
+                "status": "starting",
+                "pending": sorted(startup_profile.pending),
+                "failed": startup_profile.failures
+            }
+        )
+    try:
+        async with engine.connect() as conn:
+            await conn.execute(text("SELECT 1"))
+    except Exception as e:
+        return JSONResponse(status_code=503, content={"status": "unavailable", "detail": f"Database unavailable: {str(e)}"})
+    return {
+        "status": "ready",
+        "ready_after_ms": round(startup_profile.ready_after * 1000, 2),
+        "startup_ms": startup_profile.as_metadata()
+    }
+
+
+async def _get_session(db: AsyncSession, session_id: str) -> Optional[ConversationSession]:
+    """Load a conversation session by its identifier."""
+    result = await db.execute(
+        select(ConversationSession).where(ConversationSession.session_id == session_id)
+    )
+    return result.scalars().first()
+
+
+async def _get_or_create_session(db: AsyncSession, session_id: str) -> Tuple[ConversationSession, Dict]:
+    """
+    Load a conversation session and its context, creating it with an empty context if missing.
+    A new session is committed before the model is called, so concurrent first
+    requests for one session_id all end up using the same row.
+    """
+    session = await _get_session(db, session_id)
+    
+    if not session:
+        db.add(ConversationSession(session_id=session_id))
+        try:
+            await db.commit()
+        except IntegrityError:
+            # Another request created it first
+            await db.rollback()
+        session = await _get_session(db, session_id)
+    
+    return session, await context_blobs.session_context(db, session)
+
+
+async def _build_query_messages(db: AsyncSession, request: QueryRequest, session: ConversationSession,
+                                context: Dict, timer: StageTimer) -> Tuple[list, Optional[int]]:
+    """
+    Build LLM messages for a query from the session's context (or the request's
+    override) and the session history.
+    
+    Returns:
+        Tuple of (messages, seq of the oldest history message included)
+    """
+    with timer.stage("history_load"):
+        history, summary, first_seq = await select_history(db, session, llm_service.model)
+    with timer.stage("prompt_build"):
+        chunks = await context_engine.retrieve_knowledge_async(request.query)
+        messages = context_engine.build_chat_messages(
+            user_query=request.query,
+            context_override=request.context or context,
+            conversation_history=history,
+            conversation_summary=summary,
+            knowledge_chunks=chunks,
+            # The session's context is addressed by its blob hash; an override is not stored yet
+            context_key=None if request.context else session.context_hash
+        )
+    return messages, first_seq
+
+
+async def _record_turn(db: AsyncSession, session: ConversationSession, context: Dict, request: QueryRequest,
+                       response_text: str, messages: list, timer: StageTimer):
+    """Persist a completed query/response turn to session history and the audit log."""
+    with timer.stage("history_persist"):
+        # Merge the override into this session's context only
+        if request.context:
+            context = {**context, **request.context}
+            await context_blobs.assign(session, context)
+        
+        # Append the turn to conversation history
+        await append_messages(db, session.session_id, [
+            {"role": "user", "content": request.query},
+            {"role": "assistant", "content": response_text}
+        ], llm_service.model)
+        session.updated_at = datetime.utcnow()
+        if request.user_id and not session.user_id:
+            session.user_id = request.user_id
+        
+        await db.commit()
+        context_store.remember(session.session_id, context)
+    
+    with timer.stage("audit_log"):
+        # Log the interaction for audit; written in batches off the request path
+        await audit_writer.submit({
+            "timestamp": datetime.utcnow(),
+            "user_query": request.query,
+            "context_hash": await context_blobs.put(request.context or context),
+            "response": response_text,
+            "session_id": session.session_id,
+            "user_id": request.user_id,
+            "extra_metadata": turn_metadata(timer, llm_service.model, messages, response_text)
+        })
+
+
+async def admit_query(request: QueryRequest):
+    """
+    Hold an admission slot for the whole query, including a streamed response.
+    
+    Sheds the request with 429 and Retry-After when the caller is over its
+    rate limit or the worker's wait queue is full.
+    """
+    try:
+        granted_at = await admission_controller.acquire(request.user_id, request.session_id)
+    except AdmissionRejected as e:
+        logger.warning("Query rejected: %s", e.detail)
+        raise HTTPException(status_code=429, detail=e.detail, headers={"Retry-After": str(e.retry_after)})
+    try:
+        yield
+    finally:
+        admission_controller.release(granted_at)
+
+
+def _sse_event(data: Dict, event: Optional[str] = None) -> str:
+    """Format a server-sent event frame."""
+    frame = f"data: {json.dumps(data)}\n\n"
+    if event:
+        frame = f"event: {event}\n{frame}"
+    return frame
+
+
 @api_router.post("/query", response_model=QueryResponse)
-async def process_query(request: QueryRequest, db: Session = Depends(get_db)):
+async def process_query(request: QueryRequest, db: AsyncSession = Depends(get_db),
+                        _admission: None = Depends(admit_query)):
     """
     Process a user query with optional context override.
     Returns only the processed response without LLM metadata.
     """
     try:
-        logger.info(f"Processing query: {request.query[:100]}...")
+        logger.info("Processing query: %s...", request.query[:100])
+        
+        timer = StageTimer("query")
         
         # Get or create session
         session_id = request.session_id or str(uuid.uuid4())
-        session = db.query(ConversationSession).filter(
-            ConversationSession.session_id == session_id
-        ).first()
-        
-        if not session:
-            session = ConversationSession(
-                session_id=session_id,
-                context=context_engine.get_context(),
-                messages=[]
-            )
-            db.add(session)
-            db.commit()
-            db.refresh(session)
+        with timer.stage("session_load"):
+            session, context = await _get_or_create_session(db, session_id)
         
         # Build messages with context and history
-        conversation_history = session.messages if session.messages else []
-        messages = context_engine.build_chat_messages(
-            user_query=request.query,
-            context_override=request.context,
-            conversation_history=conversation_history[-10:]  # Last 10 messages for context
-        )
+        messages, first_seq = await _build_query_messages(db, request, session, context, timer)
         
         # Generate response from LLM
-        response_text = await llm_service.generate_response(messages)
-        
-        # Update conversation history
-        conversation_history.append({"role": "user", "content": request.query})
-        conversation_history.append({"role": "assistant", "content": response_text})
-        session.messages = conversation_history
-        session.updated_at = datetime.utcnow()
+        with timer.stage("llm_wait"):
+            response_text = await llm_service.generate_response(messages, use_cache=not request.no_cache)
         
-        # Update context if override provided
-        if request.context:
-            context_engine.update_context(request.context, merge=True)
-            session.context = context_engine.get_context()
+        await _record_turn(db, session, context, request, response_text, messages, timer)
+        schedule_summary_refresh(session, first_seq, llm_service)
+        timer.finish()
         
-        db.commit()
-        
-        # Log the interaction for audit
-        log_entry = ConversationLog(
-            timestamp=datetime.utcnow(),
-            user_query=request.query,
-            context_used=request.context or context_engine.get_context(),
-            response=response_text,
-            session_id=session_id
-        )
-        db.add(log_entry)
-        db.commit()
-        
-        logger.info(f"Query processed successfully for session: {session_id}")
+        logger.info("Query processed successfully for session: %s", session_id)
         
         return QueryResponse(
             response=response_text,
             session_id=session_id
         )
+    
+    except LLMServiceError as e:
+        logger.error("No LLM backend could answer query: %s", e)
+        raise HTTPException(
+            status_code=503,
+            detail=LLM_UNAVAILABLE_DETAIL,
+            headers={"Retry-After": str(int(settings.llm_circuit_reset_timeout))}
+        )
+    except Exception as e:
+        logger.error("Error processing query: %s", e, exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Error processing query: {str(e)}")
+
+
+@api_router.post("/query/stream")
+async def process_query_stream(request: QueryRequest, db: AsyncSession = Depends(get_db),
+                               _admission: None = Depends(admit_query)):
+    """
+    Process a user query and stream the response as server-sent events.
+    
+    Emits a `start` event carrying the session id, one unnamed event per
+    response fragment (`{"token": ...}`), then `done` once history and the
+    audit log are written, or `error` if generation fails.
+    """
+    try:
+        logger.info("Processing streaming query: %s...", request.query[:100])
         
+        timer = StageTimer("query_stream")
+        session_id = request.session_id or str(uuid.uuid4())
+        with timer.stage("session_load"):
+            session, context = await _get_or_create_session(db, session_id)
+        messages, first_seq = await _build_query_messages(db, request, session, context, timer)
     except Exception as e:
-        logger.error(f"Error processing query: {str(e)}", exc_info=True)
+        logger.error("Error processing query: %s", e, exc_info=True)
         raise HTTPException(status_code=500, detail=f"Error processing query: {str(e)}")
+    
+    async def event_stream():
+        yield _sse_event({"session_id": session_id}, event="start")
+        
+        response_parts = []
+        try:
+            llm_started = time.perf_counter()
+            with timer.stage("llm_wait"):
+                async for token in llm_service.generate_response_stream(messages, use_cache=not request.no_cache):
+                    if not response_parts:
+                        timer.record("llm_first_token", time.perf_counter() - llm_started)
+                    response_parts.append(token)
+                    yield _sse_event({"token": token})
+            
+            await _record_turn(db, session, context, request, "".join(response_parts).strip(), messages, timer)
+            schedule_summary_refresh(session, first_seq, llm_service)
+            timer.finish()
+        except LLMServiceError as e:
+            await db.rollback()
+            logger.error("No LLM backend could answer query: %s", e)
+            yield _sse_event({"detail": LLM_UNAVAILABLE_DETAIL, "status": 503}, event="error")
+            return
+        except Exception as e:
+            await db.rollback()
+            logger.error("Error processing query: %s", e, exc_info=True)
+            yield _sse_event({"detail": f"Error processing query: {str(e)}"}, event="error")
+            return
+        
+        logger.info("Streaming query processed successfully for session: %s", session_id)
+        yield _sse_event({"session_id": session_id}, event="done")
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@api_router.post("/query/batch")
+async def process_query_batch(request: BatchQueryRequest, db: AsyncSession = Depends(get_db)):
+    """
+    Process many queries and stream results as NDJSON in completion order.
+    
+    Each line carries the item's `index` in the request, its `id` and
+    `session_id`, and either `response` or `error`. Items sharing a session
+    run in request order; at most `concurrency` (capped by
+    BATCH_MAX_CONCURRENCY) LLM calls are in flight at once.
+    
+    Each distinct user and session is charged for its items up front, at
+    most a full bucket (429, charging nothing, if any is over), and each LLM
+    call holds an admission slot like a single query; an item shed by
+    admission control gets an error line.
+    """
+    if not request.items:
+        raise HTTPException(status_code=400, detail="Batch contains no items")
+    if len(request.items) > settings.batch_max_items:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Batch too large: {len(request.items)} items (max {settings.batch_max_items})"
+        )
+    try:
+        await admission_controller.check_batch_rate((item.user_id, item.session_id) for item in request.items)
+    except AdmissionRejected as e:
+        logger.warning("Batch rejected: %s", e.detail)
+        raise HTTPException(status_code=429, detail=e.detail, headers={"Retry-After": str(e.retry_after)})
+    
+    concurrency = min(request.concurrency or settings.batch_max_concurrency, settings.batch_max_concurrency)
+    logger.info("Processing batch of %s queries (concurrency %s)", len(request.items), concurrency)
+    
+    return StreamingResponse(
+        batch_runner.run(
+            db,
+            [item.dict() for item in request.items],
+            concurrency,
+            use_cache=not request.no_cache
+        ),
+        media_type="application/x-ndjson"
+    )
+
+
+@api_router.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Stage latency histograms, token usage, cache, pool and event-loop metrics in Prometheus text format."""
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+
+@api_router.get("/cache/stats")
+async def get_cache_stats():
+    """Get response cache hit/miss counters."""
+    return llm_service.cache.get_stats()
+
+
+@api_router.get("/llm/stats")
+async def get_llm_stats():
+    """Get per-backend latency, error rate and circuit breaker state, and coalesced call counts."""
+    return llm_service.get_stats()
+
+
+@api_router.get("/admission/stats")
+async def get_admission_stats():
+    """Get admission control slots, queue length and shed counters."""
+    return admission_controller.get_stats()
+
+
+@api_router.get("/audit/stats")
+async def get_audit_stats():
+    """Get audit log writer queue and drop counters."""
+    return audit_writer.get_stats()
 
 
 @api_router.get("/context")
-async def get_context():
-    """Get the current business context."""
-    return {"context": context_engine.get_context()}
+async def get_context(session_id: Optional[str] = None, db: AsyncSession = Depends(get_db)):
+    """Get the business context of a session (empty for a new session)."""
+    return {"context": await context_store.get(db, session_id)}
 
 
 @api_router.post("/context")
-async def update_context(request: ContextUpdateRequest):
-    """Update the business context dynamically."""
+async def update_context(request: ContextUpdateRequest, session_id: Optional[str] = None,
+                         db: AsyncSession = Depends(get_db)):
+    """Update the business context of a session; without a session_id a new session is created."""
+    session_id = session_id or str(uuid.uuid4())
     try:
-        context_engine.update_context(request.context, merge=request.merge)
-        logger.info(f"Context updated: {list(request.context.keys())}")
-        return {"message": "Context updated successfully", "context": context_engine.get_context()}
+        context = await context_store.set(db, session_id, request.context, merge=request.merge)
+        logger.info("Context updated: %s", list(request.context.keys()))
+        return {"message": "Context updated successfully", "context": context, "session_id": session_id}
     except Exception as e:
-        logger.error(f"Error updating context: {str(e)}")
+        await db.rollback()
+        logger.error("Error updating context: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @api_router.delete("/context")
-async def clear_context():
-    """Clear the current business context."""
-    context_engine.clear_context()
+async def clear_context(session_id: Optional[str] = None, db: AsyncSession = Depends(get_db)):
+    """Clear the business context of a session."""
+    if session_id:
+        # Without a session there is nothing to clear: new sessions start empty
+        await context_store.set(db, session_id, {}, merge=False)
     logger.info("Context cleared")
     return {"message": "Context cleared successfully"}
 
 
 @api_router.get("/presets", response_model=List[ContextPresetResponse])
-async def get_presets(db: Session = Depends(get_db)):
-    """Get all available context presets."""
-    presets = db.query(ContextPreset).all()
-    return [
-        ContextPresetResponse(
-            id=preset.id,
-            name=preset.name,
-            description=preset.description,
-            context_data=preset.context_data,
-            created_at=preset.created_at,
-            updated_at=preset.updated_at
-        )
-        for preset in presets
-    ]
+async def get_presets(if_none_match: Optional[str] = Header(None), db: AsyncSession = Depends(get_db)):
+    """Get all available context presets, served from memory with an ETag."""
+    if preset_registry.version is None:
+        # Asked before the startup load finished
+        await preset_registry.refresh(db)
+    headers = {"ETag": preset_registry.etag, "Cache-Control": "no-cache"}
+    if preset_registry.not_modified(if_none_match):
+        return Response(status_code=304, headers=headers)
+    return Response(content=preset_registry.body, media_type="application/json", headers=headers)
 
 
 @api_router.post("/presets", response_model=ContextPresetResponse)
-async def create_preset(preset: ContextPresetCreate, db: Session = Depends(get_db)):
+async def create_preset(preset: ContextPresetCreate, db: AsyncSession = Depends(get_db)):
     """Create a new context preset."""
     try:
         db_preset = ContextPreset(
@@ -311,9 +742,11 @@ async def create_preset(preset: ContextPresetCreate, db: Session = Depends(get_d
             context_data=preset.context_data
         )
         db.add(db_preset)
-        db.commit()
-        db.refresh(db_preset)
-        logger.info(f"Created preset: {preset.name}")
+        await preset_registry.bump(db)
+        await db.commit()
+        await db.refresh(db_preset)
+        await preset_registry.refresh(db)
+        logger.info("Created preset: %s", preset.name)
         return ContextPresetResponse(
             id=db_preset.id,
             name=db_preset.name,
@@ -323,55 +756,220 @@ async def create_preset(preset: ContextPresetCreate, db: Session = Depends(get_d
             updated_at=db_preset.updated_at
         )
     except Exception as e:
-        db.rollback()
-        logger.error(f"Error creating preset: {str(e)}")
+        await db.rollback()
+        logger.error("Error creating preset: %s", e)
         raise HTTPException(status_code=400, detail=str(e))
 
 
 @api_router.post("/presets/{preset_name}/apply")
-async def apply_preset(preset_name: str, db: Session = Depends(get_db)):
-    """Apply a context preset."""
-    preset = db.query(ContextPreset).filter(ContextPreset.name == preset_name).first()
+async def apply_preset(preset_name: str, session_id: Optional[str] = None,
+                       db: AsyncSession = Depends(get_db)):
+    """Apply a context preset to a session; without a session_id a new session is created."""
+    preset = await preset_registry.lookup(db, preset_name)
     if not preset:
         raise HTTPException(status_code=404, detail=f"Preset '{preset_name}' not found")
     
-    context_engine.update_context(preset.context_data, merge=False)
-    logger.info(f"Applied preset: {preset_name}")
-    return {"message": f"Preset '{preset_name}' applied", "context": context_engine.get_context()}
+    session_id = session_id or str(uuid.uuid4())
+    context = await context_store.set(db, session_id, copy.deepcopy(preset["context_data"]), merge=False)
+    logger.info("Applied preset: %s", preset_name)
+    return {"message": f"Preset '{preset_name}' applied", "context": context, "session_id": session_id}
 
 
 @api_router.get("/conversations/{session_id}", response_model=ConversationHistoryResponse)
-async def get_conversation_history(session_id: str, db: Session = Depends(get_db)):
-    """Get conversation history for a session."""
-    session = db.query(ConversationSession).filter(
-        ConversationSession.session_id == session_id
-    ).first()
+async def get_conversation_history(session_id: str,
+                                   offset: int = Query(0, ge=0),
+                                   limit: int = Query(100, ge=1, le=1000),
+                                   db: AsyncSession = Depends(get_db)):
+    """Get a page of conversation history for a session, oldest messages first."""
+    session = await _get_session(db, session_id)
     
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
     
+    messages, total = await get_messages_page(db, session_id, offset, limit)
     return ConversationHistoryResponse(
         session_id=session.session_id,
-        messages=session.messages or [],
-        context=session.context
+        messages=messages,
+        context=await context_blobs.session_context(db, session),
+        total=total,
+        offset=offset,
+        limit=limit
     )
 
 
 @api_router.delete("/conversations/{session_id}")
-async def delete_conversation(session_id: str, db: Session = Depends(get_db)):
+async def delete_conversation(session_id: str, db: AsyncSession = Depends(get_db)):
     """Delete a conversation session."""
-    session = db.query(ConversationSession).filter(
-        ConversationSession.session_id == session_id
-    ).first()
+    session = await _get_session(db, session_id)
     
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
     
-    db.delete(session)
-    db.commit()
-    logger.info(f"Deleted session: {session_id}")
+    await delete_messages(db, session_id)
+    await db.delete(session)
+    await db.commit()
+    context_store.forget(session_id)
+    logger.info("Deleted session: %s", session_id)
     return {"message": "Session deleted successfully"}
 
+
+@api_router.post("/knowledge/documents", status_code=202)
+async def add_knowledge_document(request: KnowledgeDocumentCreate, db: AsyncSession = Depends(get_db)):
+    """Add or replace a knowledge document; it is indexed in the background."""
+    if not request.name.strip() or not request.content.strip():
+        raise HTTPException(status_code=400, detail="Document name and content are required")
+    try:
+        document = await knowledge_base.add_document(db, request.name.strip(), request.content)
+        logger.info("Knowledge document stored: %s", document["name"])
+        return document
+    except Exception as e:
+        await db.rollback()
+        logger.error("Error storing knowledge document: %s", e)
+        raise HTTPException(status_code=500, detail=f"Error storing knowledge document: {str(e)}")
+
+
+@api_router.get("/knowledge/documents")
+async def list_knowledge_documents(db: AsyncSession = Depends(get_db)):
+    """List knowledge documents."""
+    return await knowledge_base.list_documents(db)
+
+
+@api_router.delete("/knowledge/documents/{name}")
+async def delete_knowledge_document(name: str, db: AsyncSession = Depends(get_db)):
+    """Delete a knowledge document; it leaves the index with the next rebuild."""
+    if not await knowledge_base.delete_document(db, name):
+        raise HTTPException(status_code=404, detail="Document not found")
+    logger.info("Knowledge document deleted: %s", name)
+    return {"message": "Document deleted successfully"}
+
+
+@api_router.get("/knowledge/search")
+async def search_knowledge(q: str = Query(..., min_length=1, max_length=1000),
+                           k: Optional[int] = Query(None, ge=1, le=50)):
+    """Show the chunks retrieval would add to a prompt for this query."""
+    return {"query": q, "results": await knowledge_base.retrieve_async(q, k or max(knowledge_base.top_k, 1))}
+
+
+@api_router.get("/knowledge/stats")
+async def get_knowledge_stats():
+    """Get knowledge index size, build and retrieval counters."""
+    return knowledge_base.get_stats()
+
+
+@api_router.get("/search")
+async def search(q: str = Query(..., min_length=1, max_length=500),
+                 session_id: Optional[str] = None,
+                 user_id: Optional[str] = None,
+                 start: Optional[datetime] = None,
+                 end: Optional[datetime] = None,
+                 sort: str = Query(SORT_RELEVANCE, regex=f"^({SORT_RELEVANCE}|{SORT_RECENT})$"),
+                 offset: int = Query(0, ge=0, le=10000),
+                 limit: int = Query(20, ge=1, le=100),
+                 db: AsyncSession = Depends(get_db)):
+    """Search past questions and answers, best matches (or newest) first."""
+    try:
+        page = await search_conversations(db, q, session_id, user_id, start, end, sort, offset, limit)
+    except SearchQueryError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error("Error searching conversations: %s", e, exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Error searching conversations: {str(e)}")
+    return {"query": q, "offset": offset, "limit": limit, **page}
+
+@api_router.get("/export")
+async def export_table(table: str = Query(LOGS_TABLE, regex=f"^({LOGS_TABLE}|{SESSIONS_TABLE})$"),
+                       output_format: str = Query(FORMAT_NDJSON, alias="format",
+                                                  regex=f"^({FORMAT_NDJSON}|{FORMAT_CSV})$"),
+                       gzip: bool = False,
+                       session_id: Optional[str] = None,
+                       user_id: Optional[str] = None,
+                       start: Optional[datetime] = None,
+                       end: Optional[datetime] = None,
+                       after_id: int = Query(0, ge=0),
+                       cursor: Optional[str] = None,
+                       max_rows: Optional[int] = Query(None, ge=1)):
+    """
+    Stream conversation logs or sessions as NDJSON or CSV, in id order.
+    
+    A `cursor` from a previous NDJSON export's trailer resumes it with the
+    same table and filters; the other filter parameters are then ignored.
+    """
+    if cursor:
+        try:
+            export_request = ExportRequest.from_cursor(cursor)
+        except ExportCursorError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    else:
+        export_request = ExportRequest(table, session_id, user_id, start, end, after_id)
+    
+    filename = f"{export_request.table}-{datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')}.{output_format}"
+    media_type = "application/x-ndjson" if output_format == FORMAT_NDJSON else "text/csv; charset=utf-8"
+    if gzip:
+        filename += ".gz"
+        media_type = "application/gzip"
+    logger.info("Exporting %s as %s after id %s", export_request.table, output_format, export_request.after_id)
+    return StreamingResponse(
+        stream_export(export_request, context_blobs, output_format, gzip, max_rows),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"', "X-Accel-Buffering": "no"}
+    )
+
+
+@api_router.get("/archive/conversations/{session_id}")
+async def get_archived_conversation(session_id: str,
+                                    kind: Optional[str] = Query(None, regex=f"^({MESSAGES_KIND}|{LOGS_KIND})$"),
+                                    db: AsyncSession = Depends(get_db)):
+    """Read a session's archived messages and audit log rows back from archive segments."""
+    archived = await read_archive(db, session_id, kind)
+    if archived is None:
+        raise HTTPException(status_code=404, detail="No archived data for this session")
+    return archived
+
+
+@api_router.get("/analytics")
+async def get_analytics(dimension: str = Query(DIMENSION_PRESET,
+                                               regex=f"^({DIMENSION_PRESET}|{DIMENSION_USER}|{DIMENSION_HOUR})$"),
+                        start: Optional[datetime] = None, end: Optional[datetime] = None,
+                        limit: int = Query(50, ge=1, le=1000), db: AsyncSession = Depends(get_db)):
+    """Query counts, latency and token usage per preset, per user or per hour from the precomputed rollups."""
+    try:
+        return await usage_analytics.query(db, dimension, start, end, limit)
+    except Exception as e:
+        logger.error("Error querying analytics: %s", e, exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Error querying analytics: {str(e)}")
+
+
+@api_router.post("/analytics/rollup")
+async def run_analytics_rollup():
+    """Roll up new audit rows now instead of waiting for the next scheduled pass."""
+    try:
+        return await usage_analytics.run_once()
+    except Exception as e:
+        logger.error("Error rolling up usage analytics: %s", e, exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Error rolling up usage analytics: {str(e)}")
+
+
+@api_router.get("/analytics/stats")
+async def get_analytics_stats():
+    """Get rollup counters and the result of the last pass."""
+    return usage_analytics.get_stats()
+
+
+@api_router.post("/maintenance/run")
+async def run_maintenance():
+    """Run one compaction and archival pass now."""
+    try:
+        return await maintenance_job.run_once()
+    except Exception as e:
+        logger.error("Error running maintenance: %s", e, exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Error running maintenance: {str(e)}")
+
+
+@api_router.get("/maintenance/stats")
+async def get_maintenance_stats():
+    """Get maintenance job counters and the result of the last pass."""
+    return maintenance_job.get_stats()
+
 app.include_router(api_router)   # <- important: include router BEFORE mounting static files
 
 app.mount("/", StaticFiles(directory=FRONTEND_DIR, html=True), name="frontend")
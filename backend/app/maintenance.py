@@ -0,0 +1,391 @@
+"""Background compaction and archival of old conversations.
+
+Run one pass from the backend directory with:
+
+    python -m app.maintenance
+"""
+from collections import Counter
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Dict, List, Optional
+import asyncio
+import gzip
+import io
+import json
+import os
+import time
+import uuid
+
+from sqlalchemy import delete, func, insert, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import settings
+from app.analytics import UsageAnalytics
+from app.context_blobs import ContextBlobStore
+from app.history import summarize_messages
+from app.llm_service import LLMService
+from app.logger import logger, start_log_output
+from app.models import (
+    ArchivedSession, ArchiveSegment, ConversationLog, ConversationMessage, ConversationSession,
+    SessionLocal, engine
+)
+
+try:
+    import zstandard
+except ImportError:  # Optional: archives fall back to gzip
+    zstandard = None
+
+
+LOGS_KIND = "conversation_logs"
+MESSAGES_KIND = "conversation_messages"
+
+
+def _compression() -> str:
+    if settings.archive_compression == "zstd":
+        if zstandard is not None:
+            return "zstd"
+        logger.warning("ARCHIVE_COMPRESSION=zstd but zstandard is not installed; using gzip")
+    return "gzip"
+
+
+def _write_segment(relative_path: str, records: List[Dict]) -> None:
+    """Write records as compressed JSONL, durably, under ARCHIVE_DIR."""
+    path = Path(settings.archive_dir) / relative_path
+    path.parent.mkdir(parents=True, exist_ok=True)
+    partial_path = path.with_name(path.name + ".partial")
+    with open(partial_path, "wb") as raw:
+        if path.suffix == ".zst":
+            stream = zstandard.ZstdCompressor().stream_writer(raw, closefd=False)
+        else:
+            stream = gzip.GzipFile(fileobj=raw, mode="wb")
+        with stream:
+            for record in records:
+                stream.write((json.dumps(record, default=str) + "\n").encode("utf-8"))
+        raw.flush()
+        os.fsync(raw.fileno())
+    # Only complete segments ever carry the final name
+    os.replace(partial_path, path)
+
+
+def _read_segment(relative_path: str, session_id: str) -> List[Dict]:
+    """Read the records of one session back from a segment."""
+    path = Path(settings.archive_dir) / relative_path
+    records = []
+    with open(path, "rb") as raw:
+        if path.suffix == ".zst":
+            stream = zstandard.ZstdDecompressor().stream_reader(raw)
+        else:
+            stream = gzip.GzipFile(fileobj=raw, mode="rb")
+        for line in io.TextIOWrapper(stream, encoding="utf-8"):
+            record = json.loads(line)
+            if record.get("session_id") == session_id:
+                records.append(record)
+    return records
+
+
+def _log_record(row: ConversationLog, contexts: Dict[str, Dict]) -> Dict:
+    # Segments are self-contained: store the context itself, not its hash
+    return {
+        "id": row.id,
+        "timestamp": row.timestamp.isoformat() if row.timestamp else None,
+        "user_query": row.user_query,
+        "context_used": contexts.get(row.context_hash) if row.context_hash else row.context_used,
+        "response": row.response,
+        "session_id": row.session_id,
+        "user_id": row.user_id,
+        "extra_metadata": row.extra_metadata
+    }
+
+
+def _message_record(row: ConversationMessage) -> Dict:
+    return {
+        "session_id": row.session_id,
+        "seq": row.seq,
+        "role": row.role,
+        "content": row.content,
+        "created_at": row.created_at.isoformat() if row.created_at else None
+    }
+
+
+async def _store_segment(db: AsyncSession, kind: str, records: List[Dict],
+                         timestamps: List[Optional[datetime]]) -> None:
+    """
+    Write a segment file and index it. The caller deletes the archived rows and commits.
+    
+    If the commit fails the file is left unindexed and never read.
+    """
+    extension = ".jsonl.zst" if _compression() == "zstd" else ".jsonl.gz"
+    relative_path = f"{kind}/{datetime.utcnow():%Y/%m/%d}/{uuid.uuid4().hex}{extension}"
+    await asyncio.to_thread(_write_segment, relative_path, records)
+    
+    known = [timestamp for timestamp in timestamps if timestamp is not None]
+    segment = ArchiveSegment(
+        kind=kind,
+        path=relative_path,
+        row_count=len(records),
+        min_timestamp=min(known) if known else None,
+        max_timestamp=max(known) if known else None
+    )
+    db.add(segment)
+    await db.flush()
+    
+    per_session = Counter(record["session_id"] for record in records if record.get("session_id"))
+    if per_session:
+        await db.execute(insert(ArchivedSession), [
+            {"session_id": session_id, "segment_id": segment.id, "row_count": count}
+            for session_id, count in per_session.items()
+        ])
+
+
+async def read_archive(db: AsyncSession, session_id: str, kind: Optional[str] = None) -> Optional[Dict]:
+    """
+    Read a session's archived rows back from its segments.
+    
+    Args:
+        db: Database session
+        session_id: Conversation session identifier
+        kind: Only read one source table (conversation_logs or conversation_messages)
+    
+    Returns:
+        Dictionary with the archived messages and logs, or None if nothing was archived
+    """
+    query = (
+        select(ArchiveSegment)
+        .join(ArchivedSession, ArchivedSession.segment_id == ArchiveSegment.id)
+        .where(ArchivedSession.session_id == session_id)
+        .order_by(ArchiveSegment.id)
+    )
+    if kind:
+        query = query.where(ArchiveSegment.kind == kind)
+    segments = (await db.execute(query)).scalars().all()
+    if not segments:
+        return None
+    
+    archived = {MESSAGES_KIND: [], LOGS_KIND: []}
+    missing = []
+    for segment in segments:
+        try:
+            archived[segment.kind].extend(await asyncio.to_thread(_read_segment, segment.path, session_id))
+        except FileNotFoundError:
+            logger.error("Archive segment missing: %s", segment.path)
+            missing.append(segment.path)
+    
+    return {
+        "session_id": session_id,
+        "messages": sorted(archived[MESSAGES_KIND], key=lambda record: record["seq"]),
+        "logs": sorted(archived[LOGS_KIND], key=lambda record: record["id"]),
+        "missing_segments": missing
+    }
+
+
+class MaintenanceJob:
+    """
+    Keep the conversation tables small.
+    
+    Each pass compacts sessions idle for `maintenance_compact_after_days`:
+    everything but their newest `maintenance_compact_keep_messages` messages
+    is folded into the session summary, written to an archive segment and
+    deleted. It then moves `conversation_logs` rows older than
+    `maintenance_archive_after_days` to segments and purges them in bulk,
+    `maintenance_batch_size` rows per segment. Rows are only deleted in the
+    transaction that indexes the segment holding them. With `analytics`,
+    pending audit rows are rolled up before any are archived.
+    
+    Runs every `maintenance_interval` seconds when enabled; enable it on one
+    worker only, or run `python -m app.maintenance` from a scheduler.
+    """
+    
+    def __init__(self, llm_service, context_blobs: ContextBlobStore, analytics: Optional[UsageAnalytics] = None):
+        self.llm_service = llm_service
+        self.context_blobs = context_blobs
+        self.analytics = analytics
+        self.interval = settings.maintenance_interval
+        self._task: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+        self.last_run: Optional[Dict] = None
+        self.stats = {
+            "runs": 0,
+            "failed_runs": 0,
+            "sessions_compacted": 0,
+            "failed_sessions": 0,
+            "messages_archived": 0,
+            "logs_archived": 0,
+            "segments_written": 0
+        }
+    
+    def start(self) -> None:
+        if self._task is None and self.interval > 0:
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+    
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.run_once()
+            except Exception as e:
+                self.stats["failed_runs"] += 1
+                logger.error("Error running maintenance: %s", e, exc_info=True)
+    
+    async def run_once(self) -> Dict:
+        """Run one compaction and archival pass; concurrent calls wait for each other."""
+        async with self._lock:
+            started = time.perf_counter()
+            result = {"sessions_compacted": 0, "messages_archived": 0, "logs_archived": 0, "segments_written": 0}
+            if settings.maintenance_compact_after_days > 0:
+                await self._compact_sessions(result)
+            if settings.maintenance_archive_after_days > 0:
+                await self._archive_logs(result)
+            
+            for key, value in result.items():
+                self.stats[key] += value
+            self.stats["runs"] += 1
+            result["duration_seconds"] = round(time.perf_counter() - started, 3)
+            self.last_run = {**result, "finished_at": datetime.utcnow().isoformat()}
+            logger.info("Maintenance pass finished: %s", result)
+            return result
+    
+    async def _compact_sessions(self, result: Dict) -> None:
+        cutoff = datetime.utcnow() - timedelta(days=settings.maintenance_compact_after_days)
+        keep = settings.maintenance_compact_keep_messages
+        after = ""
+        while True:
+            async with SessionLocal() as db:
+                candidates = (await db.execute(
+                    select(ConversationMessage.session_id, func.max(ConversationMessage.seq))
+                    .join(ConversationSession, ConversationSession.session_id == ConversationMessage.session_id)
+                    .where(ConversationSession.updated_at < cutoff, ConversationMessage.session_id > after)
+                    .group_by(ConversationMessage.session_id)
+                    .having(func.count() > keep)
+                    .order_by(ConversationMessage.session_id)
+                    .limit(settings.maintenance_compact_batch_sessions)
+                )).all()
+                if not candidates:
+                    return
+                after = candidates[-1][0]
+                
+                await self._compact_batch(db, candidates, keep, result)
+                if len(candidates) < settings.maintenance_compact_batch_sessions:
+                    return
+    
+    async def _compact_batch(self, db: AsyncSession, candidates, keep: int, result: Dict) -> None:
+        session_ids = [session_id for session_id, _ in candidates]
+        sessions = {
+            session.session_id: session
+            for session in (await db.execute(
+                select(ConversationSession).where(ConversationSession.session_id.in_(session_ids))
+            )).scalars()
+        }
+        
+        records, timestamps, compacted = [], [], []
+        for session_id, max_seq in candidates:
+            session = sessions[session_id]
+            cut_seq = max_seq - keep
+            rows = (await db.execute(
+                select(ConversationMessage)
+                .where(ConversationMessage.session_id == session_id, ConversationMessage.seq <= cut_seq)
+                .order_by(ConversationMessage.seq)
+            )).scalars().all()
+            
+            summarized_through = session.summary_seq if session.summary_seq is not None else -1
+            unsummarized = [
+                {"role": row.role, "content": row.content} for row in rows if row.seq > summarized_through
+            ]
+            summary = session.summary
+            if unsummarized:
+                try:
+                    summary = await summarize_messages(self.llm_service, summary, unsummarized)
+                except Exception as e:
+                    # Leave the session as it is rather than archive what the summary lacks
+                    self.stats["failed_sessions"] += 1
+                    logger.error("Error summarizing session %s for compaction: %s", session_id, e)
+                    continue
+            
+            records.extend(_message_record(row) for row in rows)
+            timestamps.extend(row.created_at for row in rows)
+            compacted.append((session_id, cut_seq, summary, max(cut_seq, summarized_through)))
+        
+        if not records:
+            return
+        await _store_segment(db, MESSAGES_KIND, records, timestamps)
+        for session_id, cut_seq, summary, summary_seq in compacted:
+            await db.execute(
+                delete(ConversationMessage)
+                .where(ConversationMessage.session_id == session_id, ConversationMessage.seq <= cut_seq)
+                .execution_options(synchronize_session=False)
+            )
+            await db.execute(
+                update(ConversationSession)
+                .where(ConversationSession.session_id == session_id)
+                # Compaction is not activity: keep updated_at as it was
+                .values(summary=summary, summary_seq=summary_seq, updated_at=ConversationSession.updated_at)
+                .execution_options(synchronize_session=False)
+            )
+        await db.commit()
+        
+        result["sessions_compacted"] += len(compacted)
+        result["messages_archived"] += len(records)
+        result["segments_written"] += 1
+    
+    async def _archive_logs(self, result: Dict) -> None:
+        if self.analytics is not None:
+            # Roll rows up before they leave the table
+            await self.analytics.run_once()
+        cutoff = datetime.utcnow() - timedelta(days=settings.maintenance_archive_after_days)
+        batch_size = settings.maintenance_batch_size
+        while True:
+            async with SessionLocal() as db:
+                rows = (await db.execute(
+                    select(ConversationLog)
+                    .where(ConversationLog.timestamp < cutoff)
+                    .order_by(ConversationLog.id)
+                    .limit(batch_size)
+                )).scalars().all()
+                if not rows:
+                    return
+                
+                contexts = await self.context_blobs.get_many(db, [row.context_hash for row in rows])
+                records = [_log_record(row, contexts) for row in rows]
+                await _store_segment(db, LOGS_KIND, records, [row.timestamp for row in rows])
+                # Newer rows have higher ids and later timestamps, so the range holds exactly this batch
+                await db.execute(
+                    delete(ConversationLog)
+                    .where(
+                        ConversationLog.id >= rows[0].id,
+                        ConversationLog.id <= rows[-1].id,
+                        ConversationLog.timestamp < cutoff
+                    )
+                    .execution_options(synchronize_session=False)
+                )
+                await db.commit()
+                
+                result["logs_archived"] += len(rows)
+                result["segments_written"] += 1
+                if len(rows) < batch_size:
+                    return
+    
+    def get_stats(self) -> Dict:
+        return {**self.stats, "enabled": self.interval > 0, "last_run": self.last_run}
+
+
+async def _main():
+    start_log_output()
+    llm_service = LLMService()
+    try:
+        await MaintenanceJob(llm_service, ContextBlobStore(), UsageAnalytics()).run_once()
+    finally:
+        await llm_service.aclose()
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
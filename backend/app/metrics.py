@@ -0,0 +1,284 @@
+"""In-process metrics exposed in the Prometheus text format."""
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+import asyncio
+import bisect
+import time
+
+from app.logger import logger
+from app.tokens import count_tokens
+
+
+# Latency buckets in seconds, from sub-millisecond DB work up to slow LLM calls
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+LabelValues = Tuple[str, ...]
+# (name, "gauge" | "counter", help text, labels, value) produced by a collector
+Sample = Tuple[str, str, str, Dict[str, str], float]
+
+
+def _format_labels(names: Tuple[str, ...], values: LabelValues, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Counter:
+    """Monotonic counter with optional labels."""
+    
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._values: Dict[LabelValues, float] = {}
+    
+    def inc(self, amount: float = 1.0, *label_values: str) -> None:
+        self._values[label_values] = self._values.get(label_values, 0.0) + amount
+    
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for values, total in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, values)} {total}")
+        return lines
+
+
+class Histogram:
+    """Cumulative-bucket histogram with optional labels."""
+    
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        # Per label set: [count per bucket (+Inf last), sum]
+        self._series: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+    
+    def observe(self, value: float, *label_values: str) -> None:
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = ([0] * (len(self.buckets) + 1), [0.0])
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1][0] += value
+    
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for values, (counts, total) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, values, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, values)} {total[0]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, values)} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    Holds the application's counters and histograms.
+    
+    Point-in-time values owned by other components (cache sizes, pool usage,
+    breaker states) are pulled from registered collectors at scrape time.
+    """
+    
+    def __init__(self):
+        self._metrics = []
+        self._collectors: List[Callable[[], Iterator[Sample]]] = []
+    
+    def counter(self, name: str, help_text: str, labels: Tuple[str, ...] = ()) -> Counter:
+        metric = Counter(name, help_text, labels)
+        self._metrics.append(metric)
+        return metric
+    
+    def histogram(self, name: str, help_text: str, labels: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, help_text, labels, buckets)
+        self._metrics.append(metric)
+        return metric
+    
+    def register_collector(self, collector: Callable[[], Iterator[Sample]]) -> None:
+        """Register a callable yielding samples at scrape time."""
+        self._collectors.append(collector)
+    
+    def render(self) -> str:
+        """Render every metric in the Prometheus text exposition format."""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        
+        described = set()
+        for collector in self._collectors:
+            try:
+                samples = list(collector())
+            except Exception as e:
+                logger.error("Error collecting metrics: %s", e)
+                continue
+            for name, kind, help_text, labels, value in samples:
+                if name not in described:
+                    lines.append(f"# HELP {name} {help_text}")
+                    lines.append(f"# TYPE {name} {kind}")
+                    described.add(name)
+                names = tuple(labels)
+                lines.append(f"{name}{_format_labels(names, tuple(labels[n] for n in names))} {float(value)}")
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+stage_seconds = registry.histogram(
+    "smartadvisor_stage_seconds",
+    "Time spent in each stage of handling a query",
+    labels=("endpoint", "stage")
+)
+request_seconds = registry.histogram(
+    "smartadvisor_query_seconds",
+    "End-to-end query handling time",
+    labels=("endpoint",)
+)
+provider_tokens = registry.counter(
+    "smartadvisor_llm_tokens_total",
+    "Tokens reported by LLM providers",
+    labels=("provider", "model", "kind")
+)
+provider_requests = registry.counter(
+    "smartadvisor_llm_requests_total",
+    "Upstream LLM requests by outcome",
+    labels=("provider", "model", "outcome")
+)
+knowledge_retrieval_seconds = registry.histogram(
+    "smartadvisor_knowledge_retrieval_seconds",
+    "Time to retrieve knowledge chunks for a prompt",
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)
+)
+loop_lag_seconds = registry.histogram(
+    "smartadvisor_event_loop_lag_seconds",
+    "How late the event loop ran a periodic timer",
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+)
+
+
+def stats_samples(prefix: str, component, help_text: str) -> Iterator[Sample]:
+    """
+    Turn a component's `get_stats()` numbers into samples.
+    
+    Keys of the component's `stats` dict are running totals and become
+    counters; anything else `get_stats()` adds (sizes, ratios) is a gauge.
+    """
+    for key, value in component.get_stats().items():
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            continue
+        if key in component.stats:
+            yield f"smartadvisor_{prefix}_{key}_total", "counter", f"{help_text}: {key}", {}, value
+        else:
+            yield f"smartadvisor_{prefix}_{key}", "gauge", f"{help_text}: {key}", {}, value
+
+
+def backend_samples(router_stats: Dict) -> Iterator[Sample]:
+    """Per-backend latency, error rate and circuit state from `ProviderRouter.get_stats()`."""
+    for backend in router_stats["backends"]:
+        labels = {"provider": backend["provider"], "model": backend["model"]}
+        for quantile, key in (("0.5", "p50_seconds"), ("0.99", "p99_seconds")):
+            if backend[key] is not None:
+                yield ("smartadvisor_llm_backend_latency_seconds", "gauge",
+                       "Rolling upstream latency per backend", {**labels, "quantile": quantile}, backend[key])
+        yield ("smartadvisor_llm_backend_error_rate", "gauge",
+               "Rolling error rate per backend", labels, backend["error_rate"])
+        yield ("smartadvisor_llm_backend_circuit_open", "gauge",
+               "1 while the backend's circuit breaker rejects traffic", labels, backend["state"] == "open")
+
+
+def pool_samples(pool) -> Iterator[Sample]:
+    """Connection pool usage; pools without sizing (e.g. NullPool) report nothing."""
+    for key in ("size", "checkedin", "checkedout", "overflow"):
+        method = getattr(pool, key, None)
+        if callable(method):
+            yield f"smartadvisor_db_pool_{key}", "gauge", f"Database connection pool {key}", {}, method()
+
+
+class StageTimer:
+    """
+    Time the stages of one request.
+    
+    Each stage is observed in `smartadvisor_stage_seconds` and kept on the
+    timer so it can be stored with the request's audit row.
+    """
+    
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self.started = time.perf_counter()
+        self.timings: Dict[str, float] = {}
+    
+    @contextmanager
+    def stage(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started)
+    
+    def record(self, name: str, seconds: float) -> None:
+        self.timings[name] = self.timings.get(name, 0.0) + seconds
+        stage_seconds.observe(seconds, self.endpoint, name)
+    
+    def finish(self) -> float:
+        """Record the end-to-end time of the request."""
+        elapsed = time.perf_counter() - self.started
+        request_seconds.observe(elapsed, self.endpoint)
+        return elapsed
+    
+    def as_metadata(self) -> Dict[str, float]:
+        """Stage timings in milliseconds, for `ConversationLog.extra_metadata`."""
+        return {name: round(seconds * 1000, 2) for name, seconds in self.timings.items()}
+
+
+def turn_metadata(timer: StageTimer, model: str, messages: List[Dict], response_text: str) -> Dict:
+    """
+    Token counts (counted locally) and stage timings stored in `ConversationLog.extra_metadata`.
+    
+    Built while the `audit_log` stage is still running, so that stage is the
+    one the stored timings never include; it is still observed in
+    `smartadvisor_stage_seconds`.
+    """
+    return {
+        "model": model,
+        "prompt_tokens": sum(count_tokens(message["content"], model) for message in messages),
+        "completion_tokens": count_tokens(response_text, model),
+        "timings_ms": timer.as_metadata()
+    }
+
+
+class LoopLagMonitor:
+    """Measure event-loop lag by checking how late a periodic sleep wakes up."""
+    
+    def __init__(self, interval: float = 0.5):
+        self.interval = interval
+        self.last_lag = 0.0
+        self._task: Optional[asyncio.Task] = None
+    
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.last_lag = max(0.0, loop.time() - expected)
+            loop_lag_seconds.observe(self.last_lag)
+    
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
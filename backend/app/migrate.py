@@ -0,0 +1,80 @@
+"""One-shot data migrations for SmartAdvisor.
+
+Run from the backend directory with:
+
+    python -m app.migrate
+"""
+import asyncio
+
+from sqlalchemy import delete, inspect, text
+
+from app.context_blobs import ContextBlobStore, backfill_context_blobs
+from app.conversation_store import migrate_legacy_messages
+from app.logger import logger, start_log_output
+from app.models import Base, ConversationSession, init_db, engine, SessionLocal
+
+# Session id older versions used to store a context shared by all new sessions
+LEGACY_DEFAULT_SESSION_ID = "__default__"
+
+
+def _add_missing_columns(connection) -> None:
+    """Add nullable columns declared on the models but missing from existing tables."""
+    inspector = inspect(connection)
+    existing_tables = set(inspector.get_table_names())
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing_columns:
+                continue
+            if not column.nullable:
+                logger.warning("Cannot add NOT NULL column %s.%s in place", table.name, column.name)
+                continue
+            column_type = column.type.compile(dialect=connection.dialect)
+            connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+            logger.info("Added column %s.%s", table.name, column.name)
+
+
+async def upgrade_schema():
+    """Create missing tables and add missing nullable columns to existing ones."""
+    await init_db()
+    async with engine.begin() as conn:
+        await conn.run_sync(_add_missing_columns)
+
+
+async def run_migrations():
+    """Bring the schema up to date and migrate legacy data in place."""
+    await upgrade_schema()
+
+    async with SessionLocal() as db:
+        try:
+            migrated = await migrate_legacy_messages(db)
+            logger.info("Migrated message history for %s session(s)", migrated)
+
+            converted = await backfill_context_blobs(db, ContextBlobStore())
+            for table_name, count in converted.items():
+                logger.info("Moved %s inline context(s) of %s to context_blobs", count, table_name)
+
+            # Sessions no longer inherit a shared default context
+            removed = await db.execute(
+                delete(ConversationSession).where(ConversationSession.session_id == LEGACY_DEFAULT_SESSION_ID)
+            )
+            await db.commit()
+            if removed.rowcount:
+                logger.info("Removed the legacy shared default context session")
+        except Exception:
+            await db.rollback()
+            raise
+
+
+async def _main():
+    start_log_output()
+    try:
+        await run_migrations()
+    finally:
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
@@ -1,12 +1,24 @@
 """Database models for SmartAdvisor."""
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, JSON
+from sqlalchemy import Column, Integer, Float, String, Text, DateTime, JSON, UniqueConstraint, event, select, text, update
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from datetime import datetime
 from app.config import settings
 
 Base = declarative_base()
 
+# Bump whenever a table or column is added so workers re-run schema creation
+SCHEMA_VERSION = 9
+SCHEMA_VERSION_KEY = "schema"
+
+# Full-text index over conversation_logs.user_query/response: an external-content
+# FTS5 table on SQLite, a generated tsvector column with a GIN index on Postgres
+SEARCH_FTS_TABLE = "conversation_logs_fts"
+SEARCH_VECTOR_COLUMN = "search_vector"
+SEARCH_LANGUAGE = "english"
+
 
 class ConversationLog(Base):
     """Model for logging all conversations."""
@@ -14,8 +26,10 @@ class ConversationLog(Base):
     
     id = Column(Integer, primary_key=True, index=True)
     timestamp = Column(DateTime, default=datetime.utcnow, index=True)
+    inserted_at = Column(DateTime, default=datetime.utcnow, nullable=True)  # When the row was written, for settling rollups
     user_query = Column(Text, nullable=False)
-    context_used = Column(JSON, nullable=True)
+    context_used = Column(JSON, nullable=True)  # Legacy inline copy, superseded by context_hash
+    context_hash = Column(String, nullable=True)  # Key into context_blobs
     response = Column(Text, nullable=False)
     session_id = Column(String, index=True, nullable=True)
     user_id = Column(String, index=True, nullable=True)
@@ -41,27 +55,243 @@ class ConversationSession(Base):
     id = Column(Integer, primary_key=True, index=True)
     session_id = Column(String, unique=True, nullable=False, index=True)
     user_id = Column(String, index=True, nullable=True)
-    context = Column(JSON, nullable=True)
-    messages = Column(JSON, nullable=True)  # Store conversation history as JSON
+    context = Column(JSON, nullable=True)  # Legacy inline copy, superseded by context_hash
+    context_hash = Column(String, nullable=True)  # Key into context_blobs
+    messages = Column(JSON, nullable=True)  # Legacy history blob, superseded by conversation_messages
+    summary = Column(Text, nullable=True)  # Rolling summary of turns outside the history window
+    summary_seq = Column(Integer, nullable=True)  # Last message seq folded into the summary
+    next_seq = Column(Integer, nullable=True)  # Next free message seq; NULL until the first append
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
 
+class ConversationMessage(Base):
+    """Model for storing conversation history, one row per message."""
+    __tablename__ = "conversation_messages"
+    __table_args__ = (
+        # Doubles as the (session_id, seq) index used for ordered history reads
+        UniqueConstraint("session_id", "seq", name="uq_conversation_messages_session_seq"),
+    )
+    
+    id = Column(Integer, primary_key=True)
+    session_id = Column(String, nullable=False)
+    seq = Column(Integer, nullable=False)  # Position of the message within its session
+    role = Column(String, nullable=False)
+    content = Column(Text, nullable=False)
+    token_count = Column(Integer, nullable=True)  # Cached at write time for history budgeting
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+class KnowledgeDocument(Base):
+    """A document of the knowledge base; chunked and indexed on disk by `KnowledgeBase`."""
+    __tablename__ = "knowledge_documents"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    name = Column(String, unique=True, nullable=False, index=True)
+    content = Column(Text, nullable=False)
+    content_hash = Column(String(64), nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+class ContextBlob(Base):
+    """One distinct context, stored once and referenced by hash from sessions and audit rows."""
+    __tablename__ = "context_blobs"
+    
+    hash = Column(String(64), primary_key=True)  # sha256 of the canonical JSON
+    data = Column(JSON, nullable=False)
+    size = Column(Integer, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+class ArchiveSegment(Base):
+    """One compressed JSONL file of rows moved out of the database by maintenance."""
+    __tablename__ = "archive_segments"
+    
+    id = Column(Integer, primary_key=True)
+    kind = Column(String, nullable=False, index=True)  # Source table: conversation_logs or conversation_messages
+    path = Column(String, nullable=False)  # Relative to ARCHIVE_DIR
+    row_count = Column(Integer, nullable=False)
+    min_timestamp = Column(DateTime, nullable=True)
+    max_timestamp = Column(DateTime, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+class ArchivedSession(Base):
+    """Which archive segments hold rows of a session, so they can be read back by session."""
+    __tablename__ = "archived_sessions"
+    __table_args__ = (
+        UniqueConstraint("session_id", "segment_id", name="uq_archived_sessions_session_segment"),
+    )
+    
+    id = Column(Integer, primary_key=True)
+    session_id = Column(String, nullable=False)
+    segment_id = Column(Integer, nullable=False, index=True)
+    row_count = Column(Integer, nullable=False)
+
+
+class UsageRollup(Base):
+    """Hourly usage totals for one key of one dimension (total, preset or user), built from `conversation_logs`."""
+    __tablename__ = "usage_rollups"
+    __table_args__ = (
+        # Doubles as the (dimension, hour) index used for dashboard range reads
+        UniqueConstraint("dimension", "hour", "key", name="uq_usage_rollups_dimension_hour_key"),
+    )
+    
+    id = Column(Integer, primary_key=True)
+    dimension = Column(String, nullable=False)
+    hour = Column(DateTime, nullable=False)  # Start of the UTC hour
+    key = Column(String, nullable=False)  # Preset name or user id; "" for the total and for anonymous users
+    queries = Column(Integer, nullable=False, default=0)
+    latency_ms_sum = Column(Float, nullable=False, default=0.0)
+    latency_ms_min = Column(Float, nullable=True)  # NULL on rows rolled up before the minimum was kept
+    latency_ms_max = Column(Float, nullable=False, default=0.0)
+    latency_histogram = Column(JSON, nullable=False)  # Counts per LATENCY_BUCKETS_MS bucket (analytics.py)
+    prompt_tokens = Column(Integer, nullable=False, default=0)
+    completion_tokens = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+class CacheVersion(Base):
+    """Version counters bumped on writes so every worker can tell when its in-memory copy is stale."""
+    __tablename__ = "cache_versions"
+    
+    name = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
 # Database setup
-engine = create_engine(settings.database_url, connect_args={"check_same_thread": False} if "sqlite" in settings.database_url else {})
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+def _async_database_url(url: str) -> str:
+    """Map a configured DATABASE_URL onto its asyncio driver (aiosqlite / asyncpg)."""
+    if url.startswith("sqlite:"):
+        return url.replace("sqlite:", "sqlite+aiosqlite:", 1)
+    # Heroku still hands out the legacy postgres:// scheme
+    for prefix in ("postgres://", "postgresql://", "postgresql+psycopg2://"):
+        if url.startswith(prefix):
+            return "postgresql+asyncpg://" + url[len(prefix):]
+    return url
+
+
+def _create_engine():
+    """Create the async engine with a pool sized for the configured backend."""
+    url = _async_database_url(settings.database_url)
+    
+    if url.startswith("sqlite"):
+        if ":memory:" in url or url.endswith("sqlite+aiosqlite://"):
+            return create_async_engine(url)
+        # aiosqlite defaults to NullPool, which opens a connection thread per
+        # request; keep a small pool of long-lived connections instead.
+        sqlite_engine = create_async_engine(
+            url,
+            poolclass=AsyncAdaptedQueuePool,
+            pool_size=settings.db_pool_size,
+            max_overflow=settings.db_max_overflow,
+            connect_args={"timeout": settings.db_pool_timeout}
+        )
+        
+        @event.listens_for(sqlite_engine.sync_engine, "connect")
+        def _set_sqlite_pragmas(dbapi_connection, connection_record):
+            # WAL lets readers proceed while a writer commits
+            cursor = dbapi_connection.cursor()
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA synchronous=NORMAL")
+            cursor.close()
+        
+        return sqlite_engine
+    
+    return create_async_engine(
+        url,
+        pool_size=settings.db_pool_size,
+        max_overflow=settings.db_max_overflow,
+        pool_timeout=settings.db_pool_timeout,
+        pool_recycle=settings.db_pool_recycle,
+        pool_pre_ping=True
+    )
 
 
-def init_db():
-    """Initialize the database tables."""
-    Base.metadata.create_all(bind=engine)
+engine = _create_engine()
+SessionLocal = sessionmaker(bind=engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
 
 
-def get_db():
-    """Get database session."""
-    db = SessionLocal()
+def _create_search_index(connection) -> None:
+    """Create the full-text index over conversation_logs if it does not exist yet."""
+    dialect = connection.dialect.name
+    if dialect == "sqlite":
+        exists = connection.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+            {"name": SEARCH_FTS_TABLE}
+        ).first()
+        if exists:
+            return
+        connection.execute(text(
+            f"CREATE VIRTUAL TABLE {SEARCH_FTS_TABLE} USING fts5("
+            "user_query, response, content='conversation_logs', content_rowid='id', "
+            "tokenize='porter unicode61')"
+        ))
+        # Triggers keep the index in step with every insert, update and delete
+        connection.execute(text(
+            f"CREATE TRIGGER {SEARCH_FTS_TABLE}_ai AFTER INSERT ON conversation_logs BEGIN "
+            f"INSERT INTO {SEARCH_FTS_TABLE}(rowid, user_query, response) "
+            "VALUES (new.id, new.user_query, new.response); END"
+        ))
+        connection.execute(text(
+            f"CREATE TRIGGER {SEARCH_FTS_TABLE}_ad AFTER DELETE ON conversation_logs BEGIN "
+            f"INSERT INTO {SEARCH_FTS_TABLE}({SEARCH_FTS_TABLE}, rowid, user_query, response) "
+            "VALUES ('delete', old.id, old.user_query, old.response); END"
+        ))
+        connection.execute(text(
+            f"CREATE TRIGGER {SEARCH_FTS_TABLE}_au AFTER UPDATE OF user_query, response ON conversation_logs BEGIN "
+            f"INSERT INTO {SEARCH_FTS_TABLE}({SEARCH_FTS_TABLE}, rowid, user_query, response) "
+            "VALUES ('delete', old.id, old.user_query, old.response); "
+            f"INSERT INTO {SEARCH_FTS_TABLE}(rowid, user_query, response) "
+            "VALUES (new.id, new.user_query, new.response); END"
+        ))
+        # Index rows written before the index existed
+        connection.execute(text(f"INSERT INTO {SEARCH_FTS_TABLE}({SEARCH_FTS_TABLE}) VALUES ('rebuild')"))
+    elif dialect == "postgresql":
+        # Needs PostgreSQL 12+; adding the column computes it for existing rows once
+        connection.execute(text(
+            f"ALTER TABLE conversation_logs ADD COLUMN IF NOT EXISTS {SEARCH_VECTOR_COLUMN} tsvector "
+            f"GENERATED ALWAYS AS (to_tsvector('{SEARCH_LANGUAGE}', "
+            "coalesce(user_query, '') || ' ' || coalesce(response, ''))) STORED"
+        ))
+        connection.execute(text(
+            f"CREATE INDEX IF NOT EXISTS ix_conversation_logs_{SEARCH_VECTOR_COLUMN} "
+            f"ON conversation_logs USING GIN ({SEARCH_VECTOR_COLUMN})"
+        ))
+
+
+async def init_db():
+    """Initialize the database tables and record the schema version they match."""
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(_create_search_index)
+        result = await conn.execute(
+            update(CacheVersion)
+            .where(CacheVersion.name == SCHEMA_VERSION_KEY)
+            .values(version=SCHEMA_VERSION, updated_at=datetime.utcnow())
+        )
+        if result.rowcount == 0:
+            await conn.execute(
+                CacheVersion.__table__.insert().values(name=SCHEMA_VERSION_KEY, version=SCHEMA_VERSION)
+            )
+
+
+async def schema_is_current() -> bool:
+    """Whether `init_db` (or `python -m app.migrate`) already created this schema version."""
     try:
-        yield db
-    finally:
-        db.close()
+        async with engine.connect() as conn:
+            version = await conn.scalar(
+                select(CacheVersion.version).where(CacheVersion.name == SCHEMA_VERSION_KEY)
+            )
+    except Exception:
+        # Fresh database: cache_versions does not exist yet
+        return False
+    return version == SCHEMA_VERSION
+
 
+async def get_db():
+    """Get database session."""
+    async with SessionLocal() as db:
+        yield db
@@ -0,0 +1,137 @@
+"""In-memory registry of context presets, kept in sync across workers."""
+from datetime import datetime
+from typing import Dict, Optional
+import asyncio
+import hashlib
+import json
+
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.logger import logger
+from app.models import CacheVersion, ContextPreset, SessionLocal
+
+
+# Row in `cache_versions` bumped whenever a preset is written
+PRESETS_VERSION_KEY = "presets"
+
+
+def _serialize(preset: ContextPreset) -> Dict:
+    return {
+        "id": preset.id,
+        "name": preset.name,
+        "description": preset.description,
+        "context_data": preset.context_data,
+        "created_at": preset.created_at.isoformat() if preset.created_at else None,
+        "updated_at": preset.updated_at.isoformat() if preset.updated_at else None
+    }
+
+
+class PresetRegistry:
+    """
+    Serve context presets from memory.
+    
+    Presets are loaded once and the `GET /api/presets` body is rendered once
+    per load, with an ETag for conditional requests. Writers bump the
+    `presets` row of `cache_versions` in the same transaction; every worker
+    polls that row and reloads when it changes. A lookup that misses also
+    checks the version, so a preset created on another worker can be
+    applied before the next poll.
+    """
+    
+    def __init__(self, poll_interval: float = 5.0):
+        self.poll_interval = poll_interval
+        self.version: Optional[int] = None
+        self.body = b"[]"
+        self.etag = '"empty"'
+        self._by_name: Dict[str, Dict] = {}
+        self._reload_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"reloads": 0, "hits": 0, "misses": 0, "not_modified": 0}
+    
+    @staticmethod
+    async def _read_version(db: AsyncSession) -> int:
+        version = await db.scalar(
+            select(CacheVersion.version).where(CacheVersion.name == PRESETS_VERSION_KEY)
+        )
+        return version or 0
+    
+    async def load(self, db: AsyncSession) -> None:
+        """(Re)load every preset from the database."""
+        # Read the version first: a write landing in between only causes an extra reload
+        version = await self._read_version(db)
+        result = await db.execute(select(ContextPreset).order_by(ContextPreset.id))
+        presets = [_serialize(preset) for preset in result.scalars().all()]
+        
+        body = json.dumps(presets).encode("utf-8")
+        self._by_name = {preset["name"]: preset for preset in presets}
+        self.body = body
+        self.etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+        self.version = version
+        self.stats["reloads"] += 1
+    
+    async def refresh(self, db: AsyncSession) -> bool:
+        """Reload if another writer bumped the version; returns True when reloaded."""
+        async with self._reload_lock:
+            if await self._read_version(db) == self.version:
+                return False
+            await self.load(db)
+            return True
+    
+    async def bump(self, db: AsyncSession) -> None:
+        """Mark presets as changed; call inside the transaction that writes them."""
+        result = await db.execute(
+            update(CacheVersion)
+            .where(CacheVersion.name == PRESETS_VERSION_KEY)
+            .values(version=CacheVersion.version + 1, updated_at=datetime.utcnow())
+        )
+        if result.rowcount == 0:
+            db.add(CacheVersion(name=PRESETS_VERSION_KEY, version=1))
+    
+    def __len__(self) -> int:
+        return len(self._by_name)
+    
+    async def lookup(self, db: AsyncSession, name: str) -> Optional[Dict]:
+        """Find a preset by name, checking for newer presets on a miss."""
+        preset = self._by_name.get(name)
+        if preset is None and await self.refresh(db):
+            preset = self._by_name.get(name)
+        self.stats["hits" if preset is not None else "misses"] += 1
+        return preset
+    
+    def not_modified(self, if_none_match: Optional[str]) -> bool:
+        """Whether an `If-None-Match` header matches the current ETag."""
+        if not if_none_match:
+            return False
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        matched = "*" in tags or any(tag.removeprefix("W/") == self.etag for tag in tags)
+        if matched:
+            self.stats["not_modified"] += 1
+        return matched
+    
+    async def _poll(self) -> None:
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                async with SessionLocal() as db:
+                    if await self.refresh(db):
+                        logger.info("Reloaded presets (version %s)", self.version)
+            except Exception as e:
+                logger.error("Error polling preset version: %s", e)
+    
+    def start(self) -> None:
+        if self._task is None and self.poll_interval > 0:
+            self._task = asyncio.create_task(self._poll())
+    
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+    
+    def get_stats(self) -> Dict:
+        return {**self.stats, "presets": len(self._by_name), "version": self.version or 0}
@@ -0,0 +1,54 @@
+"""Token-bucket rate limiting."""
+import asyncio
+import time
+
+
+class TokenBucket:
+    """
+    Token bucket refilled at `rate` tokens per second, holding at most `capacity`.
+    
+    A rate of 0 or less disables limiting.
+    """
+    
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = max(capacity, 1.0)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+    
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0
+    
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+    
+    def try_acquire(self, tokens: float = 1.0) -> float:
+        """
+        Take tokens if available.
+        
+        Returns:
+            0 if the tokens were taken, otherwise the seconds until they will be available
+        """
+        if not self.enabled:
+            return 0.0
+        self._refill()
+        if self._tokens >= tokens:
+            self._tokens -= tokens
+            return 0.0
+        return (tokens - self._tokens) / self.rate
+    
+    def refund(self, tokens: float = 1.0) -> None:
+        """Give back tokens taken for work that was not done."""
+        self._refill()
+        self._tokens = min(self.capacity, self._tokens + tokens)
+    
+    async def acquire(self, tokens: float = 1.0) -> None:
+        """Wait until tokens are available, then take them."""
+        while True:
+            wait = self.try_acquire(tokens)
+            if not wait:
+                return
+            await asyncio.sleep(wait)
@@ -0,0 +1,204 @@
+"""Response cache that sits in front of the LLM provider."""
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+import asyncio
+import hashlib
+import json
+import math
+import re
+import sqlite3
+import threading
+import time
+
+from app.config import settings
+
+
+_WORD_RE = re.compile(r"\w+")
+
+
+def canonical_request_hash(messages: List[Dict[str, str]], model: str,
+                           temperature: float, max_tokens: Optional[int]) -> str:
+    """Hash a chat request so that byte-identical prompts map to the same key."""
+    payload = json.dumps(
+        {"model": model, "temperature": temperature, "max_tokens": max_tokens, "messages": messages},
+        sort_keys=True, separators=(",", ":"), ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def embed_text(text: str, dims: int = 256) -> List[float]:
+    """
+    Compute a local, dependency-free embedding of a text.
+
+    Words and character trigrams are feature-hashed into a signed vector and
+    L2-normalized, so the dot product of two embeddings is their cosine similarity.
+    """
+    vector = [0.0] * dims
+    for word in _WORD_RE.findall(text.lower()):
+        padded = f"#{word}#"
+        features = [word] + [padded[i:i + 3] for i in range(len(padded) - 2)]
+        for feature in features:
+            digest = int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "little")
+            vector[digest % dims] += 1.0 if (digest >> 63) else -1.0
+    norm = math.sqrt(sum(value * value for value in vector))
+    if norm:
+        vector = [value / norm for value in vector]
+    return vector
+
+
+class _DiskTier:
+    """Shared SQLite-backed cache tier, usable by several workers on one host."""
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=5)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS response_cache "
+            "(key TEXT PRIMARY KEY, response TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    def get(self, key: str) -> Optional[Tuple[str, float]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response, expires_at FROM response_cache WHERE key = ? AND expires_at > ?",
+                (key, time.time())
+            ).fetchone()
+        return row
+
+    def set(self, key: str, response: str, expires_at: float) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO response_cache (key, response, expires_at) VALUES (?, ?, ?)",
+                (key, response, expires_at)
+            )
+            self._writes += 1
+            # Expired rows are only ever skipped on read; sweep them periodically
+            if self._writes % 500 == 0:
+                self._conn.execute("DELETE FROM response_cache WHERE expires_at <= ?", (time.time(),))
+            self._conn.commit()
+
+
+class ResponseCache:
+    """
+    Tiered cache of LLM responses.
+
+    Tiers are checked in order:
+    1. In-process LRU keyed by the canonical request hash, with a TTL.
+    2. Optional SQLite file shared between workers (RESPONSE_CACHE_DB_PATH).
+    3. Optional near-duplicate tier: requests that share everything except the
+       final user message match when that message's embedding is within
+       RESPONSE_CACHE_SEMANTIC_THRESHOLD cosine similarity.
+    """
+
+    def __init__(self):
+        self.enabled = settings.response_cache_enabled
+        self.max_entries = settings.response_cache_max_entries
+        self.ttl = settings.response_cache_ttl
+        self.semantic_threshold = settings.response_cache_semantic_threshold
+
+        self._entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        # scope hash -> list of (expires_at, embedding, response)
+        self._semantic: "OrderedDict[str, List[Tuple[float, List[float], str]]]" = OrderedDict()
+        self._disk = _DiskTier(settings.response_cache_db_path) if settings.response_cache_db_path else None
+
+        self.stats = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "semantic_hits": 0,
+            "misses": 0,
+            "bypassed": 0,
+            "stores": 0,
+            "evictions": 0
+        }
+
+    def _remember(self, key: str, expires_at: float, response: str) -> None:
+        self._entries[key] = (expires_at, response)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    @staticmethod
+    def _semantic_scope(messages: List[Dict[str, str]], model: str,
+                        temperature: float, max_tokens: Optional[int]) -> str:
+        return canonical_request_hash(messages[:-1], model, temperature, max_tokens)
+
+    async def get(self, messages: List[Dict[str, str]], model: str,
+                  temperature: float, max_tokens: Optional[int]) -> Optional[str]:
+        """Look up a cached response for a request, or None on a miss."""
+        now = time.time()
+        key = canonical_request_hash(messages, model, temperature, max_tokens)
+
+        entry = self._entries.get(key)
+        if entry:
+            if entry[0] > now:
+                self._entries.move_to_end(key)
+                self.stats["memory_hits"] += 1
+                return entry[1]
+            del self._entries[key]
+
+        if self._disk:
+            row = await asyncio.to_thread(self._disk.get, key)
+            if row:
+                response, expires_at = row
+                self._remember(key, expires_at, response)
+                self.stats["disk_hits"] += 1
+                return response
+
+        if self.semantic_threshold and messages:
+            scope = self._semantic_scope(messages, model, temperature, max_tokens)
+            candidates = self._semantic.get(scope)
+            if candidates:
+                query_vector = embed_text(messages[-1]["content"])
+                live = [candidate for candidate in candidates if candidate[0] > now]
+                self._semantic[scope] = live
+                best_score, best_response = 0.0, None
+                for _, vector, response in live:
+                    score = sum(a * b for a, b in zip(query_vector, vector))
+                    if score > best_score:
+                        best_score, best_response = score, response
+                if best_response is not None and best_score >= self.semantic_threshold:
+                    self.stats["semantic_hits"] += 1
+                    return best_response
+
+        self.stats["misses"] += 1
+        return None
+
+    async def set(self, messages: List[Dict[str, str]], model: str,
+                  temperature: float, max_tokens: Optional[int], response: str) -> None:
+        """Store a response for a request in every enabled tier."""
+        expires_at = time.time() + self.ttl
+        key = canonical_request_hash(messages, model, temperature, max_tokens)
+        self._remember(key, expires_at, response)
+        self.stats["stores"] += 1
+
+        if self._disk:
+            await asyncio.to_thread(self._disk.set, key, response, expires_at)
+
+        if self.semantic_threshold and messages:
+            scope = self._semantic_scope(messages, model, temperature, max_tokens)
+            candidates = self._semantic.setdefault(scope, [])
+            candidates.append((expires_at, embed_text(messages[-1]["content"]), response))
+            # Bound both the number of scopes and the candidates scanned per lookup
+            del candidates[:-settings.response_cache_semantic_scope_size]
+            self._semantic.move_to_end(scope)
+            while len(self._semantic) > self.max_entries:
+                self._semantic.popitem(last=False)
+
+    def record_bypass(self) -> None:
+        """Count a request that skipped the cache on purpose."""
+        self.stats["bypassed"] += 1
+
+    def get_stats(self) -> Dict:
+        """Hit/miss counters plus current tier sizes."""
+        lookups = sum(self.stats[name] for name in ("memory_hits", "disk_hits", "semantic_hits", "misses"))
+        hits = lookups - self.stats["misses"]
+        return {
+            **self.stats,
+            "enabled": self.enabled,
+            "entries": len(self._entries),
+            "hit_ratio": round(hits / lookups, 4) if lookups else 0.0
+        }
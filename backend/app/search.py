@@ -0,0 +1,166 @@
+"""Full-text search over the audit log (`conversation_logs`)."""
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+import html
+import re
+
+from sqlalchemy import DateTime, bindparam, text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.models import SEARCH_FTS_TABLE, SEARCH_LANGUAGE, SEARCH_VECTOR_COLUMN
+
+SORT_RELEVANCE = "relevance"
+SORT_RECENT = "recent"
+
+HIGHLIGHT_START = "<mark>"
+HIGHLIGHT_STOP = "</mark>"
+# The database marks matches with control characters; `_highlight` escapes the
+# text around them as HTML and only then turns them into the tags above
+_MATCH_START = "\x02"
+_MATCH_STOP = "\x03"
+
+_TERM_PATTERN = re.compile(r"(\w+)(\*?)", re.UNICODE)
+
+
+class SearchQueryError(ValueError):
+    """The search text has no terms to match."""
+
+
+def _fts5_query(query: str) -> str:
+    """
+    Turn free text into an FTS5 query matching rows that contain every term.
+    
+    Terms are quoted, so operators and punctuation typed by users are matched
+    as text rather than parsed as FTS5 syntax. A trailing `*` on a term keeps
+    prefix matching.
+    """
+    terms = [f'"{match.group(1)}"{match.group(2)}' for match in _TERM_PATTERN.finditer(query)]
+    if not terms:
+        raise SearchQueryError("Search query has no searchable terms")
+    return " ".join(terms)
+
+
+def _naive_utc(value: datetime) -> datetime:
+    # Log timestamps are stored as naive UTC
+    if value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def _filters(session_id: Optional[str], user_id: Optional[str], start: Optional[datetime],
+             end: Optional[datetime], params: Dict) -> str:
+    clauses = []
+    if session_id:
+        clauses.append("l.session_id = :session_id")
+        params["session_id"] = session_id
+    if user_id:
+        clauses.append("l.user_id = :user_id")
+        params["user_id"] = user_id
+    if start:
+        clauses.append("l.timestamp >= :start")
+        params["start"] = _naive_utc(start)
+    if end:
+        clauses.append("l.timestamp < :end")
+        params["end"] = _naive_utc(end)
+    return "".join(f" AND {clause}" for clause in clauses)
+
+
+def _highlight(snippet: Optional[str]) -> Optional[str]:
+    """HTML-escape a snippet, then wrap its matches in `<mark>` tags."""
+    if snippet is None:
+        return None
+    return html.escape(snippet).replace(_MATCH_START, HIGHLIGHT_START).replace(_MATCH_STOP, HIGHLIGHT_STOP)
+
+
+def _sqlite_statement(filters: str, sort: str) -> str:
+    order = "rank" if sort == SORT_RELEVANCE else "l.id DESC"
+    # bm25() weights: a match in the question counts double one in the answer
+    return (
+        "SELECT l.id, l.timestamp, l.session_id, l.user_id, "
+        f"snippet({SEARCH_FTS_TABLE}, 0, '{_MATCH_START}', '{_MATCH_STOP}', '…', 16) AS query_snippet, "
+        f"snippet({SEARCH_FTS_TABLE}, 1, '{_MATCH_START}', '{_MATCH_STOP}', '…', 24) AS response_snippet, "
+        f"bm25({SEARCH_FTS_TABLE}, 2.0, 1.0) AS rank "
+        f"FROM {SEARCH_FTS_TABLE} JOIN conversation_logs l ON l.id = {SEARCH_FTS_TABLE}.rowid "
+        f"WHERE {SEARCH_FTS_TABLE} MATCH :query{filters} "
+        f"ORDER BY {order} LIMIT :limit OFFSET :offset"
+    )
+
+
+def _postgres_statement(filters: str, sort: str) -> str:
+    order = "rank DESC" if sort == SORT_RELEVANCE else "id DESC"
+    options = f"StartSel={_MATCH_START}, StopSel={_MATCH_STOP}, MaxWords=24, MinWords=8"
+    # Headlines are costly, so they are built only for the rows of the page
+    return (
+        "SELECT page.id, page.timestamp, page.session_id, page.user_id, "
+        f"ts_headline('{SEARCH_LANGUAGE}', page.user_query, page.tsq, '{options}') AS query_snippet, "
+        f"ts_headline('{SEARCH_LANGUAGE}', page.response, page.tsq, '{options}') AS response_snippet, "
+        "page.rank "
+        "FROM ("
+        "SELECT l.id, l.timestamp, l.session_id, l.user_id, l.user_query, l.response, q.tsq, "
+        f"ts_rank_cd(l.{SEARCH_VECTOR_COLUMN}, q.tsq) AS rank "
+        f"FROM conversation_logs l, websearch_to_tsquery('{SEARCH_LANGUAGE}', :query) AS q(tsq) "
+        f"WHERE l.{SEARCH_VECTOR_COLUMN} @@ q.tsq{filters} "
+        f"ORDER BY {order} LIMIT :limit OFFSET :offset"
+        f") AS page ORDER BY page.{order}"
+    )
+
+
+async def search_conversations(db: AsyncSession, query: str, session_id: Optional[str] = None,
+                               user_id: Optional[str] = None, start: Optional[datetime] = None,
+                               end: Optional[datetime] = None, sort: str = SORT_RELEVANCE,
+                               offset: int = 0, limit: int = 20) -> Dict:
+    """
+    Search questions and answers in the audit log through the full-text index.
+    
+    Args:
+        db: Database session
+        query: Free text; every term must match
+        session_id: Only rows of this session
+        user_id: Only rows of this user
+        start: Only rows at or after this time
+        end: Only rows before this time
+        sort: "relevance" (best match first) or "recent" (newest first)
+        offset: Number of results to skip
+        limit: Maximum number of results
+    
+    Returns:
+        Dictionary with the page of 'results' and 'has_more'. Matches are not
+        counted, which would mean visiting every one of them.
+    
+    Raises:
+        SearchQueryError: If the query has no searchable terms
+    """
+    dialect = db.bind.dialect.name
+    if dialect == "sqlite":
+        match = _fts5_query(query)
+    elif not _TERM_PATTERN.search(query):
+        raise SearchQueryError("Search query has no searchable terms")
+    else:
+        match = query
+    
+    # One extra row tells whether another page exists
+    params = {"query": match, "limit": limit + 1, "offset": offset}
+    filters = _filters(session_id, user_id, start, end, params)
+    if dialect == "sqlite":
+        statement = _sqlite_statement(filters, sort)
+    elif dialect == "postgresql":
+        statement = _postgres_statement(filters, sort)
+    else:
+        raise NotImplementedError(f"Full-text search is not supported on {dialect}")
+    
+    typed = [bindparam(name, type_=DateTime) for name in ("start", "end") if name in params]
+    statement = text(statement).bindparams(*typed).columns(timestamp=DateTime)
+    rows = (await db.execute(statement, params)).mappings().all()
+    results: List[Dict] = []
+    for row in rows[:limit]:
+        results.append({
+            "id": row["id"],
+            "timestamp": row["timestamp"].isoformat() if row["timestamp"] else None,
+            "session_id": row["session_id"],
+            "user_id": row["user_id"],
+            "query_snippet": _highlight(row["query_snippet"]),
+            "response_snippet": _highlight(row["response_snippet"]),
+            # bm25() is lower-is-better; flip it so higher always means a better match
+            "score": round(-row["rank"] if dialect == "sqlite" else row["rank"], 6)
+        })
+    return {"results": results, "has_more": len(rows) > limit}
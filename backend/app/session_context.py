@@ -0,0 +1,111 @@
+"""Per-session business context with an in-memory LRU and write-through to the database."""
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+import time
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import settings
+from app.context_blobs import ContextBlobStore
+from app.models import ConversationSession
+
+
+class SessionContextStore:
+    """
+    Resolve business context per conversation session.
+
+    The database (`ConversationSession.context_hash`, resolved through
+    `context_blobs`) is the source of truth, so every worker sees the same
+    contexts. Each worker keeps recently used contexts in a bounded LRU;
+    entries expire after `context_cache_ttl` seconds so updates made by
+    other workers are picked up.
+
+    There is no shared default: a new session starts with an empty context,
+    so a change to one session never leaks into another.
+    """
+
+    def __init__(self, blobs: ContextBlobStore):
+        self.blobs = blobs
+        self.max_entries = settings.context_cache_size
+        self.ttl = settings.context_cache_ttl
+        self._entries: "OrderedDict[str, Tuple[float, Dict]]" = OrderedDict()
+
+    def _cached(self, key: str) -> Optional[Dict]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def remember(self, session_id: str, context: Optional[Dict]) -> None:
+        """Cache a context that the caller has already written to the database."""
+        self._entries[session_id] = (time.monotonic() + self.ttl, dict(context or {}))
+        self._entries.move_to_end(session_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def forget(self, session_id: str) -> None:
+        """Drop a session from the cache, e.g. after it is deleted."""
+        self._entries.pop(session_id, None)
+
+    async def _load_session(self, db: AsyncSession, key: str) -> Optional[ConversationSession]:
+        result = await db.execute(
+            select(ConversationSession).where(ConversationSession.session_id == key)
+        )
+        return result.scalars().first()
+
+    async def get(self, db: AsyncSession, session_id: Optional[str] = None) -> Dict:
+        """
+        Get the context for a session.
+
+        No session, or one that does not exist yet, resolves to the empty
+        context new sessions are created with.
+        """
+        if not session_id:
+            return {}
+        cached = self._cached(session_id)
+        if cached is not None:
+            return dict(cached)
+
+        session = await self._load_session(db, session_id)
+        if session is None:
+            return {}
+
+        context = await self.blobs.session_context(db, session)
+        self.remember(session_id, context)
+        return dict(context)
+
+    async def set(self, db: AsyncSession, session_id: str, context: Dict,
+                  merge: bool = True) -> Dict:
+        """
+        Update a session's context and persist it, creating the session if needed.
+
+        Args:
+            db: Database session
+            session_id: Session to update
+            context: Dictionary containing context information
+            merge: If True, merge with existing context. If False, replace.
+
+        Returns:
+            The resulting context
+        """
+        session = await self._load_session(db, session_id)
+        if session is None:
+            current = {}
+            session = ConversationSession(session_id=session_id)
+            db.add(session)
+        else:
+            current = await self.blobs.session_context(db, session)
+
+        new_context = {**current, **context} if merge else dict(context)
+        await self.blobs.assign(session, new_context)
+        session.updated_at = datetime.utcnow()
+        await db.commit()
+
+        self.remember(session_id, new_context)
+        return dict(new_context)
@@ -0,0 +1,103 @@
+"""Single-flight deduplication of identical in-flight calls."""
+from typing import AsyncIterator, Callable, Dict, List, Optional
+import asyncio
+
+
+class _Flight:
+    """One upstream call and the fragments it has produced so far."""
+    
+    def __init__(self):
+        self.fragments: List[str] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.task: Optional[asyncio.Task] = None
+        self._changed = asyncio.Event()
+    
+    def publish(self) -> None:
+        """Wake every subscriber waiting for the next fragment or the end."""
+        self._changed.set()
+        self._changed = asyncio.Event()
+    
+    async def follow(self) -> AsyncIterator[str]:
+        index = 0
+        while True:
+            while index < len(self.fragments):
+                yield self.fragments[index]
+                index += 1
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            await self._changed.wait()
+
+
+class SingleFlight:
+    """
+    Share one upstream call between concurrent callers with the same key.
+    
+    The upstream call runs in its own task, so it keeps going for the
+    remaining callers when the one that started it disconnects, and it is
+    cancelled once nobody is listening. Late joiners replay the fragments
+    produced so far and then follow along live.
+    """
+    
+    def __init__(self):
+        self._flights: Dict[str, _Flight] = {}
+        self.stats = {"upstream_calls": 0, "coalesced_calls": 0}
+    
+    async def _run(self, key: str, flight: _Flight, produce: Callable[[], AsyncIterator[str]]) -> None:
+        try:
+            async for fragment in produce():
+                flight.fragments.append(fragment)
+                flight.publish()
+        except Exception as e:
+            flight.error = e
+        finally:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            flight.done = True
+            flight.publish()
+    
+    async def stream(self, key: str, produce: Callable[[], AsyncIterator[str]]) -> AsyncIterator[str]:
+        """
+        Yield the fragments of the in-flight call for `key`, starting one with `produce` if needed.
+        
+        Args:
+            key: Identity of the call, e.g. a canonical request hash
+            produce: Starts the upstream call and yields its fragments
+        """
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self._flights[key] = _Flight()
+            flight.task = asyncio.create_task(self._run(key, flight, produce))
+            self.stats["upstream_calls"] += 1
+        else:
+            self.stats["coalesced_calls"] += 1
+        
+        flight.subscribers += 1
+        try:
+            async for fragment in flight.follow():
+                yield fragment
+        finally:
+            flight.subscribers -= 1
+            if not flight.subscribers and not flight.done:
+                # Nobody is waiting for the result any more
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+                flight.task.cancel()
+    
+    async def call(self, key: str, produce: Callable[[], AsyncIterator[str]]) -> str:
+        """Like `stream`, but wait for the whole result."""
+        fragments = []
+        stream = self.stream(key, produce)
+        try:
+            async for fragment in stream:
+                fragments.append(fragment)
+        finally:
+            # Leave the flight right away if this caller is cancelled
+            await stream.aclose()
+        return "".join(fragments)
+    
+    def get_stats(self) -> Dict:
+        return {**self.stats, "in_flight": len(self._flights)}
@@ -0,0 +1,83 @@
+"""Startup step timing and readiness tracking."""
+from contextlib import contextmanager
+from typing import Dict, Set
+import time
+
+# Longest wait between retries of a failed background step, in seconds
+STEP_RETRY_MAX_DELAY = 30.0
+
+
+class StartupProfile:
+    """
+    Time the steps of bringing a worker up and track when it can take traffic.
+    
+    `mark` records the time since the previous mark (used for import
+    phases); `step` times a block. Steps started with `begin` keep the
+    worker out of readiness until `done` is called for them; a step that
+    failed stays pending, with its last error in `failures`, until it succeeds.
+    """
+    
+    def __init__(self):
+        self.started = time.perf_counter()
+        self._last_mark = self.started
+        self.steps: Dict[str, float] = {}
+        self.pending: Set[str] = set()
+        self.failures: Dict[str, str] = {}
+        self.ready_after: float = 0.0
+        self.startup_complete = False
+    
+    def mark(self, name: str) -> None:
+        now = time.perf_counter()
+        self.steps[name] = now - self._last_mark
+        self._last_mark = now
+    
+    @contextmanager
+    def step(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.steps[name] = self.steps.get(name, 0.0) + time.perf_counter() - started
+    
+    def begin(self, name: str) -> None:
+        self.pending.add(name)
+    
+    def fail(self, name: str, error: Exception) -> None:
+        """Record a failed attempt of a background step; it stays pending."""
+        self.failures[name] = str(error)
+    
+    def done(self, name: str) -> bool:
+        """Finish a background step; returns True if the worker just became ready."""
+        self.pending.discard(name)
+        self.failures.pop(name, None)
+        return self._check_ready()
+    
+    def complete_startup(self) -> bool:
+        """Called once the startup hook has finished; background steps may still be pending."""
+        self.startup_complete = True
+        return self._check_ready()
+    
+    def _check_ready(self) -> bool:
+        if not self.ready or self.ready_after:
+            return False
+        self.ready_after = time.perf_counter() - self.started
+        return True
+    
+    @property
+    def ready(self) -> bool:
+        return self.startup_complete and not self.pending
+    
+    def as_metadata(self) -> Dict[str, float]:
+        """Step timings in milliseconds."""
+        return {name: round(seconds * 1000, 2) for name, seconds in self.steps.items()}
+    
+    def report(self) -> str:
+        """One line per step, slowest first, for profile mode."""
+        lines = [f"Worker ready after {self.ready_after * 1000:.1f} ms"]
+        for name, seconds in sorted(self.steps.items(), key=lambda item: item[1], reverse=True):
+            lines.append(f"  {name:<24} {seconds * 1000:9.1f} ms")
+        return "\n".join(lines)
+
+
+# Imported first by main.py so the import phases that follow are measured
+startup_profile = StartupProfile()
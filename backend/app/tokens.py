@@ -0,0 +1,76 @@
+"""Local token counting for prompt budgeting."""
+from functools import lru_cache
+from typing import Dict, Optional
+import math
+
+from app.config import settings
+from app.logger import logger
+
+try:
+    import tiktoken
+except ImportError:  # Optional: fall back to a character-based estimate
+    tiktoken = None
+
+
+# Chat formats add a few tokens of framing per message
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+@lru_cache(maxsize=32)
+def _encoding_for(model: str):
+    """The tiktoken encoding for a model, or None for the character estimate; failures are cached too."""
+    if tiktoken is None:
+        return None
+    # OpenRouter model ids are namespaced, e.g. "openai/gpt-3.5-turbo"
+    model_name = model.split("/")[-1]
+    try:
+        try:
+            return tiktoken.encoding_for_model(model_name)
+        except KeyError:
+            # Not an OpenAI model (e.g. Ollama): cl100k_base is a close estimate
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        # Encodings are downloaded on first use; stay usable offline
+        logger.warning("No tiktoken encoding for %s, estimating tokens from length: %s", model, e)
+        return None
+
+
+def load_encodings(*models: Optional[str]) -> None:
+    """
+    Load the encodings of these models ahead of the first request.
+
+    May download them, so call it off the event loop.
+    """
+    for model in models:
+        _encoding_for(model or settings.openai_model)
+
+
+def count_tokens(text: str, model: Optional[str] = None) -> int:
+    """
+    Count the tokens a message body will use, including per-message framing.
+
+    Uses tiktoken when installed and falls back to ~4 characters per token.
+    """
+    encoding = _encoding_for(model or settings.openai_model)
+    if encoding is not None:
+        body = len(encoding.encode(text, disallowed_special=()))
+    else:
+        body = math.ceil(len(text) / 4)
+    return body + MESSAGE_OVERHEAD_TOKENS
+
+
+def _parse_budgets(raw: str) -> Dict[str, int]:
+    budgets = {}
+    for item in raw.split(","):
+        if "=" in item:
+            model, budget = item.split("=", 1)
+            budgets[model.strip()] = int(budget)
+    return budgets
+
+
+_model_budgets = _parse_budgets(settings.history_token_budgets)
+
+
+def history_token_budget(model: str) -> int:
+    """Token budget for conversation history sent to a given model."""
+    return _model_budgets.get(model, settings.history_token_budget)
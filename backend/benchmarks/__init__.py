@@ -0,0 +1 @@
+# SmartAdvisor load tests and benchmarks
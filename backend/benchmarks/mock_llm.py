@@ -0,0 +1,165 @@
+"""
+Mock OpenAI-compatible chat completions server for load tests.
+
+Point the backend at it with the `openai-compatible` provider:
+
+    python -m benchmarks.mock_llm --port 9100 --latency lognormal:0.3,0.5 --tokens-per-second 80
+    LLM_PROVIDER=openai-compatible OPENAI_COMPATIBLE_BASE_URL=http://127.0.0.1:9100/v1 uvicorn app.main:app
+"""
+from typing import Dict, List, Optional
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+class MockSettings:
+    """Behaviour of the mock provider."""
+    
+    def __init__(self, latency: str = "constant:0.05", tokens_per_second: float = 0.0,
+                 completion_tokens: int = 60, error_rate: float = 0.0,
+                 rate_limit_rate: float = 0.0, seed: Optional[int] = None):
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.completion_tokens = completion_tokens
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.random = random.Random(seed)
+        self._sample = self._parse_latency(latency)
+    
+    def _parse_latency(self, spec: str):
+        """
+        Parse a latency distribution in seconds.
+        
+        Supported: `constant:S`, `uniform:LOW,HIGH`, `lognormal:MEDIAN,SIGMA`.
+        """
+        kind, _, args = spec.partition(":")
+        values = [float(value) for value in args.split(",") if value]
+        if kind == "constant":
+            return lambda: values[0]
+        if kind == "uniform":
+            return lambda: self.random.uniform(values[0], values[1])
+        if kind == "lognormal":
+            return lambda: self.random.lognormvariate(math.log(values[0]), values[1])
+        raise ValueError(f"Unsupported latency distribution: {spec}")
+    
+    def sample_latency(self) -> float:
+        return max(0.0, self._sample())
+
+
+def _completion_words(messages: List[Dict], count: int) -> List[str]:
+    """Deterministic filler text derived from the prompt, one word per token."""
+    seed = messages[-1]["content"] if messages else ""
+    words = (seed.split() or ["ok"]) + ["lorem", "ipsum", "dolor", "sit", "amet"]
+    return [words[index % len(words)] for index in range(count)]
+
+
+def create_app(settings: MockSettings) -> FastAPI:
+    app = FastAPI(title="Mock LLM provider")
+    stats = {"requests": 0, "streams": 0, "errors": 0, "rate_limited": 0}
+    
+    @app.get("/v1/models")
+    async def list_models():
+        return {"object": "list", "data": [{"id": "mock-model", "object": "model"}]}
+    
+    @app.get("/stats")
+    async def get_stats():
+        return stats
+    
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        stats["requests"] += 1
+        roll = settings.random.random()
+        if roll < settings.rate_limit_rate:
+            stats["rate_limited"] += 1
+            return JSONResponse({"error": {"message": "rate limited"}}, status_code=429,
+                                headers={"Retry-After": "1"})
+        if roll < settings.rate_limit_rate + settings.error_rate:
+            stats["errors"] += 1
+            await asyncio.sleep(settings.sample_latency())
+            return JSONResponse({"error": {"message": "injected failure"}}, status_code=500)
+        
+        messages = body.get("messages") or []
+        model = body.get("model", "mock-model")
+        words = _completion_words(messages, body.get("max_tokens") or settings.completion_tokens)
+        prompt_tokens = sum(len(str(message.get("content", ""))) // 4 + 4 for message in messages)
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(words),
+            "total_tokens": prompt_tokens + len(words)
+        }
+        # Time to first token
+        await asyncio.sleep(settings.sample_latency())
+        
+        if body.get("stream"):
+            stats["streams"] += 1
+            return StreamingResponse(_stream(words, model, usage, settings), media_type="text/event-stream")
+        
+        if settings.tokens_per_second > 0:
+            await asyncio.sleep(len(words) / settings.tokens_per_second)
+        return {
+            "id": f"chatcmpl-mock-{stats['requests']}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": " ".join(words)},
+                "finish_reason": "stop"
+            }],
+            "usage": usage
+        }
+    
+    return app
+
+
+async def _stream(words: List[str], model: str, usage: Dict, settings: MockSettings):
+    delay = 1.0 / settings.tokens_per_second if settings.tokens_per_second > 0 else 0.0
+    for index, word in enumerate(words):
+        chunk = {
+            "object": "chat.completion.chunk",
+            "model": model,
+            "choices": [{"index": 0, "delta": {"content": word if index == 0 else " " + word}}]
+        }
+        yield f"data: {json.dumps(chunk)}\n\n"
+        if delay:
+            await asyncio.sleep(delay)
+    final = {"object": "chat.completion.chunk", "model": model, "choices": [], "usage": usage}
+    yield f"data: {json.dumps(final)}\n\n"
+    yield "data: [DONE]\n\n"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock OpenAI-compatible LLM provider")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--latency", default="constant:0.05",
+                        help="constant:S | uniform:LOW,HIGH | lognormal:MEDIAN,SIGMA (seconds)")
+    parser.add_argument("--tokens-per-second", type=float, default=0.0,
+                        help="Generation speed; 0 returns the whole completion at once")
+    parser.add_argument("--completion-tokens", type=int, default=60)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Fraction of requests answered with 429")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+    
+    settings = MockSettings(
+        latency=args.latency,
+        tokens_per_second=args.tokens_per_second,
+        completion_tokens=args.completion_tokens,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        seed=args.seed
+    )
+    uvicorn.run(create_app(settings), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
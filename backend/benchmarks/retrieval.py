@@ -0,0 +1,167 @@
+"""
+Benchmark for knowledge retrieval.
+
+Builds an index over a synthetic corpus (Zipf-distributed vocabulary, so term
+frequencies look like real text), then times index build, open and top-k
+queries. Also reports how much smaller the injected knowledge is than the
+whole corpus in the prompt. Results can be saved as a baseline and later
+runs compared against it; a regression beyond the tolerance exits non-zero.
+
+Examples (from backend/):
+
+    python -m benchmarks.retrieval --documents 2000 --save-baseline benchmarks/baselines/retrieval.json
+    python -m benchmarks.retrieval --documents 2000 --embeddings --baseline benchmarks/baselines/retrieval.json
+"""
+from pathlib import Path
+from typing import Dict, List
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from app import knowledge
+from benchmarks.run import percentile
+
+
+def make_corpus(documents: int, words_per_document: int, vocabulary: int, seed: int) -> List[tuple]:
+    rng = random.Random(seed)
+    words = [f"term{i}" for i in range(vocabulary)]
+    weights = [1.0 / (rank + 1) for rank in range(vocabulary)]
+    corpus = []
+    for doc_id in range(documents):
+        paragraphs = []
+        remaining = words_per_document
+        while remaining > 0:
+            length = min(remaining, rng.randint(40, 120))
+            paragraphs.append(" ".join(rng.choices(words, weights, k=length)))
+            remaining -= length
+        corpus.append((doc_id, f"doc-{doc_id}", "\n\n".join(paragraphs)))
+    return corpus
+
+
+def make_queries(count: int, vocabulary: int, seed: int) -> List[str]:
+    rng = random.Random(seed + 1)
+    # Mostly mid-frequency terms, like real questions, plus some very common ones
+    return [
+        " ".join(f"term{rng.randint(0, vocabulary // 4 if rng.random() < 0.2 else vocabulary - 1)}"
+                 for _ in range(rng.randint(2, 6)))
+        for _ in range(count)
+    ]
+
+
+def run(args) -> Dict[str, Dict]:
+    corpus = make_corpus(args.documents, args.words, args.vocabulary, args.seed)
+    queries = make_queries(args.queries, args.vocabulary, args.seed)
+    dims = args.embedding_dims if args.embeddings else 0
+    if dims and knowledge.numpy is None:
+        sys.exit("--embeddings needs numpy")
+    
+    directory = tempfile.mkdtemp(prefix="knowledge-bench-")
+    try:
+        started = time.perf_counter()
+        generation = knowledge.build_index(directory, 1, corpus, args.chunk_words, args.chunk_overlap, dims)
+        build_seconds = time.perf_counter() - started
+        size_mb = sum(path.stat().st_size for path in (Path(directory) / generation).iterdir()) / 2 ** 20
+        
+        started = time.perf_counter()
+        index = knowledge.KnowledgeIndex(Path(directory) / generation)
+        open_seconds = time.perf_counter() - started
+        
+        latencies = []
+        injected_chars = 0
+        for query in queries:
+            started = time.perf_counter()
+            results = index.search(query, args.top_k)
+            latencies.append((time.perf_counter() - started) * 1000)
+            injected_chars += sum(len(index.chunk_text(chunk_id)) for chunk_id, _ in results)
+        index.close()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    
+    corpus_chars = sum(len(content) for _, _, content in corpus)
+    mode = "hybrid" if dims else "bm25"
+    key = f"{mode}/{args.documents}docs"
+    return {
+        key: {
+            "chunks": index.chunk_count,
+            "build_seconds": round(build_seconds, 3),
+            "open_ms": round(open_seconds * 1000, 2),
+            "index_mb": round(size_mb, 2),
+            "p50_ms": round(percentile(latencies, 0.5), 3),
+            "p95_ms": round(percentile(latencies, 0.95), 3),
+            "p99_ms": round(percentile(latencies, 0.99), 3),
+            "qps": round(len(latencies) / (sum(latencies) / 1000), 1),
+            "avg_injected_chars": round(injected_chars / len(queries)),
+            "corpus_chars": corpus_chars
+        }
+    }
+
+
+def compare(results: Dict[str, Dict], baseline: Dict[str, Dict], tolerance: float) -> List[str]:
+    """List query latency and build time regressions beyond `tolerance` (a fraction)."""
+    regressions = []
+    for key, base in baseline.items():
+        current = results.get(key)
+        if current is None:
+            continue
+        for metric in ("p95_ms", "p99_ms", "build_seconds"):
+            if current[metric] > base[metric] * (1 + tolerance):
+                regressions.append(f"{key}: {metric} {current[metric]} > baseline {base[metric]}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SmartAdvisor knowledge retrieval benchmark")
+    parser.add_argument("--documents", type=int, default=1000)
+    parser.add_argument("--words", type=int, default=800, help="Words per document")
+    parser.add_argument("--vocabulary", type=int, default=20000)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--top-k", type=int, default=4)
+    parser.add_argument("--chunk-words", type=int, default=180)
+    parser.add_argument("--chunk-overlap", type=int, default=30)
+    parser.add_argument("--embeddings", action="store_true", help="Also index hashed vectors (needs numpy)")
+    parser.add_argument("--embedding-dims", type=int, default=512)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--save-baseline", help="Write results as a baseline file")
+    parser.add_argument("--baseline", help="Compare against a baseline file and fail on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed regression as a fraction")
+    args = parser.parse_args()
+    
+    results = run(args)
+    for key, result in results.items():
+        print(f"{key:<24} {result['chunks']} chunks  build {result['build_seconds']:.2f}s  "
+              f"open {result['open_ms']:.1f}ms  index {result['index_mb']:.1f}MiB")
+        print(f"{'':<24} p50 {result['p50_ms']:.3f}ms  p95 {result['p95_ms']:.3f}ms  "
+              f"p99 {result['p99_ms']:.3f}ms  {result['qps']:.0f} qps")
+        print(f"{'':<24} prompt knowledge {result['avg_injected_chars']} chars per query "
+              f"instead of {result['corpus_chars']}")
+    
+    if args.save_baseline:
+        path = args.save_baseline
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        existing = {}
+        if os.path.exists(path):
+            with open(path) as handle:
+                existing = json.load(handle)
+        with open(path, "w") as handle:
+            json.dump({**existing, **results}, handle, indent=2, sort_keys=True)
+        print(f"Wrote {path}")
+    
+    if args.baseline:
+        with open(args.baseline) as handle:
+            baseline = json.load(handle)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"\nREGRESSIONS against {args.baseline}:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print(f"\nNo regressions against {args.baseline} (tolerance {args.tolerance:.0%})")
+
+
+if __name__ == "__main__":
+    main()
@@ -37,6 +37,9 @@ fi
 # Create logs directory
 mkdir -p logs
 
+# Bring the database schema up to date
+python -m app.migrate
+
 # Start the server
 echo "Starting FastAPI server on http://0.0.0.0:8000"
 uvicorn app.main:app --reload --host 0.0.0.0 --port 8000
@@ -21,5 +21,8 @@ else
   echo "No injection performed (missing API_URL or folder)."
 fi
 
+# create missing tables and migrate legacy data (safe to re-run)
+python -m app.migrate
+
 # start the server
 exec uvicorn app.main:app --host 0.0.0.0 --port "$PORT"
@@ -25,6 +25,9 @@ function App() {
     scrollToBottom()
   }, [messages])
 
+  // Context belongs to the current conversation once it has a session
+  const sessionParams = () => (sessionId ? { params: { session_id: sessionId } } : {})
+
   const scrollToBottom = () => {
     messagesEndRef.current?.scrollIntoView({ behavior: 'smooth' })
   }
@@ -40,7 +43,7 @@ function App() {
 
   const loadCurrentContext = async () => {
     try {
-      const response = await axios.get(`${API_BASE_URL}/api/context`)
+      const response = await axios.get(`${API_BASE_URL}/api/context`, sessionParams())
       setContext(response.data.context)
       setContextInput(JSON.stringify(response.data.context, null, 2))
     } catch (error) {
@@ -52,7 +55,9 @@ function App() {
     if (!presetName) return
     
     try {
-      const response = await axios.post(`${API_BASE_URL}/api/presets/${presetName}/apply`)
+      const response = await axios.post(`${API_BASE_URL}/api/presets/${presetName}/apply`, null, sessionParams())
+      // Applying a preset before the first query starts the conversation's session
+      setSessionId(response.data.session_id)
       setContext(response.data.context)
       setContextInput(JSON.stringify(response.data.context, null, 2))
       setSelectedPreset(presetName)
@@ -71,11 +76,12 @@ function App() {
   const handleContextUpdate = async () => {
     try {
       const contextData = JSON.parse(contextInput)
-      await axios.post(`${API_BASE_URL}/api/context`, {
+      const response = await axios.post(`${API_BASE_URL}/api/context`, {
         context: contextData,
         merge: true
-      })
-      setContext(contextData)
+      }, sessionParams())
+      setSessionId(response.data.session_id)
+      setContext(response.data.context)
       setShowContextEditor(false)
       alert('Context updated successfully')
     } catch (error) {
@@ -128,7 +134,7 @@ function App() {
 
   const clearContext = async () => {
     try {
-      await axios.delete(`${API_BASE_URL}/api/context`)
+      await axios.delete(`${API_BASE_URL}/api/context`, sessionParams())
       setContext({})
       setContextInput('{}')
       setSelectedPreset('')